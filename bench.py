@@ -0,0 +1,335 @@
+"""
+Замеры отдельных операций бота на синтетической базе, без Telegram.
+Каждый сценарий заполняет временную базу, вызывает настоящие функции bot.py и печатает время.
+
+Сценарии:
+  report - отчёт по позициям экземпляров: --instances экземпляров по 10 позиций
+           в 100 разбивках, страницы отчёта без фильтров и с фильтрами; --baseline дополнительно
+           замеряет прежний обход экземпляров с запросами на каждый (N+1, на 10 тыс. экземпляров - секунды).
+  export - выгрузки в файл: --lines строк заказов, время и размер каждой выгрузки и память процесса
+           (выгрузка читается из базы порциями, поэтому анонимная память не должна расти с числом строк);
+           XLSX заметно медленнее CSV и замеряется только с --xlsx.
+  callbacks - разбор callback_data и выбор обработчика: decode_callback и поиск CallbackQueryHandler
+           по шаблону маршрута, как это делает приложение для каждого нажатия кнопки.
+
+Пример: python bench.py report --instances 10000; python bench.py export --lines 1000000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+# Синтетическая база отчёта: разбивок, товаров в разбивке, пользователей, заказов на экземпляр
+REPORT_BREAKDOWNS = 100
+REPORT_ITEMS = 10
+REPORT_USERS = 2000
+REPORT_ORDERS_PER_INSTANCE = 5
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Замеры операций бота на синтетической базе")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора случайных чисел")
+    parser.add_argument("--verbose", action="store_true", help="не скрывать INFO-логи бота")
+    scenarios = parser.add_subparsers(dest="scenario", required=True)
+
+    report = scenarios.add_parser("report", help="отчёт по позициям экземпляров")
+    report.add_argument("--instances", type=int, default=10_000, help="экземпляров в базе (по умолчанию 10000)")
+    report.add_argument("--pages", type=int, default=20, help="страниц, пролистываемых вперёд без фильтров")
+    report.add_argument("--repeat", type=int, default=20, help="повторов замера первой страницы")
+    report.add_argument("--baseline", action="store_true", help="замерить и прежний N+1 обход экземпляров")
+
+    export = scenarios.add_parser("export", help="выгрузки заказов и чеков в файл")
+    export.add_argument("--lines", type=int, default=1_000_000, help="строк заказов (по умолчанию 1000000)")
+    export.add_argument("--xlsx", action="store_true", help="замерить и выгрузку в XLSX (нужен openpyxl)")
+
+    callbacks = scenarios.add_parser("callbacks", help="разбор callback_data и выбор обработчика")
+    callbacks.add_argument("--count", type=int, default=200_000, help="нажатий в замере (по умолчанию 200000)")
+    return parser.parse_args()
+
+
+def configure_environment(db_dir: str) -> None:
+    """Настройки бота читаются из окружения при импорте, поэтому задаются до import bot."""
+    os.environ["DB_PATH"] = os.path.join(db_dir, "bench.sqlite")
+    os.environ["BOT_TOKEN"] = "123456:bench"
+    os.environ["METRICS_PORT"] = "0"
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f} мс"
+
+
+class BenchQuery:
+    """CallbackQuery без Telegram: запоминает последний отрисованный экран."""
+
+    def __init__(self) -> None:
+        self.message = None
+        self.text = None
+        self.reply_markup = None
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        self.text = text
+        self.reply_markup = reply_markup
+
+    def button(self, prefix: str) -> str:
+        """callback_data первой кнопки, текст которой начинается с prefix, или пустая строка."""
+        for row in self.reply_markup.inline_keyboard:
+            for button in row:
+                if button.text.startswith(prefix):
+                    return button.callback_data
+        return ""
+
+
+def peak_rss_mb() -> int:
+    """Пиковый размер резидентной памяти процесса, МБ (ru_maxrss в Linux - в КБ)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+class AnonMemorySampler:
+    """
+    Максимум анонимной памяти процесса (RssAnon из /proc/self/status, Linux) за время замера.
+    В RSS входят и страницы файла базы, прочитанные через mmap (PRAGMA mmap_size), поэтому он растёт
+    с размером базы; рост самого процесса (объекты Python, буферы) видно только по анонимной памяти.
+    """
+
+    def __init__(self, interval: float = 0.02) -> None:
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current_kb() -> int:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("RssAnon:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, self.current_kb())
+
+    def __enter__(self) -> "AnonMemorySampler":
+        self.peak_kb = self.current_kb()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, self.current_kb())
+
+
+class BenchBot:
+    """Bot без Telegram: send_document только запоминает имя и размер файла."""
+
+    def __init__(self) -> None:
+        self.documents = []
+
+    async def send_document(self, chat_id, document, filename, caption=None):
+        document.seek(0, os.SEEK_END)
+        self.documents.append((filename, document.tell()))
+
+
+def seed_report(path: str, instances: int, rng: random.Random) -> None:
+    """Разбивки с товарами, экземпляры (1% открытых) и заказы по две позиции, как после работы бота."""
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO users (user_id, username) VALUES (?, ?)",
+                     [(user_id, f"user{user_id}") for user_id in range(1, REPORT_USERS + 1)])
+    items = {}
+    for b in range(1, REPORT_BREAKDOWNS + 1):
+        conn.execute("INSERT INTO breakdowns (name) VALUES (?)", (f"Разбивка {b}",))
+        conn.executemany("INSERT INTO items (breakdown_name, item_name, price) VALUES (?, ?, ?)",
+                         [(f"Разбивка {b}", f"Позиция {k}", 10.0 + k) for k in range(REPORT_ITEMS)])
+    for item_id, breakdown_name, item_name, price in conn.execute("SELECT id, breakdown_name, item_name, price FROM items"):
+        items.setdefault(breakdown_name, []).append((item_id, item_name, price))
+    per_order = REPORT_ITEMS // REPORT_ORDERS_PER_INSTANCE
+    order_id = 0
+    for instance_id in range(1, instances + 1):
+        breakdown_name = f"Разбивка {rng.randint(1, REPORT_BREAKDOWNS)}"
+        status = "open" if instance_id > instances * 0.99 else "complete"
+        conn.execute("INSERT INTO breakdown_instances (id, breakdown_name, status, taken_count, total_count) "
+                     "VALUES (?, ?, ?, ?, ?)", (instance_id, breakdown_name, status, REPORT_ITEMS, REPORT_ITEMS))
+        for k in range(0, REPORT_ITEMS, per_order):
+            order_id += 1
+            part = items[breakdown_name][k:k + per_order]
+            conn.execute("INSERT INTO orders (order_id, user_id, breakdown_name, items, total_amount, instance_id) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (order_id, rng.randint(1, REPORT_USERS), breakdown_name,
+                          json.dumps([{"name": name, "price": price} for _, name, price in part]),
+                          sum(price for *_, price in part), instance_id))
+            conn.executemany("INSERT INTO order_items (order_id, instance_id, item_id, price) VALUES (?, ?, ?, ?)",
+                             [(order_id, instance_id, item_id, price) for item_id, _, price in part])
+    conn.commit()
+    conn.close()
+
+
+async def legacy_positions_report(bot) -> int:
+    """Прежний отчёт: запрос товаров и заказов на каждый экземпляр и имени на каждый заказ."""
+    lines = 0
+    for instance_id, breakdown_name in await bot.db.fetchall("SELECT id, breakdown_name FROM breakdown_instances"):
+        items = await bot.db.fetchall("SELECT item_name, price FROM items WHERE breakdown_name = ?", (breakdown_name,))
+        for user_id, items_json in await bot.db.fetchall("SELECT user_id, items FROM orders WHERE instance_id = ?",
+                                                         (instance_id,)):
+            json.loads(items_json)
+            await bot.db.fetchone("SELECT username FROM users WHERE user_id = ?", (user_id,))
+        lines += len(items)
+    return lines
+
+
+async def bench_report(bot, args: argparse.Namespace) -> None:
+    started = time.perf_counter()
+    seed_report(bot.DB_PATH, args.instances, random.Random(args.seed))
+    print(f"База: {args.instances} экземпляров, {REPORT_BREAKDOWNS} разбивок по {REPORT_ITEMS} позиций "
+          f"({time.perf_counter() - started:.1f} с на заполнение)")
+    await bot.catalog.breakdowns()
+    breakdown_id = (await bot.catalog.breakdowns())[REPORT_BREAKDOWNS // 2][0]
+
+    async def render(data: list) -> tuple:
+        query = BenchQuery()
+        began = time.perf_counter()
+        await bot.on_view_all_positions(query, None, data)
+        return time.perf_counter() - began, query
+
+    # Первая страница с каждым сочетанием фильтров: открытые экземпляры, одна разбивка
+    for title, filters in (("без фильтров", (0, 0)), ("только открытые", (1, 0)),
+                           ("одна разбивка", (0, breakdown_id)), ("открытые + разбивка", (1, breakdown_id))):
+        timings = [(await render([*filters, 0, 0, 0]))[0] for _ in range(args.repeat)]
+        print(f"  первая страница, {title:20} медиана {ms(statistics.median(timings))}, макс {ms(max(timings))}")
+
+    # Листание вперёд: страница читается по ключу (экземпляр, позиция), время не зависит от её номера
+    timings = []
+    _, query = await render([])
+    for _ in range(args.pages):
+        data = query.button("Вперёд")
+        if not data:
+            break
+        elapsed, query = await render(bot.decode_callback(data)[1])
+        timings.append(elapsed)
+    if timings:
+        print(f"  листание вперёд, {len(timings)} страниц: медиана {ms(statistics.median(timings))}, "
+              f"макс {ms(max(timings))}")
+
+    if args.baseline:
+        began = time.perf_counter()
+        lines = await legacy_positions_report(bot)
+        print(f"  прежний N+1 обход: {time.perf_counter() - began:.1f} с ({lines} строк)")
+
+
+def seed_export(path: str, lines: int) -> None:
+    """Одна разбивка из 10 товаров, завершённые экземпляры и заказы по две строки; строки вставляются генераторами."""
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO users (user_id, username) VALUES (?, ?)",
+                     ((user_id, f"user{user_id}") for user_id in range(1, 5001)))
+    conn.execute("INSERT INTO breakdowns (name) VALUES ('Выгрузка')")
+    conn.executemany("INSERT INTO items (breakdown_name, item_name, price) VALUES ('Выгрузка', ?, ?)",
+                     [(f"Позиция {k}", 100.0 + k) for k in range(10)])
+    conn.executemany("INSERT INTO breakdown_instances (id, breakdown_name, status, taken_count, total_count) "
+                     "VALUES (?, 'Выгрузка', 'complete', 10, 10)", ((i,) for i in range(1, lines // 10 + 1)))
+    conn.executemany("INSERT INTO orders (order_id, user_id, breakdown_name, items, total_amount, instance_id) "
+                     "VALUES (?, ?, 'Выгрузка', '[]', 0, ?)",
+                     ((o, o % 5000 + 1, (o - 1) // 5 + 1) for o in range(1, lines // 2 + 1)))
+    conn.executemany("INSERT INTO order_items (order_id, instance_id, item_id, price) VALUES (?, ?, ?, 100)",
+                     ((line // 2 + 1, line // 10 + 1, line % 10 + 1) for line in range(lines)))
+    conn.commit()
+    conn.close()
+
+
+async def bench_export(bot, args: argparse.Namespace) -> None:
+    started = time.perf_counter()
+    seed_export(bot.DB_PATH, args.lines)
+    print(f"База: {args.lines} строк заказов ({time.perf_counter() - started:.1f} с на заполнение), "
+          f"{os.path.getsize(bot.DB_PATH) / 2 ** 20:.0f} МБ; до выгрузок: анонимная память "
+          f"{AnonMemorySampler.current_kb() // 1024} МБ, пиковый RSS {peak_rss_mb()} МБ")
+    runs = [("orders", "csv"), ("checks", "csv")]
+    if args.xlsx:
+        if bot.Workbook is None:
+            print("  openpyxl не установлен, XLSX пропущен")
+        else:
+            runs.append(("orders", "xlsx"))
+    sender = BenchBot()
+    for kind, fmt in runs:
+        began = time.perf_counter()
+        with AnonMemorySampler() as memory:
+            await bot.send_export(sender, 0, kind, fmt)
+        filename, size = sender.documents[-1]
+        print(f"  {kind} {fmt}: {time.perf_counter() - began:.1f} с, {filename} {size / 2 ** 20:.1f} МБ, "
+              f"анонимная память до {memory.peak_kb // 1024} МБ, пиковый RSS {peak_rss_mb()} МБ")
+
+
+def callback_samples(bot, rng: random.Random, count: int) -> list:
+    """callback_data всех маршрутов вперемешку: статические команды и команды со случайными id."""
+    keys = list(bot.ROUTES)
+    samples = []
+    for _ in range(count):
+        key = rng.choice(keys)
+        arity = bot.CALLBACK_ARITY.get(key, 0)
+        ids = [rng.randint(0, 10 ** rng.randint(1, 6)) for _ in range(arity)]
+        samples.append(":".join([key, *(bot.to_base36(i) for i in ids)]) if arity else key)
+    return samples
+
+
+async def bench_callbacks(bot, args: argparse.Namespace) -> None:
+    from telegram import CallbackQuery, Update, User
+    samples = callback_samples(bot, random.Random(args.seed), args.count)
+    print(f"Маршрутов: {len(bot.ROUTES)}, нажатий: {len(samples)}, "
+          f"самая длинная callback_data: {max(len(data.encode()) for data in samples)} байт (лимит Telegram 64)")
+
+    began = time.perf_counter()
+    for data in samples:
+        key, _ = bot.decode_callback(data)
+        bot.ROUTES[key]
+    per_call = (time.perf_counter() - began) / len(samples)
+    print(f"  decode_callback + таблица маршрутов: {per_call * 1e6:.2f} мкс на нажатие")
+
+    # Приложение проверяет обработчики по порядку, пока шаблон одного из них не совпадёт
+    handlers = bot.build_callback_handlers()
+    user = User(id=1, first_name="bench", is_bot=False)
+    updates = [Update(update_id=i, callback_query=CallbackQuery(id=str(i), from_user=user, chat_instance="1", data=data))
+               for i, data in enumerate(samples)]
+    began = time.perf_counter()
+    for update in updates:
+        next(handler for handler in handlers if handler.check_update(update))
+        bot.decode_callback(update.callback_query.data)
+    per_call = (time.perf_counter() - began) / len(updates)
+    print(f"  выбор CallbackQueryHandler ({len(handlers)} шт.) + decode_callback: {per_call * 1e6:.2f} мкс на нажатие")
+
+
+SCENARIOS = {
+    "report": bench_report,
+    "export": bench_export,
+    "callbacks": bench_callbacks,
+}
+
+
+def main() -> None:
+    args = parse_args()
+    db_dir = tempfile.mkdtemp(prefix="bench-")
+    configure_environment(db_dir)
+    import bot  # настройки бота уже заданы в окружении
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    try:
+        bot.init_db(bot.DB_PATH)
+        asyncio.run(SCENARIOS[args.scenario](bot, args))
+    finally:
+        bot.db.close()
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,111 +1,1759 @@
+import asyncio
+import csv
+import html
 import logging
 import json
+import os
+import re
+import secrets
 import sqlite3
-from collections import defaultdict
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX-экспорт доступен, только если установлен openpyxl
+    Workbook = None
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.ext import (Application, BasePersistence, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler,
+                          MessageHandler, PersistenceInput, filters, ContextTypes)
 
 # Настройка логирования:
 # Определяем формат логов и уровень важности сообщений (INFO и выше)
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Подключение к базе данных SQLite:
-# Создаём соединение с файлом базы данных "bot_db.sqlite". Параметр check_same_thread=False позволяет использовать соединение в разных потоках.
-conn = sqlite3.connect("bot_db.sqlite", check_same_thread=False)
-# Переключаем режим журнала (WAL) для улучшения производительности и надежности
-conn.execute("PRAGMA journal_mode = WAL")
-cursor = conn.cursor()
+# Настройки бота задаются переменными окружения (см. docker-compose.yml)
+BOT_TOKEN = os.getenv("BOT_TOKEN", "ТОКЕН БОТА")
+# Перманентные администраторы (id через запятую): всегда имеют доступ и не удаляются через бота
+SUPER_ADMIN_IDS = frozenset(int(x) for x in os.getenv("SUPER_ADMIN_IDS", "1244636103").split(",") if x.strip())
 
-# Попытка добавить новый столбец "hidden" в таблицу breakdowns, если он отсутствует.
-# Если столбец уже существует, возникает исключение, которое мы игнорируем.
-try:
-    cursor.execute("ALTER TABLE breakdowns ADD COLUMN hidden INTEGER DEFAULT 0")
-    conn.commit()
-except Exception:
-    pass
-
-# Создание таблиц, если они ещё не созданы:
-# Таблица "users" для хранения информации о пользователях бота.
-# Таблица "admins" для хранения информации об администраторах.
-# Таблица "orders" для хранения заказов пользователей.
-# Таблица "breakdowns" для хранения доступных разбивок (наборов товаров).
-# Таблица "items" для хранения информации о товарах, входящих в разбивки.
-# Таблица "messages" для хранения сообщений пользователей.
-# Таблица "breakdown_instances" для хранения экземпляров разбивок и их статусов.
-cursor.executescript("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT,
-    phone_number TEXT
-);
-
-CREATE TABLE IF NOT EXISTS admins (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT
-);
-
-CREATE TABLE IF NOT EXISTS orders (
-    order_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    breakdown_name TEXT NOT NULL,
-    items TEXT,
-    total_amount REAL,
-    instance_id INTEGER,
-    FOREIGN KEY(user_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS breakdowns (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT NOT NULL UNIQUE,
-    hidden INTEGER DEFAULT 0
-);
-
-CREATE TABLE IF NOT EXISTS items (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    breakdown_name TEXT NOT NULL,
-    item_name TEXT NOT NULL,
-    price REAL NOT NULL,
-    FOREIGN KEY(breakdown_name) REFERENCES breakdowns(name)
-);
-
-CREATE TABLE IF NOT EXISTS messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    message TEXT NOT NULL,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-);
-
-CREATE TABLE IF NOT EXISTS breakdown_instances (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    breakdown_name TEXT NOT NULL,
-    status TEXT DEFAULT 'open'
-);
-""")
-conn.commit()
+# Путь к файлу базы данных SQLite и количество читающих соединений
+DB_PATH = os.getenv("DB_PATH", "bot_db.sqlite")
+DB_READERS = 4
+# Настройки соединений: ожидание блокировки (мс), кэш страниц (КБ на соединение), размер отображения файла в память
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_KB = 16000
+DB_MMAP_BYTES = 256 * 1024 * 1024
+
+# Режим получения обновлений: polling (по умолчанию) или webhook.
+# Для webhook нужен публичный HTTPS-адрес WEBHOOK_URL, на который Telegram будет присылать обновления;
+# встроенный сервер слушает WEBHOOK_LISTEN:WEBHOOK_PORT по пути WEBHOOK_PATH.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Секрет заголовка X-Telegram-Bot-Api-Secret-Token; если не задан, генерируется при каждом запуске
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Сколько обновлений разных пользователей обрабатывается одновременно
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+# Сколько обновлений разных пользователей может быть принято в обработку (выполняются или ждут свободного слота);
+# повторные обновления одного пользователя ждут в его очереди и в этот лимит не входят
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "1024"))
+# Соединений HTTP-клиента Bot API: с запасом на UPDATE_CONCURRENCY обработчиков и рассылку
+# (так же, как по умолчанию задаёт ApplicationBuilder; сам HTTPXRequest по умолчанию открывает одно)
+BOT_API_POOL_SIZE = 256
+# Как часто (в секундах) изменения context.user_data сохраняются в базу
+PERSISTENCE_INTERVAL = 5.0
+
+# Ограничения рассылки уведомлений (лимиты Telegram: ~30 сообщений в секунду всего и ~1 в секунду в один чат)
+NOTIFY_RATE = 25.0
+NOTIFY_CHAT_RATE = 1.0
+NOTIFY_CONCURRENCY = 8
+NOTIFY_BATCH = 100
+NOTIFY_MAX_ATTEMPTS = 5
+
+# Хранение сообщений пользователей: сообщения старше MESSAGE_RETENTION_DAYS дней (0 - хранить всё) переносятся
+# в таблицу messages_archive раз в MESSAGE_ARCHIVE_INTERVAL секунд пачками по MESSAGE_ARCHIVE_BATCH строк
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "90"))
+MESSAGE_ARCHIVE_INTERVAL = 3600.0
+MESSAGE_ARCHIVE_BATCH = 500
+# Пауза между пачками, чтобы поток-писатель успевал выполнять транзакции обработчиков
+MESSAGE_ARCHIVE_PAUSE = 0.05
+
+# Очистка удалённых разбивок: строк за одну транзакцию и пауза между транзакциями (с)
+PURGE_BATCH = 200
+PURGE_PAUSE = 0.05
+
+# Метрики задержек в формате Prometheus отдаются по http://METRICS_LISTEN:METRICS_PORT/metrics (0 - отключить)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# Сколько последних замеров каждой метрики хранится для расчёта перцентилей
+METRICS_WINDOW = 1024
+# Вызовы обработчиков дольше этого порога (в секундах) пишутся в лог
+SLOW_ROUTE_SECONDS = 1.0
+
+
+class Histogram:
+    """
+    Задержки одной операции: общее количество и сумма замеров, максимум и кольцевой буфер последних
+    METRICS_WINDOW значений, по которому считаются перцентили.
+    Запись - O(1) без выделения памяти, сортировка выполняется только при чтении метрик.
+    """
+
+    __slots__ = ("count", "total", "worst", "_window", "_next")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self._window = [0.0] * METRICS_WINDOW
+        self._next = 0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.worst:
+            self.worst = seconds
+        self._window[self._next] = seconds
+        self._next = (self._next + 1) % METRICS_WINDOW
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)) -> list:
+        """Перцентили по последним замерам (ближайший ранг)."""
+        samples = sorted(self._window[:min(self.count, METRICS_WINDOW)])
+        if not samples:
+            return [0.0] * len(qs)
+        return [samples[min(len(samples) - 1, int(q * len(samples)))] for q in qs]
+
+
+class LatencyMetrics:
+    """
+    Гистограммы задержек одной группы операций (обработчики, запросы к базе, вызовы Bot API) по меткам.
+    Запись выполняется только из потока цикла событий, поэтому блокировки не нужны.
+    Если задан порог slow, операции дольше него дополнительно пишутся в лог.
+    """
+
+    def __init__(self, name: str, label: str, title: str, slow: Optional[float] = None) -> None:
+        self.name = name
+        self.label = label
+        self.title = title
+        self.slow = slow
+        self.stats = defaultdict(Histogram)
+
+    def record(self, key: str, seconds: float) -> None:
+        self.stats[key].record(seconds)
+        if self.slow is not None and seconds > self.slow:
+            logger.warning("Медленный вызов %s %s: %.3f с", self.name, key, seconds)
+
+    def top(self, limit: Optional[int] = None) -> list:
+        """Метки по убыванию суммарного времени."""
+        return sorted(self.stats.items(), key=lambda kv: kv[1].total, reverse=True)[:limit]
+
+    def summary(self, limit: Optional[int] = None) -> str:
+        """Строки "метка: вызовы, p50/p95/p99 и максимум в мс"."""
+        lines = []
+        for key, hist in self.top(limit):
+            p50, p95, p99 = (q * 1000 for q in hist.quantiles())
+            lines.append(f"{key}: {hist.count} вызовов, p50 {p50:.1f} / p95 {p95:.1f} / p99 {p99:.1f} мс, "
+                         f"макс {hist.worst * 1000:.1f} мс")
+        return "\n".join(lines)
+
+    def prometheus(self) -> list:
+        """Строки метрики в текстовом формате Prometheus (тип summary)."""
+        metric = f"tgbot_{self.name}_seconds"
+        lines = [f"# HELP {metric} {self.title}", f"# TYPE {metric} summary"]
+        for key, hist in sorted(self.stats.items()):
+            label = f'{self.label}="{key}"'
+            for q, value in zip(("0.5", "0.95", "0.99"), hist.quantiles()):
+                lines.append(f'{metric}{{{label},quantile="{q}"}} {value:.6f}')
+            lines.append(f"{metric}_sum{{{label}}} {hist.total:.6f}")
+            lines.append(f"{metric}_count{{{label}}} {hist.count}")
+        return lines
+
+
+class CounterGroup:
+    """
+    Счётчики одного компонента (кэш, рассыльщик) для экрана метрик и /metrics.
+    source() возвращает словарь "имя: значение"; имена из monotonic только растут (тип counter), остальные - gauge.
+    """
+
+    def __init__(self, name: str, title: str, source, monotonic: tuple = ()) -> None:
+        self.name = name
+        self.title = title
+        self.source = source
+        self.monotonic = monotonic
+
+    def summary(self) -> str:
+        return ", ".join(f"{key} {value:g}" for key, value in self.source().items())
+
+    def prometheus(self) -> list:
+        lines = []
+        for key, value in self.source().items():
+            counter = key in self.monotonic
+            metric = f"tgbot_{self.name}_{key}" + ("_total" if counter else "")
+            lines += [f"# HELP {metric} {self.title}: {key}", f"# TYPE {metric} {'counter' if counter else 'gauge'}",
+                      f"{metric} {value:g}"]
+        return lines
+
+
+route_timings = LatencyMetrics("handler", "route", "Время обработчиков callback", slow=SLOW_ROUTE_SECONDS)
+db_timings = LatencyMetrics("db", "query", "Время запросов к базе (с ожиданием в очереди потока)")
+api_timings = LatencyMetrics("bot_api", "method", "Время вызовов Bot API")
+METRIC_GROUPS = (route_timings, db_timings, api_timings)
+
+
+class Database:
+    """
+    Асинхронный слой доступа к SQLite.
+    Все записи выполняются в одном выделенном потоке-писателе (SQLite допускает только одного писателя),
+    чтения - в пуле потоков с отдельными read-only соединениями (WAL позволяет читать параллельно с записью).
+    Каждый запрос - awaitable, поэтому fsync при коммите не блокирует цикл событий бота.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS) -> None:
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        # У каждого потока пула своё соединение
+        self._local = threading.local()
+        self._rollback_hooks = []
+        self._commit_hooks = []
+
+    def _connection(self, readonly: bool) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if readonly:
+                conn = sqlite3.connect(Path(self.path).resolve().as_uri() + "?mode=ro", uri=True,
+                                       isolation_level=None, check_same_thread=False)
+            else:
+                # Транзакциями писателя управляем явно (BEGIN IMMEDIATE ... COMMIT)
+                conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode = WAL")
+                # В режиме WAL synchronous = NORMAL не теряет целостность, но убирает fsync на каждый коммит
+                conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+            conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+            conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+            self._local.conn = conn
+        return conn
+
+    async def _run(self, executor: ThreadPoolExecutor, label: str, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        finally:
+            db_timings.record(label, time.perf_counter() - started)
+
+    def _read(self, sql: str, params: tuple, one: bool):
+        cur = self._connection(readonly=True).execute(sql, params)
+        return cur.fetchone() if one else cur.fetchall()
+
+    def _write(self, func, *args):
+        conn = self._connection(readonly=False)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            for hook in self._rollback_hooks:
+                hook()
+            raise
+        conn.execute("COMMIT")
+        for hook in self._commit_hooks:
+            hook()
+        return result
+
+    def on_rollback(self, hook) -> None:
+        """Регистрирует функцию, вызываемую в потоке-писателе после отката транзакции (сброс кэшей, изменённых внутри неё)."""
+        self._rollback_hooks.append(hook)
+
+    def on_commit(self, hook) -> None:
+        """Регистрирует функцию, вызываемую в потоке-писателе после фиксации транзакции (сброс кэшей чтения)."""
+        self._commit_hooks.append(hook)
+
+    # Метка замера одиночного запроса: "fetchall:<label>", по умолчанию label - имя вызывающей функции
+    # (разные запросы одного обработчика различаются явным label)
+
+    async def fetchone(self, sql: str, params: tuple = (), label: Optional[str] = None):
+        """Выполняет SELECT на читающем соединении и возвращает первую строку (или None)."""
+        label = f"fetchone:{label or sys._getframe(1).f_code.co_name}"
+        return await self._run(self._readers, label, self._read, sql, params, True)
+
+    async def fetchall(self, sql: str, params: tuple = (), label: Optional[str] = None) -> list:
+        """Выполняет SELECT на читающем соединении и возвращает все строки."""
+        label = f"fetchall:{label or sys._getframe(1).f_code.co_name}"
+        return await self._run(self._readers, label, self._read, sql, params, False)
+
+    async def execute(self, sql: str, params: tuple = (), label: Optional[str] = None) -> sqlite3.Cursor:
+        """Выполняет одиночный запрос на запись в отдельной транзакции и возвращает курсор (lastrowid, rowcount)."""
+        label = f"execute:{label or sys._getframe(1).f_code.co_name}"
+        return await self._run(self._writer, label, self._write, lambda conn: conn.execute(sql, params))
+
+    async def read(self, func, *args):
+        """Выполняет func(conn, *args) на читающем соединении (для длинных выборок, которые обрабатываются построчно)."""
+        return await self._run(self._readers, f"read:{func.__name__}",
+                               lambda: func(self._connection(readonly=True), *args))
+
+    async def transaction(self, func, *args):
+        """
+        Выполняет func(conn, *args) в потоке-писателе внутри одной транзакции.
+        При исключении транзакция откатывается, а исключение пробрасывается вызывающему.
+        """
+        return await self._run(self._writer, f"transaction:{func.__name__}", self._write, func, *args)
+
+    def close(self) -> None:
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+
+def column_names(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def migrate_base_schema(conn: sqlite3.Connection) -> None:
+    """
+    Исходные таблицы бота:
+    "users" - пользователи бота, "admins" - администраторы, "orders" - заказы пользователей,
+    "breakdowns" - доступные разбивки (наборы товаров), "items" - товары, входящие в разбивки,
+    "messages" - сообщения пользователей, "breakdown_instances" - экземпляры разбивок и их статусы.
+    """
+    for sql in (
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            phone_number TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS orders (
+            order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            breakdown_name TEXT NOT NULL,
+            items TEXT,
+            total_amount REAL,
+            instance_id INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS breakdowns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            hidden INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            breakdown_name TEXT NOT NULL,
+            item_name TEXT NOT NULL,
+            price REAL NOT NULL,
+            FOREIGN KEY(breakdown_name) REFERENCES breakdowns(name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS breakdown_instances (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            breakdown_name TEXT NOT NULL,
+            status TEXT DEFAULT 'open'
+        )""",
+    ):
+        conn.execute(sql)
+    # В самых старых базах таблица breakdowns создана без столбца "hidden"
+    if "hidden" not in column_names(conn, "breakdowns"):
+        conn.execute("ALTER TABLE breakdowns ADD COLUMN hidden INTEGER DEFAULT 0")
+
+def migrate_order_items(conn: sqlite3.Connection) -> None:
+    """
+    Таблица "order_items" - позиции заказов: каждая позиция экземпляра может быть продана только один раз.
+    Позиции переносятся из JSON-столбца orders.items; обрабатываются только заказы, для которых строк
+    в order_items ещё нет, поэтому повторный запуск безопасен.
+    Названия товаров сопоставляются с items.id в пределах разбивки заказа.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id INTEGER NOT NULL,
+            instance_id INTEGER,
+            item_id INTEGER NOT NULL,
+            price REAL NOT NULL,
+            UNIQUE(instance_id, item_id),
+            FOREIGN KEY(order_id) REFERENCES orders(order_id),
+            FOREIGN KEY(item_id) REFERENCES items(id)
+        )
+    """)
+    orders = conn.execute("""
+        SELECT o.order_id, o.breakdown_name, o.items, o.instance_id
+        FROM orders o
+        WHERE NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.order_id)
+    """).fetchall()
+    migrated = 0
+    for order_id, breakdown_name, items_json, instance_id in orders:
+        try:
+            order_items = json.loads(items_json)
+        except Exception as e:
+            logger.error("❌ Ошибка парсинга JSON заказа #%s: %s", order_id, e)
+            continue
+        for it in order_items:
+            row = conn.execute("SELECT id FROM items WHERE breakdown_name = ? AND item_name = ? LIMIT 1",
+                               (breakdown_name, it.get("name"))).fetchone()
+            if row is None:
+                logger.warning("Товар '%s' заказа #%s не найден в разбивке '%s'", it.get("name"), order_id, breakdown_name)
+                continue
+            cur = conn.execute("INSERT OR IGNORE INTO order_items (order_id, instance_id, item_id, price) VALUES (?, ?, ?, ?)",
+                               (order_id, instance_id, row[0], it.get("price", 0)))
+            migrated += cur.rowcount
+    if migrated:
+        logger.info("Перенесено позиций заказов в order_items: %s", migrated)
+
+def migrate_instance_counters(conn: sqlite3.Connection) -> None:
+    """
+    Добавляет в breakdown_instances счётчики занятых (taken_count) и всех (total_count) позиций
+    и заполняет их по текущим данным.
+    """
+    if {"taken_count", "total_count"} <= column_names(conn, "breakdown_instances"):
+        return
+    conn.execute("ALTER TABLE breakdown_instances ADD COLUMN taken_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE breakdown_instances ADD COLUMN total_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        UPDATE breakdown_instances SET
+            taken_count = (SELECT COUNT(*) FROM order_items oi WHERE oi.instance_id = breakdown_instances.id),
+            total_count = (SELECT COUNT(*) FROM items i WHERE i.breakdown_name = breakdown_instances.breakdown_name)
+    """)
+    logger.info("Счётчики позиций экземпляров разбивок заполнены")
+
+def migrate_outbox(conn: sqlite3.Connection) -> None:
+    """Таблица "outbox" - очередь исходящих уведомлений, ещё не доставленных получателям."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+    """)
+
+def migrate_user_state(conn: sqlite3.Connection) -> None:
+    """Таблица "user_state" - сохранённый context.user_data (выбор товаров, режимы ввода администратора)."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+def migrate_indexes(conn: sqlite3.Connection) -> None:
+    """Индексы под условия частых запросов (заказы пользователя и экземпляра, товары и экземпляры разбивки и т.д.)."""
+    for sql in (
+        "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)",
+        "CREATE INDEX IF NOT EXISTS idx_items_breakdown ON items(breakdown_name)",
+        "CREATE INDEX IF NOT EXISTS idx_instances_breakdown ON breakdown_instances(breakdown_name, status)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_instance ON orders(instance_id)",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)",
+    ):
+        conn.execute(sql)
+    conn.execute("ANALYZE")
+
+def migrate_single_open_instance(conn: sqlite3.Connection) -> None:
+    """
+    Не более одного пустого открытого экземпляра на разбивку (частичный уникальный индекс).
+    Лишние пустые открытые экземпляры без заказов удаляются, остальные дубликаты закрываются.
+    """
+    duplicates = conn.execute("""
+        SELECT id FROM breakdown_instances bi
+        WHERE status = 'open' AND taken_count = 0 AND id > (
+            SELECT MIN(id) FROM breakdown_instances earliest
+            WHERE earliest.breakdown_name = bi.breakdown_name AND earliest.status = 'open' AND earliest.taken_count = 0)
+    """).fetchall()
+    for (instance_id,) in duplicates:
+        if conn.execute("SELECT 1 FROM orders WHERE instance_id = ? LIMIT 1", (instance_id,)).fetchone():
+            conn.execute("UPDATE breakdown_instances SET status = 'complete' WHERE id = ?", (instance_id,))
+        else:
+            conn.execute("DELETE FROM breakdown_instances WHERE id = ?", (instance_id,))
+    if duplicates:
+        logger.info("Убрано лишних пустых открытых экземпляров: %s", len(duplicates))
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_instances_single_empty ON breakdown_instances(breakdown_name)
+        WHERE status = 'open' AND taken_count = 0
+    """)
+
+def migrate_message_archive(conn: sqlite3.Connection) -> None:
+    """
+    Статус сообщений пользователей (handled: 0 - новое, 1 - обработано) и архив "messages_archive",
+    куда фоновая задача переносит сообщения старше срока хранения.
+    Индекс по handled (вместе с rowid) выбирает необработанные сообщения по порядку id без сортировки.
+    """
+    if "handled" not in column_names(conn, "messages"):
+        conn.execute("ALTER TABLE messages ADD COLUMN handled INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME,
+            handled INTEGER NOT NULL,
+            archived_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_handled ON messages(handled)")
+
+def migrate_breakdown_soft_delete(conn: sqlite3.Connection) -> None:
+    """
+    Мягкое удаление разбивок: breakdowns.deleted_at - время удаления (NULL - разбивка активна).
+    Заказы удалённых разбивок фоновая очистка переносит в "orders_archive" (с JSON-снимком позиций),
+    выбирая их по индексу orders(breakdown_name).
+    """
+    if "deleted_at" not in column_names(conn, "breakdowns"):
+        conn.execute("ALTER TABLE breakdowns ADD COLUMN deleted_at REAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS orders_archive (
+            order_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            breakdown_name TEXT NOT NULL,
+            items TEXT,
+            total_amount REAL,
+            instance_id INTEGER,
+            archived_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_breakdown ON orders(breakdown_name)")
+
+# Миграции схемы по порядку: номер версии в PRAGMA user_version равен числу применённых миграций.
+# Новые миграции добавляются только в конец списка. Все миграции идемпотентны, поэтому базы,
+# созданные до появления версий (user_version = 0), проходят их без ошибок.
+MIGRATIONS = [
+    ("исходные таблицы", migrate_base_schema),
+    ("позиции заказов order_items", migrate_order_items),
+    ("счётчики позиций экземпляров", migrate_instance_counters),
+    ("очередь уведомлений outbox", migrate_outbox),
+    ("состояния пользователей user_state", migrate_user_state),
+    ("индексы", migrate_indexes),
+    ("единственный пустой открытый экземпляр", migrate_single_open_instance),
+    ("статус и архив сообщений", migrate_message_archive),
+    ("мягкое удаление разбивок", migrate_breakdown_soft_delete),
+]
+
+def init_db(path: str) -> None:
+    """
+    Приводит схему базы данных к текущей версии.
+    Каждая непримененная миграция выполняется в своей транзакции вместе с обновлением PRAGMA user_version,
+    поэтому прерванный запуск продолжится с той же миграции.
+    Выполняется синхронно один раз при запуске, до старта цикла событий.
+    """
+    started = time.perf_counter()
+    conn = sqlite3.connect(path, isolation_level=None)
+    # Переключаем режим журнала (WAL) для улучшения производительности и надежности
+    conn.execute("PRAGMA journal_mode = WAL")
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        logger.warning("Версия схемы базы (%s) новее версии бота (%s)", version, len(MIGRATIONS))
+    for number, (description, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration_started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        logger.info("Миграция %s (%s) применена за %.3f с", number, description, time.perf_counter() - migration_started)
+    conn.close()
+    logger.info("База данных: версия схемы %s, подготовка заняла %.3f с",
+                max(version, len(MIGRATIONS)), time.perf_counter() - started)
+
+
+def upsert_users(conn: sqlite3.Connection, users: list) -> None:
+    """Сохраняет пачку пользователей (user_id, username); у существующих обновляет изменившийся username."""
+    conn.executemany("""
+        INSERT INTO users (user_id, username) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET username = excluded.username
+        WHERE users.username IS NOT excluded.username
+    """, users)
+
+
+class KnownUsers:
+    """
+    Кэш известных пользователей (LRU) с отложенной пакетной записью в таблицу users.
+    Пользователь, уже сохранённый с тем же username, не вызывает записи в базу.
+    Новые и переименованные пользователи копятся в буфере и сохраняются одной транзакцией:
+    по таймеру раз в flush_interval секунд или сразу при накоплении flush_size записей.
+    """
+
+    def __init__(self, database: Database, capacity: int = 50000, flush_interval: float = 2.0,
+                 flush_size: int = 200) -> None:
+        self._db = database
+        self._capacity = capacity
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._known = OrderedDict()
+        self._pending = {}
+        self._task = None
+        self._flushing = None
+
+    def note(self, user) -> None:
+        """Отмечает пользователя; при необходимости ставит запись в очередь."""
+        username = user.username or "Без имени"
+        if self._known.get(user.id) == username:
+            self._known.move_to_end(user.id)
+            return
+        self._known[user.id] = username
+        self._known.move_to_end(user.id)
+        if len(self._known) > self._capacity:
+            self._known.popitem(last=False)
+        self._pending[user.id] = username
+        if len(self._pending) >= self._flush_size and self._flushing is None:
+            self._flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        """Сохраняет накопленных пользователей одной транзакцией."""
+        try:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await self._db.transaction(upsert_users, list(batch.items()))
+            except Exception as e:
+                logger.error("❌ Ошибка сохранения пользователей: %s", e)
+                # Возвращаем записи в буфер, не затирая более свежие данные
+                for user_id, username in batch.items():
+                    self._pending.setdefault(user_id, username)
+        finally:
+            self._flushing = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает таймер и сохраняет остаток буфера."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+def enqueue_notifications(conn: sqlite3.Connection, messages: list) -> None:
+    """Ставит уведомления (chat_id, text) в очередь outbox для фоновой отправки."""
+    now = time.time()
+    conn.executemany("INSERT INTO outbox (chat_id, text, created_at) VALUES (?, ?, ?)",
+                     [(chat_id, text, now) for chat_id, text in messages])
+
+def settle_outbox(conn: sqlite3.Connection, done: list, retries: list) -> None:
+    """Удаляет из outbox доставленные (и отброшенные) уведомления и переносит повторные попытки на более позднее время."""
+    conn.executemany("DELETE FROM outbox WHERE id = ?", [(outbox_id,) for outbox_id in done])
+    conn.executemany("UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                     [(next_attempt_at, outbox_id) for outbox_id, next_attempt_at in retries])
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты «корзина токенов»: не более rate операций в секунду, всплеск до capacity.
+    pause() полностью останавливает выдачу токенов на заданное время (ответ Telegram RetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        """Корзина полна и никто не ждёт токен - её можно удалить без потери ограничения."""
+        now = time.monotonic()
+        return (not self._lock.locked() and now >= self._paused_until
+                and self._tokens + (now - self._updated) * self.rate >= self.capacity)
+
+
+class Notifier:
+    """
+    Фоновая рассылка уведомлений из таблицы outbox.
+    Обработчики только записывают сообщения в outbox (в той же транзакции, что и изменение данных) и будят рассыльщика,
+    поэтому пользователь не ждёт отправки чужих уведомлений, а неотправленные сообщения переживают перезапуск бота.
+    Отправка идёт параллельно (не более NOTIFY_CONCURRENCY запросов) с общим и поканальным ограничением частоты.
+    В пачку берётся не больше одного сообщения на чат, поэтому поток сообщений в один чат (1 в секунду)
+    не задерживает уведомления остальным; каждое сообщение удаляется из outbox сразу после отправки,
+    и перезапуск посреди пачки не повторяет уже доставленное.
+    RetryAfter приостанавливает всю рассылку на указанное Telegram время, сетевые ошибки повторяются
+    с экспоненциальной задержкой, а сообщения в недоступные чаты (Forbidden, BadRequest) отбрасываются.
+    """
+
+    def __init__(self, database: Database) -> None:
+        self._db = database
+        self._bot = None
+        self._task = None
+        self._wake = None
+        self._stopping = False
+        self._global = None
+        self._chats = {}
+        self._semaphore = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._delay_total = 0.0
+        self._delay_max = 0.0
+
+    def wake(self) -> None:
+        """Сообщает рассыльщику о новых сообщениях в outbox."""
+        if self._wake is not None:
+            self._wake.set()
+
+    def start(self, bot) -> None:
+        # Примитивы asyncio создаются внутри работающего цикла событий
+        self._bot = bot
+        self._wake = asyncio.Event()
+        self._global = TokenBucket(NOTIFY_RATE, NOTIFY_RATE)
+        self._semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Дожидается отправки текущей пачки; недоставленное остаётся в outbox до следующего запуска."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.wake()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Рассылка уведомлений прервана, остаток будет отправлен после перезапуска")
+        self._task = None
+
+    def stats(self) -> dict:
+        """Отправлено, отброшено, повторов и задержка доставки от постановки в outbox (средняя и максимальная, с)."""
+        return {"sent": self.sent, "failed": self.failed, "retried": self.retried,
+                "delay_avg_seconds": round(self._delay_total / (self.sent or 1), 3),
+                "delay_max_seconds": round(self._delay_max, 3)}
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                # Самое раннее готовое к отправке сообщение каждого чата
+                rows = await self._db.fetchall("""
+                    SELECT id, chat_id, text, attempts, created_at FROM outbox WHERE id IN (
+                        SELECT MIN(id) FROM outbox WHERE next_attempt_at <= ? GROUP BY chat_id ORDER BY 1 LIMIT ?
+                    ) ORDER BY id
+                """, (time.time(), NOTIFY_BATCH), label="outbox_batch")
+                if rows:
+                    await self._send_batch(rows)
+                    continue
+                # Очередь пуста или все сообщения ждут повтора: спим до ближайшего срока или до wake()
+                next_at = (await self._db.fetchone("SELECT MIN(next_attempt_at) FROM outbox", label="outbox_next"))[0]
+                timeout = 60.0 if next_at is None else max(next_at - time.time(), 0.05)
+            except Exception as e:
+                logger.error("❌ Ошибка рассылки уведомлений: %s", e)
+                timeout = 5.0
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_batch(self, rows: list) -> None:
+        await asyncio.gather(*(self._deliver_and_settle(row) for row in rows))
+        # Забываем ограничители чатов, в которые давно ничего не отправлялось
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.idle()]:
+            del self._chats[chat_id]
+
+    async def _deliver_and_settle(self, row: tuple) -> None:
+        """Отправляет сообщение и сразу удаляет его из outbox или переносит повтор."""
+        outbox_id, retry_at = await self._deliver(*row)
+        if retry_at is None:
+            await self._db.transaction(settle_outbox, [outbox_id], [])
+        else:
+            await self._db.transaction(settle_outbox, [], [(outbox_id, retry_at)])
+
+    async def _deliver(self, outbox_id: int, chat_id: int, text: str, attempts: int, created_at: float) -> tuple:
+        """Отправляет одно сообщение. Возвращает (id, None), если сообщение больше не нужно, или (id, время повтора)."""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(NOTIFY_CHAT_RATE, 1)
+        # Ждём поканальный токен до занятия слота, чтобы частый чат не блокировал остальных
+        await bucket.acquire()
+        async with self._semaphore:
+            await self._global.acquire()
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                # retry_after - число секунд или timedelta в зависимости от версии библиотеки
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                self._global.pause(delay)
+                self.retried += 1
+                return outbox_id, time.time() + delay
+            except (Forbidden, BadRequest) as e:
+                logger.warning("Уведомление в чат %s отброшено: %s", chat_id, e)
+                self.failed += 1
+                return outbox_id, None
+            except Exception as e:
+                if attempts + 1 >= NOTIFY_MAX_ATTEMPTS:
+                    logger.error("❌ Ошибка отправки уведомления в чат %s, попытки исчерпаны: %s", chat_id, e)
+                    self.failed += 1
+                    return outbox_id, None
+                logger.warning("Ошибка отправки уведомления в чат %s (попытка %s): %s", chat_id, attempts + 1, e)
+                self.retried += 1
+                return outbox_id, time.time() + min(2 ** attempts, 300)
+        delay = time.time() - created_at
+        self.sent += 1
+        self._delay_total += delay
+        self._delay_max = max(self._delay_max, delay)
+        return outbox_id, None
+
+
+# Общий асинхронный доступ к базе данных для всех обработчиков
+db = Database(DB_PATH)
+known_users = KnownUsers(db)
+notifier = Notifier(db)
 
 def save_user(user) -> None:
     """
-    Сохраняет пользователя в таблице users, если его там еще нет.
+    Сохраняет пользователя в таблице users, если его там еще нет, и обновляет изменившийся username.
+    Запись выполняется отложенно и пакетами (см. KnownUsers).
     При отсутствии username используется значение "Без имени".
     """
-    cursor.execute(
-        "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-        (user.id, user.username or "Без имени")
+    known_users.note(user)
+
+class AdminCache:
+    """
+    Множество администраторов из таблицы admins, хранящееся в памяти.
+    Загружается при запуске и перечитывается после добавления или удаления администратора,
+    поэтому проверка прав не обращается к базе данных.
+    """
+
+    def __init__(self, database: Database) -> None:
+        self._db = database
+        self.ids = frozenset()
+
+    async def reload(self) -> None:
+        self.ids = frozenset(r[0] for r in await self._db.fetchall("SELECT user_id FROM admins", label="admin_cache"))
+
+
+admin_cache = AdminCache(db)
+
+
+class CatalogCache:
+    """
+    Кэш каталога с чтением через кэш: список разбивок и товары каждой разбивки.
+    Административные операции изменения каталога вызывают invalidate(), который увеличивает номер версии.
+    Результат запроса, начатого до смены версии, в кэш не попадает, поэтому устаревшие данные не сохраняются.
+    """
+
+    def __init__(self, database: Database) -> None:
+        self._db = database
+        self.version = 0
+        self._breakdowns = None
+        self._items = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def breakdowns(self) -> list:
+        """Все неудалённые разбивки: список (id, name, hidden)."""
+        if self._breakdowns is not None:
+            self.hits += 1
+            return self._breakdowns
+        self.misses += 1
+        version = self.version
+        rows = await self._db.fetchall("SELECT id, name, hidden FROM breakdowns WHERE deleted_at IS NULL ORDER BY id",
+                                       label="catalog_breakdowns")
+        if version == self.version:
+            self._breakdowns = rows
+        return rows
+
+    async def breakdown(self, breakdown_id: int) -> Optional[tuple]:
+        """Разбивка по id: (id, name, hidden) или None."""
+        for row in await self.breakdowns():
+            if row[0] == breakdown_id:
+                return row
+        return None
+
+    async def visible_breakdowns(self) -> list:
+        """Разбивки, где hidden = 0 (не скрыты)."""
+        return [b for b in await self.breakdowns() if not b[2]]
+
+    async def items(self, breakdown_name: str) -> list:
+        """Товары разбивки: список (id, item_name, price)."""
+        items = self._items.get(breakdown_name)
+        if items is not None:
+            self.hits += 1
+            return items
+        self.misses += 1
+        version = self.version
+        rows = await self._db.fetchall("SELECT id, item_name, price FROM items WHERE breakdown_name = ? ORDER BY id",
+                                       (breakdown_name,), label="catalog_items")
+        if version == self.version:
+            self._items[breakdown_name] = rows
+        return rows
+
+    def invalidate(self, breakdown_name: Optional[str] = None) -> None:
+        """
+        Сбрасывает список разбивок и товары указанной разбивки (или всех разбивок) и увеличивает версию каталога.
+        """
+        self.version += 1
+        self._breakdowns = None
+        if breakdown_name is None:
+            self._items.clear()
+        else:
+            self._items.pop(breakdown_name, None)
+
+    def stats(self) -> dict:
+        return {"version": self.version, "hits": self.hits, "misses": self.misses}
+
+
+catalog = CatalogCache(db)
+
+
+# Кодирование callback_data.
+# Команды с параметрами передают целочисленные id строк (разбивки, товара, заказа), а не названия:
+# так данные укладываются в лимит Telegram в 64 байта и не ломаются символом "_" в названиях.
+# Формат: "<версия><маршрут>:<id>:<id>...", id записываются в base36, например "1t:2s".
+CALLBACK_VERSION = "1"
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# Коды маршрутов с параметрами
+CB_BREAKDOWN = "b"           # выбор разбивки покупателем (id разбивки)
+CB_TOGGLE_ITEM = "t"         # отметка товара (id товара)
+CB_SELECT_BREAKDOWN = "sb"   # выбор разбивки для добавления позиции (id разбивки)
+CB_DELETE_BREAKDOWN = "db"   # удаление разбивки (id разбивки)
+CB_HIDE_BREAKDOWN = "hb"     # скрытие разбивки (id разбивки)
+CB_DELETE_ADMIN = "da"       # удаление администратора (id пользователя)
+CB_SELECT_ORDER = "so"       # выбор заказа для удаления позиции (id заказа)
+CB_DELETE_ITEM = "di"        # удаление позиции заказа (id заказа, id товара)
+CB_DELETE_MESSAGE = "dm"     # удаление сообщения (id сообщения)
+CB_MESSAGES = "ms"           # страница сообщений (только необработанные 0/1, курсор - id сообщения, назад 0/1)
+CB_HANDLE_MESSAGE = "hm"     # отметка сообщения обработанным/новым (id сообщения, новое состояние 0/1, затем параметры страницы CB_MESSAGES)
+CB_VIEW_POSITIONS = "vp"     # отчёт по позициям (только открытые 0/1, id разбивки или 0, курсор - id экземпляра и товара, назад 0/1)
+CB_POSITIONS_FILTER = "pf"   # выбор разбивки для отчёта по позициям (фильтры отчёта, со скрытыми 0/1, курсор - id разбивки, назад 0/1)
+CB_FULL_SPLITS = "fs"        # страница отчёта по разбитым наборам (курсор - id экземпляра, назад 0/1)
+CB_USER_CHECKS = "uc"        # страница чеков пользователей (курсор - id пользователя и id заказа, назад 0/1)
+CB_SHOW_USERS = "su"         # страница списка пользователей (курсор - id пользователя, назад 0/1)
+CB_POSITION_ORDERS = "po"    # страница заказов для удаления позиций (курсор - id заказа, назад 0/1)
+CB_EXPORT = "ex"             # выгрузка отчёта в файл (номер выгрузки, формат: 0 - CSV, 1 - XLSX)
+CB_ACCOUNT_PAGE = "ap"       # страница личного кабинета (курсор - id заказа и позиции заказа, назад 0/1)
+
+# Количество id у каждого маршрута с параметрами
+CALLBACK_ARITY = {
+    CALLBACK_VERSION + CB_BREAKDOWN: 1,
+    CALLBACK_VERSION + CB_TOGGLE_ITEM: 1,
+    CALLBACK_VERSION + CB_SELECT_BREAKDOWN: 1,
+    CALLBACK_VERSION + CB_DELETE_BREAKDOWN: 1,
+    CALLBACK_VERSION + CB_HIDE_BREAKDOWN: 1,
+    CALLBACK_VERSION + CB_DELETE_ADMIN: 1,
+    CALLBACK_VERSION + CB_SELECT_ORDER: 1,
+    CALLBACK_VERSION + CB_DELETE_ITEM: 2,
+    CALLBACK_VERSION + CB_DELETE_MESSAGE: 1,
+    CALLBACK_VERSION + CB_MESSAGES: 3,
+    CALLBACK_VERSION + CB_HANDLE_MESSAGE: 5,
+    CALLBACK_VERSION + CB_VIEW_POSITIONS: 5,
+    CALLBACK_VERSION + CB_POSITIONS_FILTER: 5,
+    CALLBACK_VERSION + CB_FULL_SPLITS: 2,
+    CALLBACK_VERSION + CB_USER_CHECKS: 3,
+    CALLBACK_VERSION + CB_SHOW_USERS: 2,
+    CALLBACK_VERSION + CB_POSITION_ORDERS: 2,
+    CALLBACK_VERSION + CB_EXPORT: 2,
+    CALLBACK_VERSION + CB_ACCOUNT_PAGE: 3,
+}
+
+def to_base36(value: int) -> str:
+    if value < 0:
+        raise ValueError("Отрицательные id не поддерживаются")
+    digits = []
+    while True:
+        value, rem = divmod(value, 36)
+        digits.append(BASE36_DIGITS[rem])
+        if not value:
+            return "".join(reversed(digits))
+
+def callback_key(route: str) -> str:
+    """Ключ маршрута в таблице ROUTES для команды с параметрами."""
+    return CALLBACK_VERSION + route
+
+def encode_callback(route: str, *ids: int) -> str:
+    """Кодирует маршрут и id в компактную строку callback_data."""
+    return ":".join((callback_key(route), *(to_base36(i) for i in ids)))
+
+def decode_callback(data: str) -> tuple:
+    """
+    Разбирает callback_data в (ключ маршрута, список id).
+    Для статических команд ("actual_breakdowns" и т.п.) список id пуст.
+    При повреждённых id или неверном их количестве возбуждает ValueError.
+    """
+    key, _, tail = data.partition(":")
+    ids = [int(part, 36) for part in tail.split(":")] if tail else []
+    if len(ids) != CALLBACK_ARITY.get(key, 0):
+        raise ValueError(f"Некорректные данные callback: {data!r}")
+    return key, ids
+
+
+class ItemsKeyboard:
+    """
+    Предрассчитанная клавиатура выбора товаров одной разбивки для одной версии каталога.
+    Для каждого товара заранее созданы две кнопки - обычная и отмеченная галочкой,
+    поэтому выбор пользователя накладывается на клавиатуру без форматирования строк.
+    """
+
+    FOOTER = (
+        (InlineKeyboardButton("✅ Готово", callback_data="finish_selection"),),
+        (InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns"),),
     )
-    conn.commit()
+
+    def __init__(self, items: list) -> None:
+        self.keys = [item_id for item_id, _, _ in items]
+        self.plain = [InlineKeyboardButton(f"{name} - {price} руб.", callback_data=encode_callback(CB_TOGGLE_ITEM, item_id))
+                      for item_id, name, price in items]
+        self.checked = [InlineKeyboardButton(f"✅ {name} - {price} руб.", callback_data=encode_callback(CB_TOGGLE_ITEM, item_id))
+                        for item_id, name, price in items]
+
+    def render(self, selected) -> InlineKeyboardMarkup:
+        rows = [(self.checked[i] if key in selected else self.plain[i],) for i, key in enumerate(self.keys)]
+        return InlineKeyboardMarkup(rows + list(self.FOOTER))
+
+
+class KeyboardRenderer:
+    """Кэш клавиатур выбора товаров по разбивкам; сбрасывается при смене версии каталога."""
+
+    def __init__(self, catalog_cache: CatalogCache) -> None:
+        self._catalog = catalog_cache
+        self._version = catalog_cache.version
+        self._keyboards = {}
+
+    async def items_keyboard(self, breakdown_name: str) -> Optional[ItemsKeyboard]:
+        """Возвращает клавиатуру товаров разбивки или None, если товаров нет."""
+        if self._version != self._catalog.version:
+            self._keyboards.clear()
+            self._version = self._catalog.version
+        keyboard = self._keyboards.get(breakdown_name)
+        if keyboard is None:
+            version = self._catalog.version
+            items = await self._catalog.items(breakdown_name)
+            if not items:
+                return None
+            keyboard = ItemsKeyboard(items)
+            if version == self._catalog.version:
+                self._keyboards[breakdown_name] = keyboard
+        return keyboard
+
+
+renderer = KeyboardRenderer(catalog)
+
+async def edit_if_changed(query, text: str, reply_markup: InlineKeyboardMarkup, parse_mode: Optional[str] = None,
+                          compare: bool = True) -> None:
+    """
+    Редактирует сообщение с кнопками, только если текст или клавиатура действительно изменились.
+    Так не тратится запрос к Telegram API и не возникает ошибка "message is not modified".
+    Для размеченного текста (parse_mode) и при compare=False сравнение не выполняется, остаётся только обработка ошибки.
+    query.message - копия сообщения на момент нажатия: при быстрых повторных нажатиях она может отставать
+    от экрана, поэтому экраны, зависящие от состояния пользователя, передают compare=False.
+    """
+    message = query.message
+    if compare and parse_mode is None and message is not None and message.text == text and message.reply_markup == reply_markup:
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+
+# Ограничение Telegram на длину текста сообщения и размеры страниц отчётов
+MESSAGE_LIMIT = 4096
+REPORT_PAGE_SIZE = 10
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+# До скольких считаются необработанные сообщения в заголовке входящих
+UNHANDLED_COUNT_LIMIT = 1000
+LIST_PAGE_SIZE = 30
+# Кнопок разбивок на одной странице выбора фильтра
+FILTER_PAGE_SIZE = 20
+
+async def fetch_keyset(sql: str, params: tuple, cursor: tuple, backward: bool, limit: int,
+                       descending: bool = False, label: Optional[str] = None) -> tuple:
+    """
+    Читает одну страницу по ключу (keyset-пагинация): строки с ключом больше cursor или, при backward, меньше его.
+    При descending ключ убывает от страницы к странице (новые записи первыми), и сравнения меняются местами.
+    cursor - кортеж значений ключа; нулевой курсор означает первую страницу.
+    sql содержит условие "{cmp} ?" на ключ (последние параметры перед LIMIT) и "ORDER BY ключ {order} LIMIT ?".
+    Возвращает (строки в порядке вывода, есть предыдущая страница, есть следующая страница).
+    Запрос замеряется под меткой label, по умолчанию - "<вызывающая функция>:page".
+    """
+    label = label or f"{sys._getframe(1).f_code.co_name}:page"
+    first_page = not any(cursor)
+    if descending and first_page:
+        # Первая страница убывающего списка начинается с наибольшего возможного ключа
+        cursor = (SQLITE_MAX_INTEGER,) * len(cursor)
+    smaller = backward != descending
+    rows = await db.fetchall(sql.format(cmp="<" if smaller else ">", order="DESC" if smaller else "ASC"),
+                             params + cursor + (limit + 1,), label=label)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return rows, more, True
+    return rows, not first_page, more
+
+def fit_page(keys: list, blocks: list, backward: bool, has_prev: bool, has_next: bool) -> tuple:
+    """
+    Оставляет столько блоков текста страницы, сколько помещается в одно сообщение (с запасом под заголовок и разметку).
+    Отбрасываются блоки, дальние от курсора: они попадут на следующую (или, при backward, предыдущую) страницу.
+    Ближайший к курсору блок выводится всегда (при необходимости обрезается в page_text).
+    Возвращает (ключи, блоки, есть предыдущая страница, есть следующая страница).
+    """
+    order = range(len(blocks) - 1, -1, -1) if backward else range(len(blocks))
+    size = 0
+    count = 0
+    for index in order:
+        size += len(blocks[index]) + 1
+        if size > MESSAGE_LIMIT - 200 and count:
+            break
+        count += 1
+    if count == len(blocks):
+        return keys, blocks, has_prev, has_next
+    if backward:
+        return keys[-count:], blocks[-count:], True, has_next
+    return keys[:count], blocks[:count], has_prev, True
+
+def page_text(blocks: list, limit: int = MESSAGE_LIMIT - 200) -> str:
+    text = "\n".join(blocks)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def page_buttons(route: str, prefix: tuple, first_key: tuple, last_key: tuple, has_prev: bool, has_next: bool) -> list:
+    """Строка кнопок "назад/вперёд" для страницы с ключами first_key..last_key."""
+    row = []
+    if has_prev:
+        row.append(InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback(route, *prefix, *first_key, 1)))
+    if has_next:
+        row.append(InlineKeyboardButton("Вперёд ➡️", callback_data=encode_callback(route, *prefix, *last_key, 0)))
+    return [row] if row else []
 
 def is_admin(user_id: int) -> bool:
     """
-    Проверяет, является ли пользователь администратором.
-    Если user_id равен заданному числу (жестко закодированному), возвращает True.
-    Иначе выполняет запрос в таблицу admins.
-    Сюда можно добавить перманентного администратора.
+    Проверяет, является ли пользователь администратором.
+    Перманентные администраторы задаются в SUPER_ADMIN_IDS, остальные берутся из кэша таблицы admins.
+    """
+    return user_id in SUPER_ADMIN_IDS or user_id in admin_cache.ids
+
+# Маршруты, доступные только администраторам
+ADMIN_ROUTES = frozenset({
+    "admin_panel", "breakdowns_menu", "add_breakdown", "add_item", "delete_breakdown_menu", "hide_breakdown_menu",
+    "instance_users_menu", "view_full_splits", "view_all_positions", "view_user_checks", "delete_position_menu",
+    "admin_management", "add_admin", "delete_admin_menu", "show_admins", "show_users", "view_messages",
+    callback_key(CB_SELECT_BREAKDOWN), callback_key(CB_DELETE_BREAKDOWN), callback_key(CB_HIDE_BREAKDOWN),
+    callback_key(CB_DELETE_ADMIN), callback_key(CB_SELECT_ORDER), callback_key(CB_DELETE_ITEM),
+    callback_key(CB_DELETE_MESSAGE), callback_key(CB_MESSAGES), callback_key(CB_HANDLE_MESSAGE),
+    callback_key(CB_VIEW_POSITIONS), callback_key(CB_POSITIONS_FILTER), callback_key(CB_FULL_SPLITS),
+    callback_key(CB_USER_CHECKS), callback_key(CB_SHOW_USERS), callback_key(CB_POSITION_ORDERS),
+    "export_menu", callback_key(CB_EXPORT), "metrics", "purge_status",
+})
+
+# Флаги ожидания ввода, которые выставляются только из административных меню
+ADMIN_INPUT_FLAGS = ("awaiting_breakdown_name", "awaiting_item_name", "awaiting_item_price", "awaiting_admin")
+
+# Функции ниже выполняются в потоке-писателе через db.transaction и получают соединение первым аргументом.
+
+@dataclass
+class Reservation:
+    """Результат резервирования позиций: заказ, экземпляр, занятые позиции и список конфликтов."""
+    instance_id: Optional[int]
+    order_id: Optional[int] = None
+    items: list = field(default_factory=list)
+    total: float = 0.0
+    conflicts: list = field(default_factory=list)
+    completed: bool = False
+    # Разбивка удалена, пока пользователь выбирал позиции
+    unavailable: bool = False
+
+def reserve_items(conn: sqlite3.Connection, user_id: int, username: str, breakdown_name: str, item_ids) -> Reservation:
+    """
+    Атомарно резервирует выбранные позиции разбивки за пользователем.
+    Проверка доступности, создание заказа и перевод экземпляра в 'complete' выполняются в одной
+    транзакции писателя (BEGIN IMMEDIATE), поэтому два одновременных заказа не могут получить одну позицию.
+    Если хотя бы одна позиция уже занята, ничего не сохраняется, а занятые позиции возвращаются в conflicts.
+    """
+    # Удалённая разбивка недоступна для заказа сразу, даже если её данные ещё не очищены
+    if conn.execute("SELECT 1 FROM breakdowns WHERE name = ? AND deleted_at IS NULL", (breakdown_name,)).fetchone() is None:
+        return Reservation(instance_id=None, unavailable=True)
+    # Обеспечиваем, что пользователь есть в таблице users (запись из KnownUsers могла ещё не сохраниться)
+    conn.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
+    items_details = []
+    total = 0.0
+    # Получаем id и цену каждого выбранного товара и суммируем итоговую стоимость
+    catalog = {item_id: (name, price) for item_id, name, price in
+               conn.execute("SELECT id, item_name, price FROM items WHERE breakdown_name = ?", (breakdown_name,))}
+    for item_id in sorted(item_ids):
+        if item_id in catalog:
+            item_name, price = catalog[item_id]
+            total += price
+            items_details.append({"id": item_id, "name": item_name, "price": price})
+
+    instance_id = instances.open_instance(conn, breakdown_name)
+    # Проверяем, не заняты ли позиции другими пользователями (поиск по индексу order_items)
+    item_ids = [it["id"] for it in items_details]
+    placeholders = ",".join("?" * len(item_ids))
+    conflicts = [r[0] for r in conn.execute(
+        f"SELECT i.item_name FROM order_items oi JOIN items i ON i.id = oi.item_id "
+        f"WHERE oi.instance_id = ? AND oi.item_id IN ({placeholders})",
+        (instance_id, *item_ids))]
+    if conflicts:
+        return Reservation(instance_id=instance_id, conflicts=conflicts)
+
+    order_id = insert_order(conn, user_id, breakdown_name, items_details, total, instance_id)
+    account_pages.touch([user_id])
+    # Сравниваем счётчики занятых и всех позиций экземпляра (поддерживаются при каждом изменении заказов).
+    # Условие status = 'open' гарантирует, что экземпляр переводится в 'complete' ровно один раз.
+    taken_count, total_count = conn.execute("SELECT taken_count, total_count FROM breakdown_instances WHERE id = ?",
+                                            (instance_id,)).fetchone()
+    completed = False
+    if taken_count >= total_count:
+        completed = conn.execute("UPDATE breakdown_instances SET status = 'complete' WHERE id = ? AND status = 'open'",
+                                 (instance_id,)).rowcount == 1
+    if completed:
+        instances.completed(breakdown_name, instance_id)
+        # Статус экземпляра показывается в личном кабинете всех его участников
+        account_pages.touch(instance_users(conn, instance_id))
+        # Уведомления участникам попадают в outbox в той же транзакции и не теряются при сбое отправки
+        enqueue_notifications(conn, completion_notifications(conn, breakdown_name, instance_id))
+    return Reservation(instance_id=instance_id, order_id=order_id, items=items_details, total=total, completed=completed)
+
+def completion_notifications(conn: sqlite3.Connection, breakdown_name: str, instance_id: int) -> list:
+    """Формирует уведомления «Сет разбит» (chat_id, text) для всех заказов экземпляра."""
+    messages = []
+    for user_id, items_json, order_total in conn.execute(
+            "SELECT user_id, items, total_amount FROM orders WHERE instance_id = ?", (instance_id,)):
+        try:
+            order_items = json.loads(items_json)
+            items_text = "\n".join([f"▪ {it['name']} - {it['price']} руб." for it in order_items])
+        except Exception as e:
+            logger.error("❌ Ошибка парсинга JSON: %s", e)
+            items_text = "🚫 Ошибка отображения"
+        messages.append((user_id, (
+            f"✅ Сет разбит!\nРазбивка: {breakdown_name}\nЭкземпляр: {instance_id}\n\n"
+            f"Ваш заказ:\n{items_text}\nСумма: {order_total} руб."
+        )))
+    return messages
+
+def store_message(conn: sqlite3.Connection, user_id: int, username: str, text: str, notifications: list) -> None:
+    """Сохраняет сообщение пользователя и ставит в очередь уведомления администраторам."""
+    conn.execute("INSERT INTO messages (user_id, message) VALUES (?, ?)", (user_id, text))
+    # Обеспечиваем, что отправитель есть в таблице users (запись из KnownUsers могла ещё не сохраниться)
+    conn.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
+    enqueue_notifications(conn, notifications)
+
+def archive_messages(conn: sqlite3.Connection, retention_days: int, batch: int) -> int:
+    """
+    Переносит в messages_archive не более batch самых старых сообщений старше retention_days дней
+    (выборка по индексу idx_messages_timestamp). Возвращает число перенесённых сообщений.
+    """
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM messages WHERE timestamp < datetime('now', ?) ORDER BY timestamp LIMIT ?",
+        (f"-{retention_days} days", batch))]
+    if not ids:
+        return 0
+    placeholders = ",".join("?" * len(ids))
+    conn.execute(f"""
+        INSERT INTO messages_archive (id, user_id, message, timestamp, handled, archived_at)
+        SELECT id, user_id, message, timestamp, handled, ? FROM messages WHERE id IN ({placeholders})
+    """, (time.time(), *ids))
+    conn.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", ids)
+    return len(ids)
+
+class MessageArchiver:
+    """
+    Фоновый перенос старых сообщений пользователей в архив, чтобы рабочая таблица messages оставалась небольшой.
+    Раз в interval секунд сообщения старше retention_days дней переносятся короткими транзакциями по batch строк
+    с паузой между ними, поэтому обработчики не ждут поток-писатель дольше одной пачки.
+    """
+
+    def __init__(self, database: Database, retention_days: int, batch: int = MESSAGE_ARCHIVE_BATCH,
+                 interval: float = MESSAGE_ARCHIVE_INTERVAL) -> None:
+        self._db = database
+        self._retention_days = retention_days
+        self._batch = batch
+        self._interval = interval
+        self._task = None
+        self.archived = 0
+
+    async def archive(self) -> int:
+        """Переносит все сообщения старше срока хранения; возвращает их число."""
+        moved = 0
+        while True:
+            count = await self._db.transaction(archive_messages, self._retention_days, self._batch)
+            moved += count
+            if count < self._batch:
+                break
+            await asyncio.sleep(MESSAGE_ARCHIVE_PAUSE)
+        if moved:
+            self.archived += moved
+            logger.info("Перенесено в архив сообщений: %s", moved)
+        return moved
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.archive()
+            except Exception as e:
+                logger.error("❌ Ошибка архивации сообщений: %s", e)
+            await asyncio.sleep(self._interval)
+
+    def start(self) -> None:
+        if self._retention_days > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+message_archiver = MessageArchiver(db, MESSAGE_RETENTION_DAYS)
+
+class BreakdownPurger:
+    """
+    Фоновая очистка удалённых разбивок.
+    Удаление в боте мягкое (breakdowns.deleted_at) и действует сразу, а заказы, экземпляры и товары разбивки
+    удаляются короткими транзакциями purge_breakdown_batch с паузой между ними, поэтому оформление заказов
+    не ждёт поток-писатель дольше одной пачки. Заказы сохраняются в orders_archive.
+    Состояние очистки - сами помеченные разбивки, поэтому прерванная очистка продолжается после перезапуска.
+    """
+
+    def __init__(self, database: Database, batch: int = PURGE_BATCH) -> None:
+        self._db = database
+        self._batch = batch
+        self._task = None
+        self._wake = None
+        # Ход текущей очистки: название разбивки -> [перенесено заказов, всего заказов]
+        self.progress = {}
+
+    def wake(self) -> None:
+        """Сообщает об удалённой разбивке, которую нужно очистить."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def purge(self, breakdown_name: str) -> int:
+        """Очищает одну удалённую разбивку; возвращает число перенесённых в архив заказов."""
+        total = (await self._db.fetchone("SELECT COUNT(*) FROM orders WHERE breakdown_name = ?", (breakdown_name,),
+                                         label="purge_count"))[0]
+        progress = self.progress[breakdown_name] = [0, total]
+        logger.info("🗑 Очистка разбивки '%s': заказов для переноса в архив %s", breakdown_name, total)
+        started = last_report = time.monotonic()
+        try:
+            while True:
+                archived, done = await self._db.transaction(purge_breakdown_batch, breakdown_name, self._batch)
+                progress[0] += archived
+                if done:
+                    break
+                if time.monotonic() - last_report > 10:
+                    last_report = time.monotonic()
+                    logger.info("🗑 Очистка разбивки '%s': %s из %s заказов", breakdown_name, *progress)
+                await asyncio.sleep(PURGE_PAUSE)
+        finally:
+            del self.progress[breakdown_name]
+        logger.info("✅ Разбивка '%s' очищена: заказов в архиве %s, %.1f с", breakdown_name, progress[0],
+                    time.monotonic() - started)
+        return progress[0]
+
+    async def purge_pending(self) -> None:
+        """Очищает все помеченные удалёнными разбивки в порядке удаления."""
+        for (breakdown_name,) in await self._db.fetchall(
+                "SELECT name FROM breakdowns WHERE deleted_at IS NOT NULL ORDER BY deleted_at"):
+            await self.purge(breakdown_name)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            try:
+                await self.purge_pending()
+            except Exception as e:
+                logger.error("❌ Ошибка очистки удалённых разбивок: %s", e)
+                # Повторяем позже: помеченные разбивки остаются в базе
+                await asyncio.sleep(60)
+                self._wake.set()
+
+    def start(self) -> None:
+        # Сразу продолжаем очистку, прерванную остановкой бота
+        self._wake = asyncio.Event()
+        self._wake.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+breakdown_purger = BreakdownPurger(db)
+
+class InstanceManager:
+    """
+    Текущий открытый экземпляр каждой разбивки, хранящийся в памяти.
+    Используется только внутри транзакций потока-писателя, поэтому обращения к нему последовательны.
+    Если открытых экземпляров несколько (после удаления позиции в завершённом экземпляре он снова открывается),
+    заполняется экземпляр с меньшим id. Новый экземпляр создаётся, только когда открытых не осталось;
+    частичный уникальный индекс idx_instances_single_empty не допускает двух пустых открытых экземпляров разбивки.
+    При откате транзакции кэш сбрасывается целиком, так как мог запомнить несохранённый экземпляр.
+    """
+
+    def __init__(self, database: Database) -> None:
+        self._open = {}
+        database.on_rollback(self.clear)
+
+    def open_instance(self, conn: sqlite3.Connection, breakdown_name: str) -> int:
+        """Возвращает id открытого экземпляра разбивки, при его отсутствии создаёт новый."""
+        instance_id = self._open.get(breakdown_name)
+        if instance_id is not None:
+            return instance_id
+        row = conn.execute("SELECT id FROM breakdown_instances WHERE breakdown_name = ? AND status = 'open' "
+                           "ORDER BY id LIMIT 1", (breakdown_name,)).fetchone()
+        if row:
+            instance_id = row[0]
+        else:
+            instance_id = conn.execute("""
+                INSERT INTO breakdown_instances (breakdown_name, status, total_count)
+                VALUES (?, 'open', (SELECT COUNT(*) FROM items WHERE breakdown_name = ?))
+            """, (breakdown_name, breakdown_name)).lastrowid
+        self._open[breakdown_name] = instance_id
+        return instance_id
+
+    def completed(self, breakdown_name: str, instance_id: int) -> None:
+        """Экземпляр заполнен: следующий заказ возьмёт другой открытый экземпляр или создаст новый."""
+        if self._open.get(breakdown_name) == instance_id:
+            del self._open[breakdown_name]
+
+    def invalidate(self, breakdown_name: str) -> None:
+        """Экземпляры разбивки изменились (повторное открытие, удаление): следующий заказ перечитает их из базы."""
+        self._open.pop(breakdown_name, None)
+
+    def clear(self) -> None:
+        self._open.clear()
+
+instances = InstanceManager(db)
+
+class AccountPages:
+    """
+    Кэш отрисованных страниц личного кабинета по пользователям (LRU).
+    Функции потока-писателя отмечают пользователей, чьи заказы изменились (touch); после фиксации транзакции
+    версия этих пользователей увеличивается, и их страницы перестают считаться актуальными.
+    Страница сохраняется с версией, прочитанной до запроса к базе, поэтому устаревшие данные не попадут в кэш.
+    """
+
+    def __init__(self, database: Database, capacity: int = 10000) -> None:
+        self._capacity = capacity
+        self._pages = OrderedDict()
+        self._versions = {}
+        self._touched = set()
+        self.hits = 0
+        self.misses = 0
+        database.on_commit(self._apply)
+        database.on_rollback(self._touched.clear)
+
+    def touch(self, user_ids) -> None:
+        """Вызывается внутри транзакции писателя: заказы этих пользователей изменились."""
+        self._touched.update(user_ids)
+
+    def _apply(self) -> None:
+        for user_id in self._touched:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        self._touched.clear()
+
+    def version(self, user_id: int) -> int:
+        return self._versions.get(user_id, 0)
+
+    def get(self, user_id: int, page: tuple) -> Optional[tuple]:
+        entry = self._pages.get(user_id)
+        if entry is not None and entry[0] == self.version(user_id) and page in entry[1]:
+            self._pages.move_to_end(user_id)
+            self.hits += 1
+            return entry[1][page]
+        self.misses += 1
+        return None
+
+    def put(self, user_id: int, version: int, page: tuple, rendered: tuple) -> None:
+        if version != self.version(user_id):
+            return
+        entry = self._pages.get(user_id)
+        if entry is None or entry[0] != version:
+            entry = self._pages[user_id] = (version, {})
+        entry[1][page] = rendered
+        self._pages.move_to_end(user_id)
+        if len(self._pages) > self._capacity:
+            self._pages.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "users": len(self._pages)}
+
+account_pages = AccountPages(db)
+
+def instance_users(conn: sqlite3.Connection, instance_id: int) -> list:
+    return [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM orders WHERE instance_id = ?", (instance_id,))]
+
+def insert_order(conn: sqlite3.Connection, user_id: int, breakdown_name: str, items_details: list,
+                 total: float, instance_id: int) -> int:
+    """
+    Сохраняет заказ в таблице orders и его позиции в order_items.
+    В orders.items хранится JSON-снимок позиций (название и цена на момент покупки) для отображения.
+    """
+    items_json = json.dumps([{"name": it["name"], "price": it["price"]} for it in items_details], ensure_ascii=False)
+    order_id = conn.execute("INSERT INTO orders (user_id, breakdown_name, items, total_amount, instance_id) VALUES (?, ?, ?, ?, ?)",
+                            (user_id, breakdown_name, items_json, total, instance_id)).lastrowid
+    conn.executemany("INSERT INTO order_items (order_id, instance_id, item_id, price) VALUES (?, ?, ?, ?)",
+                     [(order_id, instance_id, it["id"], it["price"]) for it in items_details])
+    conn.execute("UPDATE breakdown_instances SET taken_count = taken_count + ? WHERE id = ?",
+                 (len(items_details), instance_id))
+    return order_id
+
+def add_item(conn: sqlite3.Connection, breakdown_name: str, item_name: str, price: float) -> int:
+    """Добавляет товар в разбивку и увеличивает число позиций всех её экземпляров."""
+    item_id = conn.execute("INSERT INTO items (breakdown_name, item_name, price) VALUES (?, ?, ?)",
+                           (breakdown_name, item_name, price)).lastrowid
+    conn.execute("UPDATE breakdown_instances SET total_count = total_count + 1 WHERE breakdown_name = ?",
+                 (breakdown_name,))
+    return item_id
+
+def add_items(conn: sqlite3.Connection, breakdown_name: str, items: list) -> tuple:
+    """
+    Добавляет пачку товаров (название, цена) в разбивку одним executemany и увеличивает число позиций её экземпляров.
+    Товары, название которых уже есть в разбивке, пропускаются.
+    Возвращает (число добавленных, список пропущенных названий).
+    """
+    existing = {row[0].casefold() for row in
+                conn.execute("SELECT item_name FROM items WHERE breakdown_name = ?", (breakdown_name,))}
+    new_items = [(name, price) for name, price in items if name.casefold() not in existing]
+    skipped = [name for name, price in items if name.casefold() in existing]
+    conn.executemany("INSERT INTO items (breakdown_name, item_name, price) VALUES (?, ?, ?)",
+                     [(breakdown_name, name, price) for name, price in new_items])
+    conn.execute("UPDATE breakdown_instances SET total_count = total_count + ? WHERE breakdown_name = ?",
+                 (len(new_items), breakdown_name))
+    return len(new_items), skipped
+
+def soft_delete_breakdown(conn: sqlite3.Connection, breakdown_name: str) -> None:
+    """
+    Помечает разбивку удалённой: она сразу пропадает из каталога и недоступна для заказа.
+    Заказы, экземпляры и товары разбивки удаляет фоновая очистка (BreakdownPurger).
+    """
+    conn.execute("UPDATE breakdowns SET deleted_at = ? WHERE name = ? AND deleted_at IS NULL", (time.time(), breakdown_name))
+    instances.invalidate(breakdown_name)
+
+def purge_breakdown_batch(conn: sqlite3.Connection, breakdown_name: str, batch: int) -> tuple:
+    """
+    Один шаг очистки удалённой разбивки (не более batch строк):
+    сначала заказы переносятся в orders_archive вместе с удалением их позиций, затем удаляются экземпляры
+    и товары, и последним шагом - сама разбивка.
+    Возвращает (перенесено заказов, очистка завершена).
+    """
+    ids = [row[0] for row in conn.execute("SELECT order_id FROM orders WHERE breakdown_name = ? LIMIT ?",
+                                          (breakdown_name, batch))]
+    if ids:
+        placeholders = ",".join("?" * len(ids))
+        account_pages.touch([row[0] for row in conn.execute(
+            f"SELECT DISTINCT user_id FROM orders WHERE order_id IN ({placeholders})", ids)])
+        conn.execute(f"""
+            INSERT INTO orders_archive (order_id, user_id, breakdown_name, items, total_amount, instance_id, archived_at)
+            SELECT order_id, user_id, breakdown_name, items, total_amount, instance_id, ?
+            FROM orders WHERE order_id IN ({placeholders})
+        """, (time.time(), *ids))
+        conn.execute(f"DELETE FROM order_items WHERE order_id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM orders WHERE order_id IN ({placeholders})", ids)
+        return len(ids), False
+    for table in ("breakdown_instances", "items"):
+        if conn.execute(f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE breakdown_name = ? LIMIT ?)",
+                        (breakdown_name, batch)).rowcount:
+            return 0, False
+    conn.execute("DELETE FROM breakdowns WHERE name = ? AND deleted_at IS NOT NULL", (breakdown_name,))
+    instances.invalidate(breakdown_name)
+    return 0, True
+
+def remove_order_item(conn: sqlite3.Connection, order_id: int, item_id: int) -> Optional[tuple]:
+    """
+    Удаляет позицию item_id из заказа: строку order_items и запись в JSON-снимке orders.items.
+    Пустой заказ удаляется целиком. Экземпляр разбивки заказа снова становится открытым.
+    Возвращает (название товара, новый итог, заказ удалён) или None, если такой позиции в заказе нет.
+    """
+    order = conn.execute("SELECT items, total_amount, instance_id, breakdown_name FROM orders WHERE order_id = ?",
+                         (order_id,)).fetchone()
+    row = conn.execute("""
+        SELECT oi.rowid, oi.price, i.item_name FROM order_items oi JOIN items i ON i.id = oi.item_id
+        WHERE oi.order_id = ? AND oi.item_id = ?
+    """, (order_id, item_id)).fetchone()
+    if order is None or row is None:
+        return None
+    items_json, total_amount, instance_id, breakdown_name = order
+    rowid, price, item_name = row
+    # Экземпляр снова открывается: меняется личный кабинет всех его участников
+    account_pages.touch(instance_users(conn, instance_id) if instance_id is not None else
+                        [r[0] for r in conn.execute("SELECT user_id FROM orders WHERE order_id = ?", (order_id,))])
+    removed = conn.execute("DELETE FROM order_items WHERE rowid = ?", (rowid,)).rowcount
+    try:
+        items_list = json.loads(items_json)
+    except Exception as e:
+        logger.error("❌ Ошибка парсинга JSON: %s", e)
+        items_list = []
+    # Исключаем из снимка первую позицию с названием удаляемого товара
+    new_items = []
+    found = False
+    for item in items_list:
+        if not found and item.get("name") == item_name:
+            found = True
+        else:
+            new_items.append(item)
+    new_total = total_amount - price
+    if not new_items:
+        removed += conn.execute("DELETE FROM order_items WHERE order_id = ?", (order_id,)).rowcount
+        conn.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
+    else:
+        conn.execute("UPDATE orders SET items = ?, total_amount = ? WHERE order_id = ?",
+                     (json.dumps(new_items, ensure_ascii=False), new_total, order_id))
+    if instance_id is not None:
+        try:
+            conn.execute("UPDATE breakdown_instances SET status = 'open', taken_count = taken_count - ? WHERE id = ?",
+                         (removed, instance_id))
+        except sqlite3.IntegrityError:
+            # Экземпляр опустел, а у разбивки уже есть пустой открытый экземпляр: этот больше не нужен
+            conn.execute("DELETE FROM breakdown_instances WHERE id = ?", (instance_id,))
+        instances.invalidate(breakdown_name)
+    return item_name, new_total, not new_items
+
+# Выгрузки для администраторов: название, заголовок таблицы и запрос.
+# Строки читаются курсором порциями и сразу пишутся в файл, поэтому память не зависит от размера таблиц.
+EXPORTS = {
+    "instances": ("Позиции экземпляров",
+                  ["Экземпляр", "Разбивка", "Статус", "Позиция", "Цена", "Заказ", "ID пользователя", "Пользователь"], """
+        SELECT bi.id, bi.breakdown_name, bi.status, i.item_name, i.price, o.order_id, o.user_id, u.username
+        FROM breakdown_instances bi
+        JOIN items i ON i.breakdown_name = bi.breakdown_name
+        LEFT JOIN order_items oi ON oi.instance_id = bi.id AND oi.item_id = i.id
+        LEFT JOIN orders o ON o.order_id = oi.order_id
+        LEFT JOIN users u ON u.user_id = o.user_id
+        ORDER BY bi.id, i.id
+    """),
+    "orders": ("Позиции заказов",
+               ["Заказ", "Экземпляр", "Разбивка", "ID пользователя", "Пользователь", "Позиция", "Цена"], """
+        SELECT o.order_id, o.instance_id, o.breakdown_name, o.user_id, u.username, i.item_name, oi.price
+        FROM order_items oi
+        JOIN orders o ON o.order_id = oi.order_id
+        LEFT JOIN items i ON i.id = oi.item_id
+        LEFT JOIN users u ON u.user_id = o.user_id
+        ORDER BY oi.order_id
+    """),
+    "checks": ("Чеки пользователей",
+               ["ID пользователя", "Пользователь", "Заказ", "Разбивка", "Экземпляр", "Статус", "Позиций", "Сумма"], """
+        SELECT o.user_id, u.username, o.order_id, o.breakdown_name, o.instance_id, bi.status,
+               (SELECT COUNT(*) FROM order_items oi WHERE oi.order_id = o.order_id), o.total_amount
+        FROM orders o
+        LEFT JOIN users u ON u.user_id = o.user_id
+        LEFT JOIN breakdown_instances bi ON bi.id = o.instance_id
+        ORDER BY o.user_id, o.order_id
+    """),
+    "messages": ("Сообщения ТаоБао", ["ID", "ID пользователя", "Пользователь", "Время", "Сообщение"], """
+        -- В архиве только сообщения старше оставшихся в messages, поэтому строки идут по возрастанию id
+        SELECT m.id, m.user_id, u.username, m.timestamp, m.message
+        FROM messages_archive m
+        LEFT JOIN users u ON u.user_id = m.user_id
+        UNION ALL
+        SELECT m.id, m.user_id, u.username, m.timestamp, m.message
+        FROM messages m
+        LEFT JOIN users u ON u.user_id = m.user_id
+    """),
+    "archive": ("Архив заказов удалённых разбивок",
+                ["Заказ", "Экземпляр", "Разбивка", "ID пользователя", "Пользователь", "Позиции (JSON)", "Сумма"], """
+        SELECT a.order_id, a.instance_id, a.breakdown_name, a.user_id, u.username, a.items, a.total_amount
+        FROM orders_archive a
+        LEFT JOIN users u ON u.user_id = a.user_id
+        ORDER BY a.order_id
+    """),
+}
+EXPORT_KINDS = list(EXPORTS)
+EXPORT_FORMATS = ["csv", "xlsx"]
+# Больше этого размера файл упаковывается в zip (лимит Telegram на отправку документа ботом - 50 МБ)
+EXPORT_ZIP_BYTES = 45 * 1024 * 1024
+
+def iter_rows(cursor: sqlite3.Cursor, size: int = 1000):
+    """Генератор строк результата запроса, читаемых порциями по size."""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+def write_export(conn: sqlite3.Connection, kind: str, fmt: str) -> str:
+    """
+    Записывает выгрузку kind во временный файл формата fmt (csv или xlsx) и возвращает путь к нему.
+    Выполняется в потоке чтения через db.read; удалить файл после отправки должен вызывающий.
     """
-    if user_id == 1244636103:
-        return True
-    cursor.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,))
-    return cursor.fetchone() is not None
+    _, header, sql = EXPORTS[kind]
+    rows = iter_rows(conn.execute(sql))
+    fd, path = tempfile.mkstemp(prefix=f"{kind}_", suffix=f".{fmt}")
+    if fmt == "xlsx":
+        os.close(fd)
+        # write_only-книга пишет строки на диск по мере добавления
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(EXPORTS[kind][0][:31])
+        sheet.append(header)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(path)
+    else:
+        # utf-8-sig и ";" - чтобы файл сразу открывался в Excel с русской локалью
+        with open(fd, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(header)
+            writer.writerows(rows)
+    if os.path.getsize(path) > EXPORT_ZIP_BYTES:
+        zip_path = path + ".zip"
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.write(path, arcname=f"{kind}.{fmt}")
+        os.remove(path)
+        path = zip_path
+    return path
+
+async def send_export(bot, chat_id: int, kind: str, fmt: str) -> None:
+    """Формирует выгрузку и отправляет её документом; временный файл удаляется в любом случае."""
+    started = time.perf_counter()
+    path = await db.read(write_export, kind, fmt)
+    try:
+        filename = f"{kind}_{time.strftime('%Y%m%d_%H%M')}.{fmt}" + (".zip" if path.endswith(".zip") else "")
+        with open(path, "rb") as f:
+            await bot.send_document(chat_id=chat_id, document=f, filename=filename, caption=f"📤 {EXPORTS[kind][0]}")
+        logger.info("Выгрузка %s.%s (%s байт) за %.2f с", kind, fmt, os.path.getsize(path), time.perf_counter() - started)
+    finally:
+        os.remove(path)
+
+def export_keyboard() -> InlineKeyboardMarkup:
+    """Кнопки выгрузок: для каждой - CSV и, если установлен openpyxl, XLSX."""
+    keyboard = []
+    for kind_index, kind in enumerate(EXPORT_KINDS):
+        row = [InlineKeyboardButton(f"{EXPORTS[kind][0]} (CSV)", callback_data=encode_callback(CB_EXPORT, kind_index, 0))]
+        if Workbook is not None:
+            row.append(InlineKeyboardButton("XLSX", callback_data=encode_callback(CB_EXPORT, kind_index, 1)))
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(keyboard)
 
 # Функция start - обрабатывает команду /start и выводит главное меню.
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -123,695 +1771,963 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         keyboard.append([InlineKeyboardButton("⚙️ Администрирование", callback_data="admin_panel")])
     await update.message.reply_text("Привет! Выберите опцию:", reply_markup=InlineKeyboardMarkup(keyboard))
 
-# Функция button - обработчик нажатий на inline-кнопки.
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    # Сохраняем данные пользователя, инициировавшего CallbackQuery
-    save_user(query.from_user)
-    # Отправляем ответ, чтобы убрать "часики" на кнопке
-    await query.answer()
-    data = query.data
-    logger.info("Callback data: %s", data)
-
-    # Обработка запроса на показ актуальных разбивок
-    if data == "actual_breakdowns":
-        # Извлекаем все разбивки, где hidden = 0 (не скрыты)
-        cursor.execute("SELECT name FROM breakdowns WHERE hidden = 0")
-        breakdowns = cursor.fetchall()
-        if breakdowns:
-            # Формируем клавиатуру с кнопками для каждой разбивки
-            keyboard = [[InlineKeyboardButton(b[0], callback_data=f"breakdown_{b[0]}")] for b in breakdowns]
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
-            await query.edit_message_text("Выберите разбивку:", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-            await query.edit_message_text("🚫 Нет доступных разбивок.", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Обработка выбора конкретной разбивки
-    elif data.startswith("breakdown_"):
-        # Извлекаем название разбивки из данных callback
-        breakdown_name = data.split("_", 1)[1]
-        context.user_data["current_breakdown"] = breakdown_name
-        # Получаем товары для выбранной разбивки
-        cursor.execute("SELECT item_name, price FROM items WHERE breakdown_name=?", (breakdown_name,))
-        items = cursor.fetchall()
-        if items:
-            # Инициализируем множество выбранных товаров
-            context.user_data["selected_items"] = set()
-            # Формируем кнопки для выбора товаров. Если товар выбран, перед именем ставится галочка.
-            keyboard = [
-                [InlineKeyboardButton(
-                    f"{'✅ ' if i[0] in context.user_data.get('selected_items', set()) else ''}{i[0]} - {i[1]} руб.",
-                    callback_data=f"toggle_item_{i[0]}"
-                )] for i in items
-            ]
-            keyboard.append([InlineKeyboardButton("✅ Готово", callback_data="finish_selection")])
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")])
-            await query.edit_message_text("Выберите товары:", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")]]
-            await query.edit_message_text("🚫 В этой разбивке пока нет товаров.", reply_markup=InlineKeyboardMarkup(keyboard))
+# Обработка запроса на показ актуальных разбивок
+async def on_actual_breakdowns(query, context, args: list) -> None:
+    # Берём из кэша каталога все разбивки, где hidden = 0 (не скрыты)
+    breakdowns = await catalog.visible_breakdowns()
+    if breakdowns:
+        # Формируем клавиатуру с кнопками для каждой разбивки
+        keyboard = [[InlineKeyboardButton(name, callback_data=encode_callback(CB_BREAKDOWN, breakdown_id))]
+                    for breakdown_id, name, _ in breakdowns]
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")])
+        await query.edit_message_text("Выберите разбивку:", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
+        await query.edit_message_text("🚫 Нет доступных разбивок.", reply_markup=InlineKeyboardMarkup(keyboard))
 
-    # Переключение выбора товара (добавление/удаление из выбранных)
-    elif data.startswith("toggle_item_"):
-        item_name = data.split("_", 2)[2]
-        if item_name in context.user_data.get("selected_items", set()):
-            context.user_data["selected_items"].remove(item_name)
-        else:
-            context.user_data["selected_items"].add(item_name)
-        # Обновляем меню товаров с учётом изменений в выборе
-        await show_items_menu(query, context)
-
-    # Завершение выбора товаров и оформление заказа
-    elif data == "finish_selection":
-        if context.user_data.get("selected_items"):
-            selected_items = context.user_data["selected_items"]
-            breakdown_name = context.user_data["current_breakdown"]
-            user_id = query.from_user.id
-
-            # Обеспечиваем, что пользователь есть в таблице users
-            cursor.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-                           (user_id, query.from_user.username or "Без имени"))
-
-            items_details = []
-            total = 0.0
-            # Обрабатываем каждый выбранный товар: получаем цену и суммируем итоговую стоимость
-            for item_name in selected_items:
-                cursor.execute("SELECT price FROM items WHERE breakdown_name = ? AND item_name = ?",
-                               (breakdown_name, item_name))
-                result = cursor.fetchone()
-                if result:
-                    price = result[0]
-                    total += price
-                    items_details.append({"name": item_name, "price": price})
-            # Преобразуем детали заказа в JSON для хранения
-            items_json = json.dumps(items_details, ensure_ascii=False)
-            # Проверяем наличие открытого экземпляра разбивки
-            cursor.execute("SELECT id FROM breakdown_instances WHERE breakdown_name = ? AND status = 'open' LIMIT 1",
-                           (breakdown_name,))
-            row = cursor.fetchone()
-            if row:
-                instance_id = row[0]
-            else:
-                # Если открытого экземпляра нет, создаём новый
-                cursor.execute("INSERT INTO breakdown_instances (breakdown_name, status) VALUES (?, 'open')",
-                               (breakdown_name,))
-                instance_id = cursor.lastrowid
-            conn.commit()
-
-            # Проверяем, не были ли уже выбраны данные товары другими пользователями
-            unavailable = []
-            for item_name in selected_items:
-                cursor.execute("SELECT COUNT(*) FROM orders WHERE instance_id = ? AND breakdown_name = ? AND items LIKE ?",
-                               (instance_id, breakdown_name, f'%"{item_name}"%'))
-                if cursor.fetchone()[0] > 0:
-                    unavailable.append(item_name)
-            if unavailable:
-                message_text = f"❌ Товары {', '.join(unavailable)} уже выбраны. Обновите выбор."
-                keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")]]
-                await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
-                context.user_data.pop("selected_items", None)
-                return
+# Обработка выбора конкретной разбивки
+async def on_breakdown(query, context, args: list) -> None:
+    # Находим разбивку по id из данных callback
+    breakdown = await catalog.breakdown(args[0])
+    if breakdown is None:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")]]
+        await query.edit_message_text("🚫 Разбивка не найдена.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    context.user_data["current_breakdown"] = breakdown[1]
+    # Инициализируем множество выбранных товаров и показываем меню товаров разбивки
+    context.user_data["selected_items"] = set()
+    await show_items_menu(query, context)
 
-            # Сохраняем заказ в таблице orders
-            cursor.execute("INSERT INTO orders (user_id, breakdown_name, items, total_amount, instance_id) VALUES (?, ?, ?, ?, ?)",
-                           (user_id, breakdown_name, items_json, total, instance_id))
-            conn.commit()
-
-            # Получаем все товары разбивки и собираем список уже занятых позиций
-            cursor.execute("SELECT item_name FROM items WHERE breakdown_name = ?", (breakdown_name,))
-            all_items = {r[0] for r in cursor.fetchall()}
-            cursor.execute("SELECT items FROM orders WHERE instance_id = ?", (instance_id,))
-            taken_items = set()
-            for order in cursor.fetchall():
-                try:
-                    for it in json.loads(order[0]):
-                        taken_items.add(it['name'])
-                except Exception as e:
-                    logger.error("❌ Ошибка парсинга JSON: %s", e)
-            # Если все позиции разбивки заняты, обновляем статус экземпляра на 'complete'
-            if all_items == taken_items:
-                cursor.execute("UPDATE breakdown_instances SET status = 'complete' WHERE id = ?", (instance_id,))
-                conn.commit()
-                # Отправляем уведомление всем пользователям, сделавшим заказ в этом экземпляре
-                cursor.execute("SELECT user_id, items, total_amount FROM orders WHERE instance_id = ?", (instance_id,))
-                orders_details = cursor.fetchall()
-                for user_id, items_json, order_total in orders_details:
-                    try:
-                        order_items = json.loads(items_json)
-                        items_text = "\n".join([f"▪ {it['name']} - {it['price']} руб." for it in order_items])
-                    except Exception as e:
-                        logger.error("❌ Ошибка парсинга JSON: %s", e)
-                        items_text = "🚫 Ошибка отображения"
-                    notification_message = (
-                        f"✅ Сет разбит!\nРазбивка: {breakdown_name}\nЭкземпляр: {instance_id}\n\n"
-                        f"Ваш заказ:\n{items_text}\nСумма: {order_total} руб."
-                    )
-                    try:
-                        await context.bot.send_message(chat_id=user_id, text=notification_message)
-                    except Exception as e:
-                        logger.error("❌ Ошибка отправки уведомления пользователю %s: %s", user_id, e)
-
-            # Формируем сообщение с деталями заказа для пользователя
-            items_list = "\n".join([f"  - {item['name']}: {item['price']} руб." for item in items_details])
-            message_text = (
-                f"✅ Вы выбрали в разбивке '{breakdown_name}':\n{items_list}\n💰 Общая сумма: {total} руб.\nЭкземпляр: {instance_id}"
-            )
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-            await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
-            # Очищаем выбранные товары из пользовательских данных
-            context.user_data.pop("selected_items", None)
-        else:
-            # Если ни один товар не выбран, выводим соответствующее сообщение
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-            await query.edit_message_text("🚫 Вы не выбрали ни одного товара.", reply_markup=InlineKeyboardMarkup(keyboard))
+# Переключение выбора товара (добавление/удаление из выбранных)
+async def on_toggle_item(query, context, args: list) -> None:
+    item_id = args[0]
+    selected_items = context.user_data.setdefault("selected_items", set())
+    if item_id in selected_items:
+        selected_items.remove(item_id)
+    else:
+        selected_items.add(item_id)
+    # Обновляем меню товаров с учётом изменений в выборе
+    await show_items_menu(query, context)
 
-    # Обработка запроса "Личный Кабинет"
-    elif data == "personal_account":
+# Завершение выбора товаров и оформление заказа
+async def on_finish_selection(query, context, args: list) -> None:
+    if context.user_data.get("selected_items"):
+        selected_items = context.user_data["selected_items"]
+        breakdown_name = context.user_data["current_breakdown"]
         user_id = query.from_user.id
-        # Получаем заказы пользователя из таблицы orders
-        cursor.execute("SELECT breakdown_name, items, total_amount, instance_id FROM orders WHERE user_id = ?", (user_id,))
-        orders = cursor.fetchall()
-        if not orders:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-            await query.edit_message_text("🚫 У вас нет активных заказов.", reply_markup=InlineKeyboardMarkup(keyboard))
+
+        # Резервируем все выбранные позиции одной транзакцией: либо все, либо ни одной
+        reservation = await db.transaction(reserve_items, user_id, query.from_user.username or "Без имени",
+                                           breakdown_name, list(selected_items))
+        if reservation.unavailable:
+            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")]]
+            await query.edit_message_text("🚫 Разбивка больше недоступна.", reply_markup=InlineKeyboardMarkup(keyboard))
+            context.user_data.pop("selected_items", None)
             return
-        total_all = 0.0
-        message_lines = ["📁 Ваши заказы:\n"]
-        # Формируем список заказов с деталями каждого заказа
-        for breakdown_name, items_json, total, instance_id in orders:
-            line = f"🔹 Разбивка: {breakdown_name}"
-            if instance_id:
-                cursor.execute("SELECT status FROM breakdown_instances WHERE id = ?", (instance_id,))
-                status = cursor.fetchone()
-                if status and status[0] == "complete":
-                    line += " (✅Сет разбит)"
-            message_lines.append(line)
-            try:
-                items = json.loads(items_json)
-                for item in items:
-                    message_lines.append(f"    ▪ {item['name']} - {item['price']} руб.")
-            except:
-                message_lines.append("    (🚫 ошибка отображения товаров)")
-            message_lines.append(f"    Итого: {total} руб.\n")
-            total_all += total
-        message_lines.append(f"💳 Общая сумма: {total_all} руб.")
+        instance_id = reservation.instance_id
+        items_details = reservation.items
+        total = reservation.total
+        if reservation.conflicts:
+            message_text = f"❌ Товары {', '.join(reservation.conflicts)} уже выбраны. Обновите выбор."
+            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")]]
+            await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
+            context.user_data.pop("selected_items", None)
+            return
+
+        # Если заказ занял последние позиции, экземпляр уже переведён в 'complete' в той же транзакции,
+        # а уведомления участникам поставлены в очередь - рассыльщик отправит их в фоне
+        if reservation.completed:
+            notifier.wake()
+
+        # Формируем сообщение с деталями заказа для пользователя
+        items_list = "\n".join([f"  - {item['name']}: {item['price']} руб." for item in items_details])
+        message_text = (
+            f"✅ Вы выбрали в разбивке '{breakdown_name}':\n{items_list}\n💰 Общая сумма: {total} руб.\nЭкземпляр: {instance_id}"
+        )
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-        await query.edit_message_text("\n".join(message_lines), reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Обработка административного меню
-    elif data == "admin_panel":
-        keyboard = [
-            [InlineKeyboardButton("📂 Разбивки", callback_data="breakdowns_menu")],
-            [InlineKeyboardButton("💬 Последние Сообщения", callback_data="view_messages")],
-            [InlineKeyboardButton("📊 Отчет", callback_data="instance_users_menu")],
-            [InlineKeyboardButton("👤 Управление администраторами", callback_data="admin_management")],
-            [InlineKeyboardButton("👥 Показать Пользователей", callback_data="show_users")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        await query.edit_message_text("⚙️ Администрирование:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Меню управления разбивками (добавление, скрытие, удаление)
-    elif data == "breakdowns_menu":
-        keyboard = [
-            [InlineKeyboardButton("➕ Добавить Разбивку", callback_data="add_breakdown")],
-            [InlineKeyboardButton("➕ Добавить Позицию", callback_data="add_item")],
-            [InlineKeyboardButton("🙈 Скрыть Разбивку", callback_data="hide_breakdown_menu")],
-            [InlineKeyboardButton("❌ Удалить Разбивку", callback_data="delete_breakdown_menu")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
-        ]
-        await query.edit_message_text("📂 Разбивки:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Запрос на добавление новой разбивки:
-    elif data == "add_breakdown":
-        await query.edit_message_text("➕ Введите название разбивки:")
-        # Флаг, сигнализирующий, что бот ожидает ввод названия новой разбивки
-        context.user_data["awaiting_breakdown_name"] = True
-
-    # Запрос на добавление нового товара:
-    elif data == "add_item":
-        # Извлекаем все доступные (не скрытые) разбивки
-        cursor.execute("SELECT name FROM breakdowns WHERE hidden = 0")
-        breakdowns = cursor.fetchall()
-        if breakdowns:
-            keyboard = [[InlineKeyboardButton(b[0], callback_data=f"select_breakdown_{b[0]}")] for b in breakdowns]
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")])
-            await query.edit_message_text("➕ Выберите разбивку для добавления позиции:", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
-            await query.edit_message_text("🚫 Нет доступных разбивок.", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Выбор разбивки для добавления товара:
-    elif data.startswith("select_breakdown_"):
-        breakdown_name = data.split("_", 2)[2]
-        context.user_data["breakdown_name"] = breakdown_name
-        await query.edit_message_text("➕ Введите название товара:")
-        # Флаг, сигнализирующий, что бот ожидает ввод названия товара
-        context.user_data["awaiting_item_name"] = True
-
-    # Меню удаления разбивок:
-    elif data == "delete_breakdown_menu":
-        cursor.execute("SELECT name, hidden FROM breakdowns")
-        breakdowns = cursor.fetchall()
-        if breakdowns:
-            keyboard = []
-            for name, hidden in breakdowns:
-                # Отмечаем, если разбивка уже скрыта
-                button_text = f"❌ Удалить {'(скрытая) ' if hidden else ''}{name}"
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"delete_breakdown_{name}")])
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")])
-            await query.edit_message_text("❌ Выберите разбивку для удаления:", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
-            await query.edit_message_text("🚫 Нет доступных разбивок для удаления.", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Удаление выбранной разбивки и связанных с ней данных:
-    elif data.startswith("delete_breakdown_"):
-        breakdown_name = data.split("delete_breakdown_", 1)[1]
-        cursor.execute("DELETE FROM breakdowns WHERE name = ?", (breakdown_name,))
-        cursor.execute("DELETE FROM items WHERE breakdown_name = ?", (breakdown_name,))
-        cursor.execute("DELETE FROM orders WHERE breakdown_name = ?", (breakdown_name,))
-        cursor.execute("DELETE FROM breakdown_instances WHERE breakdown_name = ?", (breakdown_name,))
-        conn.commit()
-        await query.edit_message_text(f"✅ Разбивка '{breakdown_name}' и связанные данные удалены.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]))
-
-    # Меню скрытия разбивок:
-    elif data == "hide_breakdown_menu":
-        cursor.execute("SELECT name FROM breakdowns WHERE hidden = 0")
-        breakdowns = cursor.fetchall()
-        if breakdowns:
-            keyboard = [[InlineKeyboardButton(f"🙈 Скрыть {b[0]}", callback_data=f"hide_breakdown_{b[0]}")] for b in breakdowns]
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")])
-            await query.edit_message_text("🙈 Выберите разбивку для скрытия:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
+        # Очищаем выбранные товары из пользовательских данных
+        context.user_data.pop("selected_items", None)
+    else:
+        # Если ни один товар не выбран, выводим соответствующее сообщение
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
+        await query.edit_message_text("🚫 Вы не выбрали ни одного товара.", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Обработка запроса "Личный Кабинет"
+async def on_personal_account(query, context, args: list) -> None:
+    user_id = query.from_user.id
+    order_cursor, item_cursor, backward = args if args else (0, 0, 0)
+    page = (order_cursor, item_cursor, backward)
+    rendered = account_pages.get(user_id, page)
+    if rendered is None:
+        version = account_pages.version(user_id)
+        rendered = await render_account_page(user_id, (order_cursor, item_cursor), backward)
+        account_pages.put(user_id, version, page, rendered)
+    text, reply_markup = rendered
+    await edit_if_changed(query, text, reply_markup)
+
+async def render_account_page(user_id: int, cursor: tuple, backward: int) -> tuple:
+    """
+    Страница личного кабинета: итоги по всем заказам пользователя и одна страница позиций его заказов.
+    Курсор - пара (id заказа, rowid позиции в order_items), поэтому большой заказ делится на несколько страниц.
+    """
+    # Итоги считаются одним агрегирующим запросом по индексу orders(user_id)
+    order_count, total_all, complete_count = await db.fetchone("""
+        SELECT COUNT(*), COALESCE(SUM(o.total_amount), 0), COALESCE(SUM(bi.status = 'complete'), 0)
+        FROM orders o LEFT JOIN breakdown_instances bi ON bi.id = o.instance_id
+        WHERE o.user_id = ?
+    """, (user_id,))
+    back = [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+    if not order_count:
+        return "🚫 У вас нет активных заказов.", InlineKeyboardMarkup([back])
+    # Позиции заказов - из order_items, без разбора JSON; first/last - первая и последняя позиция заказа
+    rows, has_prev, has_next = await fetch_keyset("""
+        SELECT o.order_id, COALESCE(oi.rowid, 0) AS position, o.breakdown_name, o.total_amount, bi.status,
+               i.item_name, oi.price,
+               (SELECT MIN(rowid) FROM order_items WHERE order_id = o.order_id) AS first,
+               (SELECT MAX(rowid) FROM order_items WHERE order_id = o.order_id) AS last
+        FROM orders o
+        LEFT JOIN breakdown_instances bi ON bi.id = o.instance_id
+        LEFT JOIN order_items oi ON oi.order_id = o.order_id
+        LEFT JOIN items i ON i.id = oi.item_id
+        WHERE o.user_id = ? AND (o.order_id, position) {cmp} (?, ?)
+        ORDER BY o.order_id {order}, position {order} LIMIT ?
+    """, (user_id,), cursor, backward, LIST_PAGE_SIZE)
+    keyboard = []
+    blocks = []
+    def header(breakdown_name: str, status: Optional[str]) -> str:
+        return f"🔹 Разбивка: {breakdown_name}" + (" (✅Сет разбит)" if status == "complete" else "")
+
+    if rows:
+        keys = []
+        # Заголовок разбивки перед первой позицией заказа, итог после последней
+        for order_id, position, breakdown_name, total, status, item_name, price, first, last in rows:
+            lines = []
+            if position == (first or 0):
+                lines.append(header(breakdown_name, status))
+            if item_name is not None:
+                lines.append(f"    ▪ {item_name} - {price} руб.")
+            if position == (last or 0):
+                lines.append(f"    Итого: {total} руб.\n")
+            keys.append((order_id, position))
+            blocks.append("\n".join(lines))
+        keys, blocks, has_prev, has_next = fit_page(keys, blocks, backward, has_prev, has_next)
+        # Если страница начинается с середины заказа, повторяем заголовок
+        if not blocks[0].startswith("🔹"):
+            breakdown_name, status = next((row[2], row[4]) for row in rows if row[:2] == keys[0])
+            blocks[0] = f"{header(breakdown_name, status)} (продолжение)\n{blocks[0]}"
+        keyboard += page_buttons(CB_ACCOUNT_PAGE, (), keys[0], keys[-1], has_prev, has_next)
+    keyboard.append(back)
+    text = "\n".join([
+        "📁 Ваши заказы:",
+        f"Заказов: {order_count} (✅ разбито: {complete_count}, ⏳ в сборе: {order_count - complete_count})\n",
+        page_text(blocks),
+        f"💳 Общая сумма: {total_all} руб.",
+    ])
+    return text, InlineKeyboardMarkup(keyboard)
+
+# Обработка административного меню
+async def on_admin_panel(query, context, args: list) -> None:
+    keyboard = [
+        [InlineKeyboardButton("📂 Разбивки", callback_data="breakdowns_menu")],
+        [InlineKeyboardButton("💬 Последние Сообщения", callback_data="view_messages")],
+        [InlineKeyboardButton("📊 Отчет", callback_data="instance_users_menu")],
+        [InlineKeyboardButton("👤 Управление администраторами", callback_data="admin_management")],
+        [InlineKeyboardButton("👥 Показать Пользователей", callback_data="show_users")],
+        [InlineKeyboardButton("📤 Выгрузка в файл", callback_data="export_menu")],
+        [InlineKeyboardButton("📈 Метрики", callback_data="metrics")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+    ]
+    await query.edit_message_text("⚙️ Администрирование:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Меню выгрузок отчётов в файл
+async def on_export_menu(query, context, args: list) -> None:
+    await edit_if_changed(query, "📤 Выберите выгрузку:", export_keyboard())
+
+# Задержки обработчиков, запросов к базе и вызовов Bot API (самые затратные по суммарному времени)
+async def on_metrics(query, context, args: list) -> None:
+    blocks = [f"📈 Метрики (перцентили по последним {METRICS_WINDOW} замерам):"]
+    for group in METRIC_GROUPS:
+        blocks.append(f"\n{group.title}:\n" + (group.summary(limit=8) or "нет данных"))
+    blocks.append("\n" + "\n".join(f"{group.title}: {group.summary()}" for group in COUNTER_GROUPS))
+    keyboard = [
+        [InlineKeyboardButton("🔄 Обновить", callback_data="metrics")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    await edit_if_changed(query, page_text(blocks), InlineKeyboardMarkup(keyboard))
+
+# Формирование и отправка выбранной выгрузки
+async def on_export(query, context, args: list) -> None:
+    kind_index, fmt_index = args
+    if kind_index >= len(EXPORT_KINDS) or fmt_index >= len(EXPORT_FORMATS) or (fmt_index == 1 and Workbook is None):
+        await on_unknown(query, context, args)
+        return
+    kind = EXPORT_KINDS[kind_index]
+    await query.edit_message_text(f"⏳ Формирую выгрузку «{EXPORTS[kind][0]}»...")
+    try:
+        await send_export(context.bot, query.message.chat_id, kind, EXPORT_FORMATS[fmt_index])
+        text = "✅ Файл отправлен. Выберите выгрузку:"
+    except Exception as e:
+        logger.error("❌ Ошибка выгрузки %s: %s", kind, e)
+        text = "❌ Ошибка выгрузки. Выберите выгрузку:"
+    await query.edit_message_text(text, reply_markup=export_keyboard())
+
+# Команда /export [instances|orders|checks|messages|archive] [csv|xlsx] - выгрузка для администраторов
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    save_user(update.message.from_user)
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("🚫 Недостаточно прав.")
+        return
+    if not context.args:
+        await update.message.reply_text("📤 Выберите выгрузку:", reply_markup=export_keyboard())
+        return
+    kind = context.args[0].lower()
+    fmt = context.args[1].lower() if len(context.args) > 1 else "csv"
+    if kind not in EXPORTS or fmt not in EXPORT_FORMATS or (fmt == "xlsx" and Workbook is None):
+        formats = "csv|xlsx" if Workbook is not None else "csv"
+        await update.message.reply_text(f"❌ Использование: /export [{'|'.join(EXPORT_KINDS)}] [{formats}]")
+        return
+    try:
+        await send_export(context.bot, update.message.chat_id, kind, fmt)
+    except Exception as e:
+        logger.error("❌ Ошибка выгрузки %s: %s", kind, e)
+        await update.message.reply_text("❌ Ошибка выгрузки")
+
+# Меню управления разбивками (добавление, скрытие, удаление)
+async def on_breakdowns_menu(query, context, args: list) -> None:
+    keyboard = [
+        [InlineKeyboardButton("➕ Добавить Разбивку", callback_data="add_breakdown")],
+        [InlineKeyboardButton("➕ Добавить Позицию", callback_data="add_item")],
+        [InlineKeyboardButton("🙈 Скрыть Разбивку", callback_data="hide_breakdown_menu")],
+        [InlineKeyboardButton("❌ Удалить Разбивку", callback_data="delete_breakdown_menu")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    await query.edit_message_text("📂 Разбивки:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Запрос на добавление новой разбивки:
+async def on_add_breakdown(query, context, args: list) -> None:
+    await query.edit_message_text("➕ Введите название разбивки:")
+    # Флаг, сигнализирующий, что бот ожидает ввод названия новой разбивки
+    context.user_data["awaiting_breakdown_name"] = True
+
+# Запрос на добавление нового товара:
+async def on_add_item(query, context, args: list) -> None:
+    # Извлекаем все доступные (не скрытые) разбивки
+    breakdowns = await catalog.visible_breakdowns()
+    if breakdowns:
+        keyboard = [[InlineKeyboardButton(name, callback_data=encode_callback(CB_SELECT_BREAKDOWN, breakdown_id))]
+                    for breakdown_id, name, _ in breakdowns]
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")])
+        await query.edit_message_text("➕ Выберите разбивку для добавления позиции:", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
+        await query.edit_message_text("🚫 Нет доступных разбивок.", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Выбор разбивки для добавления товара:
+async def on_select_breakdown(query, context, args: list) -> None:
+    breakdown = await catalog.breakdown(args[0])
+    if breakdown is None:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="add_item")]]
+        await query.edit_message_text("🚫 Разбивка не найдена.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    breakdown_name = breakdown[1]
+    context.user_data["breakdown_name"] = breakdown_name
+    await query.edit_message_text("➕ Введите название товара.\n\n"
+                                  "Можно добавить сразу несколько позиций: отправьте список строк вида "
+                                  "«название;цена» сообщением или файлом .csv/.txt.")
+    # Флаг, сигнализирующий, что бот ожидает ввод названия товара (или списка позиций)
+    context.user_data["awaiting_item_name"] = True
+
+# Меню удаления разбивок:
+async def on_delete_breakdown_menu(query, context, args: list) -> None:
+    breakdowns = await catalog.breakdowns()
+    if breakdowns:
+        keyboard = []
+        for breakdown_id, name, hidden in breakdowns:
+            # Отмечаем, если разбивка уже скрыта
+            button_text = f"❌ Удалить {'(скрытая) ' if hidden else ''}{name}"
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=encode_callback(CB_DELETE_BREAKDOWN, breakdown_id))])
+        keyboard.append([InlineKeyboardButton("⏳ Ход очистки удалённых", callback_data="purge_status")])
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")])
+        await query.edit_message_text("❌ Выберите разбивку для удаления:", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
+        await query.edit_message_text("🚫 Нет доступных разбивок для удаления.", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Удаление выбранной разбивки и связанных с ней данных:
+async def on_delete_breakdown(query, context, args: list) -> None:
+    breakdown = await catalog.breakdown(args[0])
+    if breakdown is None:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="delete_breakdown_menu")]]
+        await query.edit_message_text("🚫 Разбивка не найдена.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    breakdown_name = breakdown[1]
+    # Разбивка пропадает из каталога сразу, а её заказы переносятся в архив в фоне
+    await db.transaction(soft_delete_breakdown, breakdown_name)
+    catalog.invalidate(breakdown_name)
+    breakdown_purger.wake()
+    keyboard = [
+        [InlineKeyboardButton("⏳ Ход очистки", callback_data="purge_status")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]
+    ]
+    await query.edit_message_text(f"✅ Разбивка '{breakdown_name}' удалена. Её заказы переносятся в архив в фоне.",
+                                  reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Ход фоновой очистки удалённых разбивок:
+async def on_purge_status(query, context, args: list) -> None:
+    pending = await db.fetchall("SELECT name FROM breakdowns WHERE deleted_at IS NOT NULL ORDER BY deleted_at")
+    lines = []
+    for (breakdown_name,) in pending:
+        progress = breakdown_purger.progress.get(breakdown_name)
+        if progress is None:
+            lines.append(f"🕒 '{breakdown_name}': ожидает очистки")
         else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
-            await query.edit_message_text("🚫 Нет доступных разбивок для скрытия.", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Выполнение скрытия выбранной разбивки:
-    elif data.startswith("hide_breakdown_"):
-        breakdown_name = data[len("hide_breakdown_"):]
-        cursor.execute("UPDATE breakdowns SET hidden = 1 WHERE name = ?", (breakdown_name,))
-        conn.commit()
-        await query.edit_message_text(f"✅ Разбивка '{breakdown_name}' скрыта.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]))
-
-    # Меню отчетов по экземплярам разбивок:
-    elif data == "instance_users_menu":
-        keyboard = [
-            [InlineKeyboardButton("📈 Разбитые разбивки", callback_data="view_full_splits")],
-            [InlineKeyboardButton("📋 Все позиции пользователей", callback_data="view_all_positions")],
-            [InlineKeyboardButton("🧾 Чек пользователей", callback_data="view_user_checks")],
-            [InlineKeyboardButton("❌ Удалить позицию пользователя", callback_data="delete_position_menu")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
-        ]
-        await query.edit_message_text("📊 Отчет:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Отчет по полностью разбитым наборам:
-    elif data == "view_full_splits":
-        cursor.execute("""
-            SELECT bi.id, bi.breakdown_name, bi.status, o.items, u.username
-            FROM breakdown_instances bi
-            JOIN orders o ON bi.id = o.instance_id
+            lines.append(f"⏳ '{breakdown_name}': заказов в архиве {progress[0]} из {progress[1]}")
+    text = "🗑 Очистка удалённых разбивок:\n\n" + "\n".join(lines) if lines else "✅ Нет разбивок, ожидающих очистки."
+    keyboard = [
+        [InlineKeyboardButton("🔄 Обновить", callback_data="purge_status")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]
+    ]
+    await edit_if_changed(query, page_text([text]), InlineKeyboardMarkup(keyboard))
+
+# Меню скрытия разбивок:
+async def on_hide_breakdown_menu(query, context, args: list) -> None:
+    breakdowns = await catalog.visible_breakdowns()
+    if breakdowns:
+        keyboard = [[InlineKeyboardButton(f"🙈 Скрыть {name}", callback_data=encode_callback(CB_HIDE_BREAKDOWN, breakdown_id))]
+                    for breakdown_id, name, _ in breakdowns]
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")])
+        await query.edit_message_text("🙈 Выберите разбивку для скрытия:", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
+        await query.edit_message_text("🚫 Нет доступных разбивок для скрытия.", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Выполнение скрытия выбранной разбивки:
+async def on_hide_breakdown(query, context, args: list) -> None:
+    breakdown = await catalog.breakdown(args[0])
+    if breakdown is None:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="hide_breakdown_menu")]]
+        await query.edit_message_text("🚫 Разбивка не найдена.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    breakdown_name = breakdown[1]
+    await db.execute("UPDATE breakdowns SET hidden = 1 WHERE id = ?", (args[0],))
+    catalog.invalidate()
+    await query.edit_message_text(f"✅ Разбивка '{breakdown_name}' скрыта.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]))
+
+# Меню отчетов по экземплярам разбивок:
+async def on_instance_users_menu(query, context, args: list) -> None:
+    keyboard = [
+        [InlineKeyboardButton("📈 Разбитые разбивки", callback_data="view_full_splits")],
+        [InlineKeyboardButton("📋 Все позиции пользователей", callback_data="view_all_positions")],
+        [InlineKeyboardButton("🧾 Чек пользователей", callback_data="view_user_checks")],
+        [InlineKeyboardButton("❌ Удалить позицию пользователя", callback_data="delete_position_menu")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    await query.edit_message_text("📊 Отчет:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Отчет по полностью разбитым наборам:
+async def on_view_full_splits(query, context, args: list) -> None:
+    cursor, backward = args if args else (0, 0)
+    # Страница разбитых экземпляров, затем заказы только этих экземпляров
+    instances, has_prev, has_next = await fetch_keyset(
+        "SELECT id, breakdown_name, status FROM breakdown_instances WHERE status = 'complete' AND id {cmp} ? "
+        "ORDER BY id {order} LIMIT ?", (), (cursor,), backward, REPORT_PAGE_SIZE)
+    keyboard = []
+    if instances:
+        ids = [row[0] for row in instances]
+        grouped = defaultdict(list)
+        for instance_id, items_json, username in await db.fetchall(f"""
+            SELECT o.instance_id, o.items, u.username
+            FROM orders o
             JOIN users u ON o.user_id = u.user_id
-            WHERE bi.status = 'complete'
-        """)
-        rows = cursor.fetchall()
-        if rows:
-            grouped = defaultdict(list)
-            instance_info = {}
-            # Группируем заказы по экземпляру разбивки
-            for instance_id, breakdown_name, status, items_json, username in rows:
-                grouped[instance_id].append((username, items_json))
-                instance_info[instance_id] = (breakdown_name, status)
-            text_lines = []
-            # Формируем текст отчета для каждого экземпляра
-            for instance_id in sorted(grouped.keys()):
-                breakdown_name, status = instance_info[instance_id]
-                text_lines.append(f"Экземпляр: {instance_id}\nРазбивка: {breakdown_name} (Статус: {status})")
-                for username, items_json in grouped[instance_id]:
-                    try:
-                        order_items = json.loads(items_json)
-                        items_text = ", ".join([f"{it['name']} - {it['price']} руб." for it in order_items])
-                    except Exception as e:
-                        logger.error("❌ Ошибка парсинга JSON: %s", e)
-                        items_text = "🚫 Ошибка отображения"
-                    text_lines.append(f"Заказ от @{username}: {items_text}")
-                text_lines.append("-" * 40)
-            text = "\n".join(text_lines)
-        else:
-            text = "🚫 Нет разбивок, где все позиции заняты."
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")]]
-        await query.edit_message_text(text=f"<pre>{text}</pre>", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Отчет по всем позициям товаров для каждого экземпляра:
-    elif data == "view_all_positions":
-        cursor.execute("SELECT id, breakdown_name FROM breakdown_instances")
-        instances = cursor.fetchall()
-        all_rows = []
-        # Для каждого экземпляра получаем товары разбивки и статусы позиций (занято/свободно)
-        for instance_id, breakdown_name in instances:
-            cursor.execute("SELECT item_name, price FROM items WHERE breakdown_name = ?", (breakdown_name,))
-            items_list = cursor.fetchall()
-            cursor.execute("SELECT o.user_id, o.items FROM orders o WHERE o.instance_id = ?", (instance_id,))
-            orders = cursor.fetchall()
-            taken = {}
-            # Определяем, какие товары уже взяты, и кем
-            for user_id, items_json in orders:
+            WHERE o.instance_id IN ({",".join("?" * len(ids))})
+            ORDER BY o.order_id
+        """, tuple(ids)):
+            grouped[instance_id].append((username, items_json))
+        blocks = []
+        # Формируем текст отчета для каждого экземпляра
+        for instance_id, breakdown_name, status in instances:
+            text_lines = [f"Экземпляр: {instance_id}\nРазбивка: {breakdown_name} (Статус: {status})"]
+            for username, items_json in grouped[instance_id]:
                 try:
                     order_items = json.loads(items_json)
-                    cursor.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-                    res = cursor.fetchone()
-                    taken_username = "@" + (res[0] if res else str(user_id))
-                    for it in order_items:
-                        taken[it['name']] = taken_username
+                    items_text = ", ".join([f"{it['name']} - {it['price']} руб." for it in order_items])
                 except Exception as e:
                     logger.error("❌ Ошибка парсинга JSON: %s", e)
-            # Формируем список всех позиций с их статусом
-            for item_name, price in items_list:
-                status = taken.get(item_name, "Свободно")
-                all_rows.append((instance_id, breakdown_name, item_name, price, status))
-        if all_rows:
-            grouped = defaultdict(list)
-            for instance_id, breakdown_name, item_name, price, status in all_rows:
-                grouped[instance_id].append((breakdown_name, item_name, price, status))
-            lines = ["Экземпляр | Разбивка | Позиция | Цена | Статус"]
-            for instance_id in sorted(grouped.keys()):
-                breakdown_name = grouped[instance_id][0][0]
-                for row in grouped[instance_id]:
-                    _, item_name, price, status = row
-                    lines.append(f"{instance_id} | {breakdown_name} | {item_name} | {price} | {status}")
+                    items_text = "🚫 Ошибка отображения"
+                text_lines.append(f"Заказ от @{username}: {items_text}")
+            text_lines.append("-" * 40)
+            blocks.append("\n".join(text_lines))
+        # Не помещающиеся в сообщение экземпляры переносятся на соседнюю страницу
+        ids, blocks, has_prev, has_next = fit_page(ids, blocks, backward, has_prev, has_next)
+        text = page_text(blocks)
+        keyboard += page_buttons(CB_FULL_SPLITS, (), (ids[0],), (ids[-1],), has_prev, has_next)
+    else:
+        text = "🚫 Нет разбивок, где все позиции заняты."
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")])
+    await edit_if_changed(query, f"<pre>{html.escape(text)}</pre>", InlineKeyboardMarkup(keyboard), parse_mode="HTML")
+
+# Отчет по всем позициям товаров для каждого экземпляра:
+async def on_view_all_positions(query, context, args: list) -> None:
+    # Фильтры отчёта: только открытые экземпляры (0/1) и id разбивки (0 - все разбивки), затем курсор страницы.
+    # Курсор - пара (id экземпляра, id товара): позиции большого экземпляра делятся на несколько страниц
+    open_only, breakdown_id, instance_cursor, item_cursor, backward = args if args else (0, 0, 0, 0, 0)
+    breakdown = await catalog.breakdown(breakdown_id) if breakdown_id else None
+    conditions = []
+    params = []
+    if open_only:
+        conditions.append("bi.status = 'open'")
+    if breakdown is not None:
+        conditions.append("bi.breakdown_name = ?")
+        params.append(breakdown[1])
+    where = "".join(f"{condition} AND " for condition in conditions)
+    # Позиции экземпляров: товары разбивки экземпляра и, если позиция занята, её покупатель
+    rows, has_prev, has_next = await fetch_keyset(f"""
+        SELECT bi.id, i.id, bi.breakdown_name, i.item_name, i.price, o.user_id, u.username
+        FROM breakdown_instances bi
+        JOIN items i ON i.breakdown_name = bi.breakdown_name
+        LEFT JOIN order_items oi ON oi.instance_id = bi.id AND oi.item_id = i.id
+        LEFT JOIN orders o ON o.order_id = oi.order_id
+        LEFT JOIN users u ON u.user_id = o.user_id
+        WHERE {where}(bi.id, i.id) {{cmp}} (?, ?)
+        ORDER BY bi.id {{order}}, i.id {{order}} LIMIT ?
+    """, tuple(params), (instance_cursor, item_cursor), backward, LIST_PAGE_SIZE)
+    keyboard = []
+    if rows:
+        keys = []
+        blocks = []
+        # Позиции идут подряд по экземплярам: заголовок перед первой позицией экземпляра, черта после последней
+        for index, (instance_id, item_id, breakdown_name, item_name, price, user_id, username) in enumerate(rows):
+            lines = []
+            if index == 0 or rows[index - 1][0] != instance_id:
+                lines.append(f"==== Экземпляр {instance_id} | {breakdown_name} ====")
+            status = "Свободно" if user_id is None else "@" + (username if username else str(user_id))
+            lines.append(f"{item_name} | {price} | {status}")
+            if index == len(rows) - 1 or rows[index + 1][0] != instance_id:
                 lines.append("_" * 40)
-            text = "\n".join(lines)
-        else:
-            text = "🚫 Нет данных о позициях."
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")]]
-        await query.edit_message_text(text=f"<pre>{text}</pre>", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
+            keys.append((instance_id, item_id))
+            blocks.append("\n".join(lines))
+        keys, blocks, has_prev, has_next = fit_page(keys, blocks, backward, has_prev, has_next)
+        # Если страница начинается с середины экземпляра, повторяем заголовок
+        if not blocks[0].startswith("===="):
+            breakdown_name = next(row[2] for row in rows if (row[0], row[1]) == keys[0])
+            blocks[0] = f"==== Экземпляр {keys[0][0]} | {breakdown_name} ====\n{blocks[0]}"
+        text = "\n".join(["Позиция | Цена | Статус", page_text(blocks)])
+        keyboard += page_buttons(CB_VIEW_POSITIONS, (open_only, breakdown_id), keys[0], keys[-1], has_prev, has_next)
+    else:
+        text = "🚫 Нет данных о позициях."
+    # Кнопки фильтров: переключатель открытых экземпляров и экран выбора разбивки.
+    # Смена фильтра начинает отчёт с первой страницы.
+    keyboard.append([InlineKeyboardButton("📋 Все экземпляры" if open_only else "🟢 Только открытые",
+                                          callback_data=encode_callback(CB_VIEW_POSITIONS, 0 if open_only else 1, breakdown_id, 0, 0, 0))])
+    keyboard.append([InlineKeyboardButton("🔎 Разбивка: " + (breakdown[1] if breakdown is not None else "все"),
+                                          callback_data=encode_callback(CB_POSITIONS_FILTER, open_only, breakdown_id,
+                                                                        1 if breakdown is not None and breakdown[2] else 0, 0, 0))])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")])
+    await edit_if_changed(query, f"<pre>{html.escape(text)}</pre>", InlineKeyboardMarkup(keyboard), parse_mode="HTML")
 
-    # Отчет по чекам пользователей:
-    elif data == "view_user_checks":
-        cursor.execute("""
-            SELECT o.breakdown_name, o.items, o.total_amount, u.username
-            FROM orders o
-            JOIN users u ON o.user_id = u.user_id
-            WHERE o.instance_id IN (SELECT id FROM breakdown_instances WHERE status = 'complete')
-        """)
-        orders_data = cursor.fetchall()
-        if orders_data:
-            grouped = defaultdict(list)
-            # Группируем заказы по пользователям
-            for breakdown_name, items_json, order_total, username in orders_data:
-                grouped[username].append((breakdown_name, items_json, order_total))
+async def on_positions_filter(query, context, args: list) -> None:
+    """Постраничный выбор разбивки для отчёта по позициям; скрытые разбивки показываются по переключателю."""
+    open_only, breakdown_id, show_hidden, cursor, backward = args
+    # Разбивки берутся из кэша каталога, страница выбирается по id так же, как в fetch_keyset
+    breakdowns = await (catalog.breakdowns() if show_hidden else catalog.visible_breakdowns())
+    if backward:
+        preceding = [row for row in breakdowns if row[0] < cursor]
+        page = preceding[-FILTER_PAGE_SIZE:]
+        has_prev, has_next = len(preceding) > FILTER_PAGE_SIZE, True
+    else:
+        following = [row for row in breakdowns if row[0] > cursor]
+        page = following[:FILTER_PAGE_SIZE]
+        has_prev, has_next = cursor > 0, len(following) > FILTER_PAGE_SIZE
+    buttons = [InlineKeyboardButton(("✅ " if b_id == breakdown_id else "") + ("🙈 " if hidden else "") + name,
+                                    callback_data=encode_callback(CB_VIEW_POSITIONS, open_only, b_id, 0, 0, 0))
+               for b_id, name, hidden in page]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    if page:
+        keyboard += page_buttons(CB_POSITIONS_FILTER, (open_only, breakdown_id, show_hidden),
+                                 (page[0][0],), (page[-1][0],), has_prev, has_next)
+    keyboard.append([InlineKeyboardButton(("✅ " if not breakdown_id else "") + "Все разбивки",
+                                          callback_data=encode_callback(CB_VIEW_POSITIONS, open_only, 0, 0, 0, 0))])
+    keyboard.append([InlineKeyboardButton("🙈 Без скрытых" if show_hidden else "👁 Показать скрытые",
+                                          callback_data=encode_callback(CB_POSITIONS_FILTER, open_only, breakdown_id,
+                                                                        0 if show_hidden else 1, 0, 0))])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=encode_callback(CB_VIEW_POSITIONS, open_only, breakdown_id, 0, 0, 0))])
+    text = "Выберите разбивку для отчёта по позициям:" if breakdowns else "🚫 Нет доступных разбивок."
+    await edit_if_changed(query, text, InlineKeyboardMarkup(keyboard))
+
+# Отчет по чекам пользователей:
+async def on_view_user_checks(query, context, args: list) -> None:
+    # Курсор - пара (id пользователя, id заказа): у пользователя с большим числом заказов они делятся на страницы
+    user_cursor, order_cursor, backward = args if args else (0, 0, 0)
+    orders, has_prev, has_next = await fetch_keyset("""
+        SELECT o.user_id, o.order_id, u.username, o.breakdown_name, o.items, o.total_amount
+        FROM orders o
+        JOIN breakdown_instances bi ON bi.id = o.instance_id
+        JOIN users u ON o.user_id = u.user_id
+        WHERE bi.status = 'complete' AND (o.user_id, o.order_id) {cmp} (?, ?)
+        ORDER BY o.user_id {order}, o.order_id {order} LIMIT ?
+    """, (), (user_cursor, order_cursor), backward, LIST_PAGE_SIZE)
+    keyboard = []
+    if orders:
+        keys = []
+        blocks = []
+        # Заказы идут подряд по пользователям: заголовок перед первым заказом пользователя, черта после последнего
+        for index, (user_id, order_id, username, breakdown_name, items_json, order_total) in enumerate(orders):
             lines = []
-            for username, orders_list in grouped.items():
+            if index == 0 or orders[index - 1][0] != user_id:
                 lines.append(f"==== Заказы от @{username} ====")
-                for breakdown_name, items_json, order_total in orders_list:
-                    try:
-                        order_items = json.loads(items_json)
-                        items_text = "\n".join([f"▪ {it['name']} - {it['price']} руб." for it in order_items])
-                    except Exception as e:
-                        logger.error("❌ Ошибка парсинга JSON: %s", e)
-                        items_text = "🚫 Ошибка отображения"
-                    lines.append(f"Разбивка: {breakdown_name}\n{items_text}\nСумма: {order_total} руб.\n")
+            try:
+                order_items = json.loads(items_json)
+                items_text = "\n".join([f"▪ {it['name']} - {it['price']} руб." for it in order_items])
+            except Exception as e:
+                logger.error("❌ Ошибка парсинга JSON: %s", e)
+                items_text = "🚫 Ошибка отображения"
+            lines.append(f"Разбивка: {breakdown_name}\n{items_text}\nСумма: {order_total} руб.\n")
+            if index == len(orders) - 1 or orders[index + 1][0] != user_id:
                 lines.append("-" * 40)
-            text = "\n".join(lines)
-        else:
-            text = "🚫 Нет чеков для пользователей."
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")]]
-        await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Меню управления администраторами:
-    elif data == "admin_management":
-        keyboard = [
-            [InlineKeyboardButton("👤➕ Добавить администратора", callback_data="add_admin")],
-            [InlineKeyboardButton("👤❌ Удалить администратора", callback_data="delete_admin_menu")],
-            [InlineKeyboardButton("👤📊 Показать администраторов", callback_data="show_admins")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
-        ]
-        await query.edit_message_text("👤 Управление администраторами:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Добавление администратора:
-    elif data == "add_admin":
-        # Запрашиваем ID нового администратора с возможностью возврата назад
-        await query.edit_message_text("➕ Введите ID нового администратора:", 
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_management")]]))
-        context.user_data["awaiting_admin"] = True
-
-    # Меню удаления администратора:
-    elif data == "delete_admin_menu":
-        cursor.execute("SELECT user_id, username FROM admins")
-        admins = cursor.fetchall()
-        if admins:
-            keyboard = [[InlineKeyboardButton(f"👤❌ Удалить {username} (ID:{user_id})", callback_data=f"delete_admin_{user_id}")]
-                        for user_id, username in admins]
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_management")])
-            await query.edit_message_text("❌ Выберите администратора для удаления:", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_management")]]
-            await query.edit_message_text("🚫 Нет дополнительных администраторов для удаления.", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Удаление администратора:
-    elif data.startswith("delete_admin_"):
-        admin_id = int(data.split("delete_admin_")[1])
-        cursor.execute("DELETE FROM admins WHERE user_id = ?", (admin_id,))
-        conn.commit()
-        await query.edit_message_text(f"✅ Администратор с ID {admin_id} удалён.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_management")]]))
-
-    # Показ списка администраторов:
-    elif data == "show_admins":
-        cursor.execute("SELECT user_id, username FROM admins")
-        admins = cursor.fetchall()
-        if admins:
-            text_lines = [f"@{username} (ID:{user_id})" for user_id, username in admins]
-            text = "\n".join(text_lines)
-        else:
-            text = "🚫 Нет администраторов."
+            keys.append((user_id, order_id))
+            blocks.append("\n".join(lines))
+        keys, blocks, has_prev, has_next = fit_page(keys, blocks, backward, has_prev, has_next)
+        # Если страница начинается с середины заказов пользователя, повторяем заголовок
+        if not blocks[0].startswith("===="):
+            username = next(row[2] for row in orders if (row[0], row[1]) == keys[0])
+            blocks[0] = f"==== Заказы от @{username} ====\n{blocks[0]}"
+        text = page_text(blocks)
+        keyboard += page_buttons(CB_USER_CHECKS, (), keys[0], keys[-1], has_prev, has_next)
+    else:
+        text = "🚫 Нет чеков для пользователей."
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")])
+    await edit_if_changed(query, text, InlineKeyboardMarkup(keyboard))
+
+# Меню управления администраторами:
+async def on_admin_management(query, context, args: list) -> None:
+    keyboard = [
+        [InlineKeyboardButton("👤➕ Добавить администратора", callback_data="add_admin")],
+        [InlineKeyboardButton("👤❌ Удалить администратора", callback_data="delete_admin_menu")],
+        [InlineKeyboardButton("👤📊 Показать администраторов", callback_data="show_admins")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    await query.edit_message_text("👤 Управление администраторами:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Добавление администратора:
+async def on_add_admin(query, context, args: list) -> None:
+    # Запрашиваем ID нового администратора с возможностью возврата назад
+    await query.edit_message_text("➕ Введите ID нового администратора:", 
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_management")]]))
+    context.user_data["awaiting_admin"] = True
+
+# Меню удаления администратора:
+async def on_delete_admin_menu(query, context, args: list) -> None:
+    admins = await db.fetchall("SELECT user_id, username FROM admins")
+    if admins:
+        keyboard = [[InlineKeyboardButton(f"👤❌ Удалить {username} (ID:{user_id})", callback_data=encode_callback(CB_DELETE_ADMIN, user_id))]
+                    for user_id, username in admins]
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_management")])
+        await query.edit_message_text("❌ Выберите администратора для удаления:", reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_management")]]
-        await query.edit_message_text(f"👤 Администраторы:\n\n{text}", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Показ списка пользователей:
-    elif data == "show_users":
-        cursor.execute("SELECT user_id, username FROM users")
-        users = cursor.fetchall()
-        if users:
-            lines = [f"ID: {uid} - @{username}" for uid, username in users]
-            text = "\n".join(lines)
-        else:
-            text = "🚫 Нет пользователей."
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]]
-        await query.edit_message_text(text=f"👥 Пользователи:\n\n{text}", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Меню для удаления позиции в заказе пользователя:
-    elif data == "delete_position_menu":
-        cursor.execute("SELECT order_id, user_id, breakdown_name, items FROM orders")
-        orders = cursor.fetchall()
-        if orders:
-            keyboard = []
-            for order in orders:
-                order_id, user_id, breakdown_name, items_json = order
-                try:
-                    items_list = json.loads(items_json)
-                except Exception as e:
-                    logger.error("❌ Ошибка парсинга JSON: %s", e)
-                    continue
-                if not items_list:
-                    continue
-                cursor.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
-                res = cursor.fetchone()
-                username = res[0] if res else str(user_id)
-                button_text = f"Заказ #{order_id}: {breakdown_name} - @{username}"
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"select_order_{order_id}")])
-            if not keyboard:
-                keyboard = [[InlineKeyboardButton("🚫 Нет заказов для удаления позиций", callback_data="admin_panel")]]
-            else:
-                keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")])
-            await query.edit_message_text("❌ Выберите заказ для удаления позиции пользователя:", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")]]
-            await query.edit_message_text("🚫 Нет заказов для удаления позиций.", reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text("🚫 Нет дополнительных администраторов для удаления.", reply_markup=InlineKeyboardMarkup(keyboard))
 
-    # Выбор конкретного заказа для удаления позиции:
-    elif data.startswith("select_order_"):
-        order_id_str = data.split("select_order_", 1)[1]
-        try:
-            order_id = int(order_id_str)
-        except:
-            await query.edit_message_text("🚫 Некорректный номер заказа.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
-            return
-        cursor.execute("SELECT items FROM orders WHERE order_id = ?", (order_id,))
-        result = cursor.fetchone()
-        if result is None:
-            await query.edit_message_text("🚫 Заказ не найден.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
-            return
-        try:
-            items_list = json.loads(result[0])
-        except Exception as e:
-            logger.error("❌ Ошибка парсинга JSON: %s", e)
-            items_list = []
-        if not items_list:
-            await query.edit_message_text("🚫 В этом заказе нет позиций для удаления.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
-            return
+# Удаление администратора:
+async def on_delete_admin(query, context, args: list) -> None:
+    admin_id = args[0]
+    await db.execute("DELETE FROM admins WHERE user_id = ?", (admin_id,))
+    await admin_cache.reload()
+    await query.edit_message_text(f"✅ Администратор с ID {admin_id} удалён.",
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="admin_management")]]))
+
+# Показ списка администраторов:
+async def on_show_admins(query, context, args: list) -> None:
+    admins = await db.fetchall("SELECT user_id, username FROM admins")
+    if admins:
+        text_lines = [f"@{username} (ID:{user_id})" for user_id, username in admins]
+        text = "\n".join(text_lines)
+    else:
+        text = "🚫 Нет администраторов."
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_management")]]
+    await query.edit_message_text(f"👤 Администраторы:\n\n{text}", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Показ списка пользователей:
+async def on_show_users(query, context, args: list) -> None:
+    cursor, backward = args if args else (0, 0)
+    users, has_prev, has_next = await fetch_keyset(
+        "SELECT user_id, username FROM users WHERE user_id {cmp} ? ORDER BY user_id {order} LIMIT ?",
+        (), (cursor,), backward, LIST_PAGE_SIZE)
+    keyboard = []
+    if users:
+        ids, lines, has_prev, has_next = fit_page([uid for uid, username in users],
+                                                  [f"ID: {uid} - @{username}" for uid, username in users],
+                                                  backward, has_prev, has_next)
+        text = page_text(lines)
+        keyboard += page_buttons(CB_SHOW_USERS, (), (ids[0],), (ids[-1],), has_prev, has_next)
+    else:
+        text = "🚫 Нет пользователей."
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")])
+    await edit_if_changed(query, f"👥 Пользователи:\n\n{text}", InlineKeyboardMarkup(keyboard))
+
+# Меню для удаления позиции в заказе пользователя:
+async def on_delete_position_menu(query, context, args: list) -> None:
+    cursor, backward = args if args else (0, 0)
+    # Страница заказов, в которых остались позиции, вместе с именами покупателей
+    orders, has_prev, has_next = await fetch_keyset("""
+        SELECT o.order_id, o.user_id, o.breakdown_name, u.username
+        FROM orders o
+        LEFT JOIN users u ON u.user_id = o.user_id
+        WHERE EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.order_id) AND o.order_id {cmp} ?
+        ORDER BY o.order_id {order} LIMIT ?
+    """, (), (cursor,), backward, LIST_PAGE_SIZE)
+    if orders:
         keyboard = []
-        # Создаём кнопки для удаления каждой позиции в заказе
-        for item in items_list:
-            item_name = item.get("name")
-            price = item.get("price")
-            button_text = f"❌ Удалить {item_name} ({price} руб.)"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"delete_item_{order_id}_{item_name}")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")])
-        await query.edit_message_text(f"Заказ #{order_id}. Выберите позицию для удаления:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Удаление выбранной позиции в заказе:
-    elif data.startswith("delete_item_"):
-        parts = data.split("_", 3)
-        if len(parts) < 4:
-            await query.edit_message_text("🚫 Некорректные данные для удаления.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
-            return
+        for order_id, user_id, breakdown_name, username in orders:
+            button_text = f"Заказ #{order_id}: {breakdown_name} - @{username or user_id}"
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=encode_callback(CB_SELECT_ORDER, order_id))])
+        keyboard += page_buttons(CB_POSITION_ORDERS, (), (orders[0][0],), (orders[-1][0],), has_prev, has_next)
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")])
+        await edit_if_changed(query, "❌ Выберите заказ для удаления позиции пользователя:", InlineKeyboardMarkup(keyboard))
+    else:
+        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="instance_users_menu")]]
+        await edit_if_changed(query, "🚫 Нет заказов для удаления позиций.", InlineKeyboardMarkup(keyboard))
+
+# Выбор конкретного заказа для удаления позиции:
+async def on_select_order(query, context, args: list) -> None:
+    order_id = args[0]
+    # Позиции заказа берём из order_items вместе с id товаров для кнопок удаления
+    items_list = await db.fetchall("""
+        SELECT oi.item_id, i.item_name, oi.price
+        FROM order_items oi JOIN items i ON i.id = oi.item_id
+        WHERE oi.order_id = ?
+        ORDER BY oi.rowid
+    """, (order_id,))
+    if not items_list:
+        await query.edit_message_text("🚫 В этом заказе нет позиций для удаления.",
+                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
+        return
+    keyboard = []
+    # Создаём кнопки для удаления каждой позиции в заказе
+    for item_id, item_name, price in items_list:
+        button_text = f"❌ Удалить {item_name} ({price} руб.)"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=encode_callback(CB_DELETE_ITEM, order_id, item_id))])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")])
+    await query.edit_message_text(f"Заказ #{order_id}. Выберите позицию для удаления:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Удаление выбранной позиции в заказе:
+async def on_delete_item(query, context, args: list) -> None:
+    order_id, item_id = args
+    removal = await db.transaction(remove_order_item, order_id, item_id)
+    if removal is None:
+        await query.edit_message_text("🚫 Позиция не найдена в заказе.",
+                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
+        return
+    item_name, new_total, order_deleted = removal
+    # Если после удаления товаров заказ пустой, он удалён целиком
+    if order_deleted:
+        message_text = f"✅ Позиция '{item_name}' удалена, заказ #{order_id} удалён."
+    else:
+        message_text = f"✅ Позиция '{item_name}' удалена из заказа #{order_id}. Новый итог: {new_total} руб."
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]
+    await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Просмотр сообщений пользователей (новые первыми) с фильтром необработанных:
+async def on_view_messages(query, context, args: list) -> None:
+    unhandled_only, cursor, backward = args if args else (0, 0, 0)
+    # Страница читается по id (rowid или индекс idx_messages_handled), без сортировки всей таблицы
+    msgs, has_prev, has_next = await fetch_keyset(f"""
+        SELECT m.id, COALESCE(u.username, 'Неизвестно'), m.message, m.timestamp, m.handled
+        FROM messages m
+        LEFT JOIN users u ON u.user_id = m.user_id
+        WHERE {"m.handled = 0 AND " if unhandled_only else ""}m.id {{cmp}} ?
+        ORDER BY m.id {{order}} LIMIT ?
+    """, (), (cursor,), backward, REPORT_PAGE_SIZE, descending=True)
+    # Счёт необработанных ограничен, чтобы при большом их числе не проходить весь индекс на каждом открытии
+    unhandled = (await db.fetchone("SELECT COUNT(*) FROM (SELECT 1 FROM messages WHERE handled = 0 LIMIT ?)",
+                                   (UNHANDLED_COUNT_LIMIT,)))[0]
+    unhandled = f"{unhandled}+" if unhandled >= UNHANDLED_COUNT_LIMIT else unhandled
+    keyboard = []
+    if msgs:
+        ids = [row[0] for row in msgs]
+        handled = {row[0]: row[4] for row in msgs}
+        # Формируем текст и кнопки обработки и удаления каждого сообщения
+        blocks = [f"ID:{msg_id} | @{username} {'✅' if is_handled else '🆕'}\n{message_text}\n🕒 {timestamp}\n"
+                  for msg_id, username, message_text, timestamp, is_handled in msgs]
+        ids, blocks, has_prev, has_next = fit_page(ids, blocks, backward, has_prev, has_next)
+        for msg_id in ids:
+            keyboard.append([
+                InlineKeyboardButton(f"{'↩️ Вернуть' if handled[msg_id] else '✅ Обработано'} ID:{msg_id}",
+                                     callback_data=encode_callback(CB_HANDLE_MESSAGE, msg_id, 1 - handled[msg_id],
+                                                                   unhandled_only, cursor, backward)),
+                InlineKeyboardButton(f"❌ Удалить ID:{msg_id}", callback_data=encode_callback(CB_DELETE_MESSAGE, msg_id)),
+            ])
+        keyboard += page_buttons(CB_MESSAGES, (unhandled_only,), (ids[0],), (ids[-1],), has_prev, has_next)
+        text = f"💬 Сообщения (🆕 необработанных: {unhandled}):\n\n{page_text(blocks)}"
+    else:
+        text = "🚫 Нет необработанных сообщений." if unhandled_only else "🚫 Нет сообщений."
+    keyboard.append([InlineKeyboardButton("📋 Все сообщения" if unhandled_only else "🆕 Только необработанные",
+                                          callback_data=encode_callback(CB_MESSAGES, 1 - unhandled_only, 0, 0))])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")])
+    await edit_if_changed(query, text, InlineKeyboardMarkup(keyboard))
+
+# Отметка сообщения обработанным (или снова новым) и возврат на ту же страницу.
+# Кнопка несёт нужное состояние, а не переключает его, поэтому повторное нажатие ничего не меняет:
+async def on_handle_message(query, context, args: list) -> None:
+    msg_id, handled, *page = args
+    await db.execute("UPDATE messages SET handled = ? WHERE id = ?", (1 if handled else 0, msg_id))
+    await on_view_messages(query, context, page)
+
+# Удаление выбранного сообщения:
+async def on_delete_message(query, context, args: list) -> None:
+    msg_id = args[0]
+    await db.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+    await query.edit_message_text(f"✅ Сообщение с ID {msg_id} удалено.",
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="view_messages")]]))
+
+# Обработка запроса "Купить с ТаоБао":
+async def on_buy_from_taobao(query, context, args: list) -> None:
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
+    await query.edit_message_text("🛒 Введите ссылку на товар с ТаоБао:", reply_markup=InlineKeyboardMarkup(keyboard))
+    # Устанавливаем флаг, чтобы в будущем обработать текстовое сообщение как ссылку с ТаоБао
+    context.user_data["awaiting_taobao_message"] = True
+
+# Возврат к главному меню:
+async def on_back_to_main(query, context, args: list) -> None:
+    user_id = query.from_user.id
+    keyboard = [
+        [InlineKeyboardButton("📂 Актуальные Разбивки", callback_data="actual_breakdowns")],
+        [InlineKeyboardButton("🛒 Купить с ТаоБао", callback_data="buy_from_taobao")],
+        [InlineKeyboardButton("👤 Личный Кабинет", callback_data="personal_account")]
+    ]
+    if is_admin(user_id):
+        keyboard.append([InlineKeyboardButton("⚙️ Администрирование", callback_data="admin_panel")])
+    await query.edit_message_text("Привет! Выберите опцию:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Обработка неизвестных команд:
+async def on_unknown(query, context, args: list) -> None:
+    await query.edit_message_text("🚫 Неизвестная команда. Попробуйте снова.",
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]))
+
+# Таблица маршрутов: ключ callback_data -> функция-обработчик.
+# Статические команды используют своё имя, команды с параметрами - версионированный код маршрута.
+ROUTES = {
+    "actual_breakdowns": on_actual_breakdowns,
+    callback_key(CB_BREAKDOWN): on_breakdown,
+    callback_key(CB_TOGGLE_ITEM): on_toggle_item,
+    "finish_selection": on_finish_selection,
+    "personal_account": on_personal_account,
+    callback_key(CB_ACCOUNT_PAGE): on_personal_account,
+    "admin_panel": on_admin_panel,
+    "breakdowns_menu": on_breakdowns_menu,
+    "add_breakdown": on_add_breakdown,
+    "add_item": on_add_item,
+    callback_key(CB_SELECT_BREAKDOWN): on_select_breakdown,
+    "delete_breakdown_menu": on_delete_breakdown_menu,
+    callback_key(CB_DELETE_BREAKDOWN): on_delete_breakdown,
+    "hide_breakdown_menu": on_hide_breakdown_menu,
+    callback_key(CB_HIDE_BREAKDOWN): on_hide_breakdown,
+    "instance_users_menu": on_instance_users_menu,
+    "view_full_splits": on_view_full_splits,
+    callback_key(CB_FULL_SPLITS): on_view_full_splits,
+    "view_all_positions": on_view_all_positions,
+    callback_key(CB_VIEW_POSITIONS): on_view_all_positions,
+    callback_key(CB_POSITIONS_FILTER): on_positions_filter,
+    "view_user_checks": on_view_user_checks,
+    callback_key(CB_USER_CHECKS): on_view_user_checks,
+    "admin_management": on_admin_management,
+    "add_admin": on_add_admin,
+    "delete_admin_menu": on_delete_admin_menu,
+    callback_key(CB_DELETE_ADMIN): on_delete_admin,
+    "show_admins": on_show_admins,
+    "show_users": on_show_users,
+    callback_key(CB_SHOW_USERS): on_show_users,
+    "delete_position_menu": on_delete_position_menu,
+    callback_key(CB_POSITION_ORDERS): on_delete_position_menu,
+    callback_key(CB_SELECT_ORDER): on_select_order,
+    callback_key(CB_DELETE_ITEM): on_delete_item,
+    "view_messages": on_view_messages,
+    "export_menu": on_export_menu,
+    "metrics": on_metrics,
+    "purge_status": on_purge_status,
+    callback_key(CB_EXPORT): on_export,
+    callback_key(CB_DELETE_MESSAGE): on_delete_message,
+    callback_key(CB_MESSAGES): on_view_messages,
+    callback_key(CB_HANDLE_MESSAGE): on_handle_message,
+    "buy_from_taobao": on_buy_from_taobao,
+    "back_to_main": on_back_to_main,
+}
+
+def make_route_handler(key: str, route):
+    """
+    Оборачивает обработчик маршрута в callback для CallbackQueryHandler:
+    сохраняет пользователя, отвечает на CallbackQuery, разбирает id, проверяет права администратора
+    и замеряет время выполнения маршрута.
+    """
+    async def handle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        # Сохраняем данные пользователя, инициировавшего CallbackQuery
+        save_user(query.from_user)
+        # Отправляем ответ, чтобы убрать "часики" на кнопке
+        await query.answer()
+        logger.info("Callback data: %s", query.data)
+        # Повреждённые данные и кнопки старого формата считаются неизвестными командами
         try:
-            order_id = int(parts[2])
-        except:
-            await query.edit_message_text("🚫 Некорректный номер заказа.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
-            return
-        item_name = parts[3]
-        cursor.execute("SELECT items, total_amount, breakdown_name, instance_id FROM orders WHERE order_id = ?", (order_id,))
-        order_data = cursor.fetchone()
-        if not order_data:
-            await query.edit_message_text("🚫 Заказ не найден.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
+            _, args = decode_callback(query.data)
+            handler = route
+        except ValueError:
+            args, handler = [], on_unknown
+        # Административные команды проверяются по кэшу администраторов, без обращения к базе
+        if key in ADMIN_ROUTES and not is_admin(query.from_user.id):
+            await query.edit_message_text("🚫 Недостаточно прав.",
+                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]))
             return
-        items_json, total_amount, breakdown_name, instance_id = order_data
+        started = time.perf_counter()
         try:
-            items_list = json.loads(items_json)
-        except Exception as e:
-            logger.error("❌ Ошибка парсинга JSON: %s", e)
-            items_list = []
-        new_items = []
-        removed = False
-        removed_price = 0
-        # Проходим по списку товаров и исключаем выбранную для удаления позицию
-        for item in items_list:
-            if not removed and item.get("name") == item_name:
-                removed = True
-                removed_price = item.get("price", 0)
-            else:
-                new_items.append(item)
-        if not removed:
-            await query.edit_message_text("🚫 Позиция не найдена в заказе.",
-                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]))
-            return
-        new_total = total_amount - removed_price
-        # Если после удаления товаров заказ пустой, удаляем заказ целиком
-        if not new_items:
-            cursor.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
-            message_text = f"✅ Позиция '{item_name}' удалена, заказ #{order_id} удалён."
-        else:
-            new_items_json = json.dumps(new_items, ensure_ascii=False)
-            cursor.execute("UPDATE orders SET items = ?, total_amount = ? WHERE order_id = ?", (new_items_json, new_total, order_id))
-            message_text = f"✅ Позиция '{item_name}' удалена из заказа #{order_id}. Новый итог: {new_total} руб."
-        # Если заказ принадлежит экземпляру разбивки, изменяем его статус на "open"
-        if instance_id is not None:
-            cursor.execute("UPDATE breakdown_instances SET status = 'open' WHERE id = ?", (instance_id,))
-        conn.commit()
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="delete_position_menu")]]
-        await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard))
+            await handler(query, context, args)
+        finally:
+            route_timings.record(key, time.perf_counter() - started)
+    return handle
 
-    # Просмотр последних сообщений пользователей:
-    elif data == "view_messages":
-        cursor.execute("""
-            SELECT messages.id, COALESCE(users.username, 'Неизвестно') as username, messages.message, messages.timestamp 
-            FROM messages 
-            LEFT JOIN users ON messages.user_id = users.user_id 
-            ORDER BY messages.timestamp DESC 
-            LIMIT 10
-        """)
-        msgs = cursor.fetchall()
-        if msgs:
-            text_lines = []
-            keyboard = []
-            # Формируем текст и кнопки для удаления каждого сообщения
-            for msg_id, username, message_text, timestamp in msgs:
-                text_lines.append(f"ID:{msg_id} | @{username}\n{message_text}\n🕒 {timestamp}")
-                keyboard.append([InlineKeyboardButton(f"❌ Удалить ID:{msg_id}", callback_data=f"delete_message_{msg_id}")])
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")])
-            full_text = "\n\n".join(text_lines)
-            await query.edit_message_text(f"💬 Последние сообщения:\n\n{full_text}", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]]
-            await query.edit_message_text("🚫 Нет сообщений.", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Удаление выбранного сообщения:
-    elif data.startswith("delete_message_"):
-        msg_id = data.split("delete_message_")[1]
-        cursor.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
-        conn.commit()
-        await query.edit_message_text(f"✅ Сообщение с ID {msg_id} удалено.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="view_messages")]]))
-
-    # Обработка запроса "Купить с ТаоБао":
-    elif data == "buy_from_taobao":
-        keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]
-        await query.edit_message_text("🛒 Введите ссылку на товар с ТаоБао:", reply_markup=InlineKeyboardMarkup(keyboard))
-        # Устанавливаем флаг, чтобы в будущем обработать текстовое сообщение как ссылку с ТаоБао
-        context.user_data["awaiting_taobao_message"] = True
-
-    # Возврат к главному меню:
-    elif data == "back_to_main":
-        user_id = query.from_user.id
-        keyboard = [
-            [InlineKeyboardButton("📂 Актуальные Разбивки", callback_data="actual_breakdowns")],
-            [InlineKeyboardButton("🛒 Купить с ТаоБао", callback_data="buy_from_taobao")],
-            [InlineKeyboardButton("👤 Личный Кабинет", callback_data="personal_account")]
-        ]
-        if is_admin(user_id):
-            keyboard.append([InlineKeyboardButton("⚙️ Администрирование", callback_data="admin_panel")])
-        await query.edit_message_text("Привет! Выберите опцию:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    # Обработка неизвестных команд:
-    else:
-        await query.edit_message_text("🚫 Неизвестная команда. Попробуйте снова.",
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]]))
+def build_callback_handlers() -> list:
+    """
+    Создаёт по одному CallbackQueryHandler на каждый маршрут из ROUTES.
+    Шаблон совпадает с ключом маршрута целиком или с ключом и следующими за ним id ("1t:2s").
+    Последним идёт обработчик неизвестных команд без шаблона.
+    """
+    handlers = [
+        CallbackQueryHandler(make_route_handler(key, route), pattern=f"^{re.escape(key)}(:|$)")
+        for key, route in ROUTES.items()
+    ]
+    handlers.append(CallbackQueryHandler(make_route_handler("unknown", on_unknown)))
+    return handlers
 
-# Функция для обновления меню выбора товаров (вызывается после изменения выбранного товара)
+# Функция для показа меню выбора товаров (при открытии разбивки и после изменения выбранного товара)
 async def show_items_menu(query, context):
     breakdown_name = context.user_data.get("current_breakdown")
-    cursor.execute("SELECT item_name, price FROM items WHERE breakdown_name=?", (breakdown_name,))
-    items = cursor.fetchall()
-    if items:
-        keyboard = [
-            [InlineKeyboardButton(f"{'✅ ' if i[0] in context.user_data.get('selected_items', set()) else ''}{i[0]} - {i[1]} руб.",
-                                  callback_data=f"toggle_item_{i[0]}")]
-            for i in items
-        ]
-        keyboard.append([InlineKeyboardButton("✅ Готово", callback_data="finish_selection")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")])
-        await query.edit_message_text("Выберите товары:", reply_markup=InlineKeyboardMarkup(keyboard))
+    keyboard = await renderer.items_keyboard(breakdown_name)
+    if keyboard:
+        # Кнопки выбранных товаров отмечаются галочкой. Сообщение редактируется всегда: при двойном нажатии
+        # копия сообщения во втором CallbackQuery ещё без первой отметки и не совпадает с экраном
+        await edit_if_changed(query, "Выберите товары:", keyboard.render(context.user_data.get("selected_items", set())),
+                              compare=False)
     else:
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="actual_breakdowns")]]
-        await query.edit_message_text("🚫 В этой разбивке пока нет товаров.", reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_if_changed(query, "🚫 В этой разбивке пока нет товаров.", InlineKeyboardMarkup(keyboard))
+
+# Максимальный размер файла со списком позиций
+IMPORT_MAX_BYTES = 1024 * 1024
+
+def parse_item_lines(text: str) -> tuple:
+    """
+    Разбирает список позиций: по одной на строке в формате "название;цена".
+    Пустые строки и строка-заголовок ("название;цена") пропускаются, цена может быть с запятой.
+    Возвращает (список (название, цена), список ошибок с номерами строк).
+    """
+    items = []
+    errors = []
+    seen = set()
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        if ";" not in line:
+            errors.append(f"Строка {line_no}: нет разделителя ';'")
+            continue
+        name, _, price_text = line.rpartition(";")
+        name = name.strip()
+        price_text = price_text.strip()
+        if line_no == 1 and price_text.lower() in ("цена", "price"):
+            continue
+        if not name:
+            errors.append(f"Строка {line_no}: пустое название")
+            continue
+        try:
+            price = float(price_text.replace(",", "."))
+        except ValueError:
+            errors.append(f"Строка {line_no}: некорректная цена '{price_text}'")
+            continue
+        if not 0 <= price < float("inf"):
+            errors.append(f"Строка {line_no}: некорректная цена '{price_text}'")
+            continue
+        if name.casefold() in seen:
+            errors.append(f"Строка {line_no}: повтор позиции '{name}'")
+            continue
+        seen.add(name.casefold())
+        items.append((name, price))
+    return items, errors
+
+async def import_items(message, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    """Добавляет список позиций в выбранную разбивку одной транзакцией и отвечает одной сводкой с ошибками по строкам."""
+    breakdown_name = context.user_data["breakdown_name"]
+    items, errors = parse_item_lines(text)
+    added, skipped = 0, []
+    if items:
+        added, skipped = await db.transaction(add_items, breakdown_name, items)
+        catalog.invalidate(breakdown_name)
+    errors += [f"'{name}' уже есть в разбивке" for name in skipped]
+    lines = [f"✅ Добавлено позиций в '{breakdown_name}': {added}"]
+    if errors:
+        lines.append(f"❌ Ошибок: {len(errors)}")
+        size = len(lines[0]) + len(lines[1])
+        for index, error in enumerate(errors):
+            size += len(error) + 1
+            if size > MESSAGE_LIMIT - 100:
+                lines.append(f"... и ещё {len(errors) - index}")
+                break
+            lines.append(error)
+    keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
+    await message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+    context.user_data.clear()
+
+async def handle_item_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Файл .csv/.txt со строками "название;цена", присланный после выбора разбивки для добавления позиций."""
+    save_user(update.message.from_user)
+    if not context.user_data.get("awaiting_item_name") or not is_admin(update.message.from_user.id):
+        return
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text("❌ Файл слишком большой (не более 1 МБ)")
+        return
+    data = bytes(await (await document.get_file()).download_as_bytearray())
+    # Файлы из Excel часто сохранены в cp1251
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = data.decode("cp1251", errors="replace")
+    await import_items(update.message, context, text)
 
 # Функция для обработки текстовых сообщений от пользователя, объединяющая разные случаи ввода
 async def handle_combined_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Сохраняем пользователя
     save_user(update.message.from_user)
+    # Административный ввод принимается только от администраторов
+    if any(context.user_data.get(flag) for flag in ADMIN_INPUT_FLAGS) and not is_admin(update.message.from_user.id):
+        context.user_data.clear()
+        return
     # Обработка ввода названия новой разбивки
     if context.user_data.get("awaiting_breakdown_name"):
         breakdown_name = update.message.text
         try:
-            cursor.execute("INSERT INTO breakdowns (name) VALUES (?)", (breakdown_name,))
-            conn.commit()
+            await db.execute("INSERT INTO breakdowns (name) VALUES (?)", (breakdown_name,))
+            catalog.invalidate()
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
             await update.message.reply_text(f"✅ Разбивка '{breakdown_name}' добавлена", reply_markup=InlineKeyboardMarkup(keyboard))
         except sqlite3.IntegrityError:
-            await update.message.reply_text("❌ Такая разбивка уже существует")
+            # Удалённая разбивка сохраняет название, пока её данные не очищены: новые позиции и заказы
+            # с тем же названием попали бы под очистку, поэтому добавить её заново можно только после неё
+            deleted = await db.fetchone("SELECT 1 FROM breakdowns WHERE name = ? AND deleted_at IS NOT NULL",
+                                        (breakdown_name,))
+            if deleted is not None:
+                keyboard = [[InlineKeyboardButton("⏳ Ход очистки", callback_data="purge_status")]]
+                await update.message.reply_text(
+                    f"⏳ Разбивка '{breakdown_name}' удалена, но её данные ещё очищаются. "
+                    "Добавьте её заново после окончания очистки.", reply_markup=InlineKeyboardMarkup(keyboard))
+            else:
+                await update.message.reply_text("❌ Такая разбивка уже существует")
         context.user_data.clear()
 
     # Обработка ввода названия товара для выбранной разбивки
     elif context.user_data.get("awaiting_item_name"):
+        # Список позиций "название;цена" добавляется целиком, иначе это название одного товара
+        if ";" in update.message.text or "\n" in update.message.text:
+            await import_items(update.message, context, update.message.text)
+            return
         context.user_data["item_name"] = update.message.text
         await update.message.reply_text("➕ Введите цену товара:")
         context.user_data["awaiting_item_price"] = True
@@ -821,9 +2737,8 @@ async def handle_combined_input(update: Update, context: ContextTypes.DEFAULT_TY
     elif context.user_data.get("awaiting_item_price"):
         try:
             price = float(update.message.text.replace(",", "."))
-            cursor.execute("INSERT INTO items (breakdown_name, item_name, price) VALUES (?, ?, ?)",
-                           (context.user_data["breakdown_name"], context.user_data["item_name"], price))
-            conn.commit()
+            await db.transaction(add_item, context.user_data["breakdown_name"], context.user_data["item_name"], price)
+            catalog.invalidate(context.user_data["breakdown_name"])
             keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data="breakdowns_menu")]]
             await update.message.reply_text("✅ Товар успешно добавлен", reply_markup=InlineKeyboardMarkup(keyboard))
         except ValueError:
@@ -834,23 +2749,12 @@ async def handle_combined_input(update: Update, context: ContextTypes.DEFAULT_TY
     elif context.user_data.get("awaiting_taobao_message"):
         user_id = update.message.from_user.id
         username = update.message.from_user.username or "Без имени"
-        # Сохраняем сообщение в таблице messages
-        cursor.execute("INSERT INTO messages (user_id, message) VALUES (?, ?)", (user_id, update.message.text))
-        conn.commit()
-        # Обеспечиваем наличие пользователя в таблице users
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
-                       (user_id, update.message.from_user.username or "Без имени"))
-        # Извлекаем список администраторов для уведомления
-        cursor.execute("SELECT user_id FROM admins")
-        admin_ids = cursor.fetchall()
-        if not admin_ids:
-            admin_ids = [(1244636103,)]
-        # Отправляем уведомление каждому администратору о новом сообщении
-        for admin in admin_ids:
-            try:
-                await context.bot.send_message(chat_id=admin[0], text=f"📨 Новое сообщение от @{username}:\n{update.message.text}")
-            except Exception as e:
-                logger.error("❌ Ошибка отправки уведомления администратору %s: %s", admin[0], e)
+        # Сохраняем сообщение и уведомления администраторам (из кэша) одной транзакцией
+        admin_ids = admin_cache.ids or SUPER_ADMIN_IDS
+        notification = f"📨 Новое сообщение от @{username}:\n{update.message.text}"
+        await db.transaction(store_message, user_id, username, update.message.text,
+                             [(admin_id, notification) for admin_id in admin_ids])
+        notifier.wake()
         # Добавляем кнопку для возврата в главное меню
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]])
         await update.message.reply_text("✅ Ваше сообщение отправлено", reply_markup=keyboard)
@@ -862,24 +2766,345 @@ async def handle_combined_input(update: Update, context: ContextTypes.DEFAULT_TY
             new_admin_id = int(update.message.text.strip())
             chat = await context.bot.get_chat(new_admin_id)
             new_admin_name = chat.first_name or chat.username or "Без имени"
-            cursor.execute("INSERT OR IGNORE INTO admins (user_id, username) VALUES (?, ?)", (new_admin_id, new_admin_name))
-            conn.commit()
+            await db.execute("INSERT OR IGNORE INTO admins (user_id, username) VALUES (?, ?)", (new_admin_id, new_admin_name))
+            await admin_cache.reload()
             await update.message.reply_text(f"✅ Администратор {new_admin_name} (ID: {new_admin_id}) добавлен")
         except Exception as e:
             logger.error("❌ Ошибка добавления администратора: %s", e)
             await update.message.reply_text("❌ Ошибка добавления администратора. Проверьте ввод ID")
         context.user_data.clear()
 
-# Функция main - инициализация и запуск бота
-def main() -> None:
-    # Создаём приложение Telegram Bot с заданным токеном
-    application = Application.builder().token("ТОКЕН БОТА").build()
+def save_user_states(conn: sqlite3.Connection, states: list) -> None:
+    """Сохраняет пачку состояний (user_id, JSON); состояние None удаляет запись пользователя."""
+    now = time.time()
+    conn.executemany("DELETE FROM user_state WHERE user_id = ?",
+                     [(user_id,) for user_id, data in states if data is None])
+    conn.executemany("""
+        INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+    """, [(user_id, data, now) for user_id, data in states if data is not None])
+
+def encode_user_data(data: dict) -> Optional[str]:
+    """Сериализует user_data в JSON (множества сохраняются как {"__set__": [...]}); пустое состояние - None."""
+    if not data:
+        return None
+    return json.dumps(data, ensure_ascii=False, sort_keys=True,
+                      default=lambda value: {"__set__": sorted(value)} if isinstance(value, (set, frozenset)) else str(value))
+
+def decode_user_data(text: str) -> dict:
+    return json.loads(text, object_hook=lambda obj: set(obj["__set__"]) if set(obj) == {"__set__"} else obj)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранение context.user_data в таблице user_state, чтобы выбор товаров и начатые диалоги
+    администраторов переживали перезапуск контейнера.
+    Библиотека передаёт изменения раз в update_interval секунд (и при остановке бота) для всех пользователей
+    с новыми обновлениями; из них записываются только действительно изменившиеся состояния,
+    одной транзакцией на весь запуск. Остальные виды данных (chat_data, bot_data и т.д.) не сохраняются.
+    """
+
+    def __init__(self, database: Database, update_interval: float = PERSISTENCE_INTERVAL) -> None:
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self._db = database
+        # Последнее записанное в базу состояние каждого пользователя (JSON) и ожидающие записи изменения
+        self._written = {}
+        self._pending = {}
+        self._flushing = None
+
+    async def get_user_data(self) -> dict:
+        rows = await self._db.fetchall("SELECT user_id, data FROM user_state")
+        user_data = {}
+        for user_id, data in rows:
+            try:
+                user_data[user_id] = decode_user_data(data)
+                self._written[user_id] = data
+            except Exception as e:
+                logger.error("❌ Ошибка чтения состояния пользователя %s: %s", user_id, e)
+        logger.info("Восстановлено состояний пользователей: %s", len(user_data))
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        encoded = encode_user_data(data)
+        if self._written.get(user_id) == encoded:
+            self._pending.pop(user_id, None)
+            return
+        self._pending[user_id] = encoded
+        self._schedule()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending[user_id] = None
+        self._schedule()
+
+    def _schedule(self) -> None:
+        # Все update_user_data одного запуска выполняются подряд, поэтому задача записи стартует после них
+        if self._flushing is None:
+            self._flushing = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        try:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await self._db.transaction(save_user_states, list(batch.items()))
+            except Exception as e:
+                logger.error("❌ Ошибка сохранения состояний пользователей: %s", e)
+                for user_id, data in batch.items():
+                    self._pending.setdefault(user_id, data)
+                return
+            for user_id, data in batch.items():
+                if data is None:
+                    self._written.pop(user_id, None)
+                else:
+                    self._written[user_id] = data
+        finally:
+            self._flushing = None
+
+    async def flush(self) -> None:
+        """Вызывается при остановке бота: дожидается текущей записи и сохраняет остаток."""
+        if self._flushing is not None:
+            await self._flushing
+        await self._write_pending()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    # Остальные виды данных не сохраняются
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+
+class KeyedLocks:
+    """
+    Асинхронные блокировки по ключу (id пользователя).
+    Блокировка создаётся при первом обращении и удаляется, как только её никто не держит и не ждёт,
+    поэтому число хранимых блокировок не превышает числа пользователей с обновлениями в обработке.
+    """
+
+    def __init__(self) -> None:
+        # ключ -> [блокировка, число владельцев и ожидающих]
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+# Ёмкость семафора BaseUpdateProcessor, которая никогда не исчерпывается
+UNBOUNDED_UPDATES = 2 ** 30
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с сохранением порядка в пределах одного пользователя.
+    Обработчики хранят состояние диалога в context.user_data (флаги awaiting_*, selected_items),
+    поэтому обновления одного пользователя выполняются строго по очереди, а разных - параллельно.
+    Оба ограничения считаются только после блокировки пользователя: max_pending - сколько обновлений разных
+    пользователей принято в обработку, max_running - сколько из них выполняется одновременно. Очередь повторных
+    нажатий одного пользователя ждёт его блокировку и не отнимает места у остальных.
+    Библиотека создаёт задачу на каждое полученное обновление до любых ограничений, поэтому число ожидающих
+    в очередях пользователей обновлений не ограничивается (каждое из них - только приостановленная задача).
+    """
+
+    def __init__(self, max_running: int, max_pending: int) -> None:
+        # Семафор базового класса занимается до блокировки пользователя (очередь одного пользователя могла бы
+        # занять его целиком), поэтому он только включает параллельную обработку, а лимиты считаются ниже
+        super().__init__(UNBOUNDED_UPDATES)
+        self._max_running = max_running
+        self._max_pending = max_pending
+        self._running = None
+        self._pending = None
+        self._locks = KeyedLocks()
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = getattr(update, "effective_user", None)
+        chat = getattr(update, "effective_chat", None)
+        key = user.id if user is not None else chat.id if chat is not None else None
+        if key is None:
+            async with self._pending, self._running:
+                await coroutine
+            return
+        async with self._locks.hold(key):
+            async with self._pending, self._running:
+                await coroutine
+
+    async def initialize(self) -> None:
+        # Семафоры создаются внутри работающего цикла событий
+        self._pending = asyncio.Semaphore(self._max_pending)
+        self._running = asyncio.Semaphore(self._max_running)
+
+    async def shutdown(self) -> None:
+        pass
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий время каждого вызова Bot API (метка - имя метода из URL)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple:
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            api_timings.record(url.rpartition("/")[2], time.perf_counter() - started)
+
+class MetricsServer:
+    """
+    Минимальный HTTP-сервер на asyncio, отдающий метрики в текстовом формате Prometheus по пути /metrics.
+    Метрики формируются в цикле событий бота, поэтому читаются без блокировок.
+    """
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self) -> None:
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info("Метрики доступны на http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            parts = head.split(b" ", 2)
+            if len(parts) > 1 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                lines = [line for group in METRIC_GROUPS + COUNTER_GROUPS for line in group.prometheus()]
+                status, body = "200 OK", "\n".join(lines) + "\n"
+            else:
+                status, body = "404 Not Found", "not found\n"
+            payload = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT)
+# Счётчики кэшей и рассыльщика для экрана "📈 Метрики", /metrics и лога при остановке
+COUNTER_GROUPS = (
+    CounterGroup("catalog_cache", "Кэш каталога", catalog.stats, monotonic=("hits", "misses")),
+    CounterGroup("account_cache", "Кэш личного кабинета", account_pages.stats, monotonic=("hits", "misses")),
+    CounterGroup("notifier", "Уведомления", notifier.stats, monotonic=("sent", "failed", "retried")),
+)
+
+# Запуск фоновых задач после инициализации приложения
+async def post_init(application: Application) -> None:
+    await admin_cache.reload()
+    known_users.start()
+    notifier.start(application.bot)
+    message_archiver.start()
+    breakdown_purger.start()
+    await metrics_server.start()
+
+# Остановка фоновых задач и сохранение буферизованных данных при завершении работы
+async def post_shutdown(application: Application) -> None:
+    await known_users.stop()
+    await notifier.stop()
+    await message_archiver.stop()
+    await breakdown_purger.stop()
+    for group in COUNTER_GROUPS:
+        logger.info("%s: %s", group.title, group.summary())
+    await metrics_server.stop()
+    for group in METRIC_GROUPS:
+        logger.info("%s:\n%s", group.title, group.summary())
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    """
+    Создаёт приложение Telegram Bot со всеми обработчиками.
+    request подменяет HTTP-клиент обычных вызовов Bot API (нагрузочный тест loadtest.py использует фиктивный).
+    """
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Обычные вызовы Bot API замеряются; long polling getUpdates идёт через отдельный клиент и не искажает метрики
+        .request(request or MeteredRequest(connection_pool_size=BOT_API_POOL_SIZE))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_QUEUE_LIMIT))
+        .persistence(SQLitePersistence(db))
+        .build()
+    )
     # Регистрируем обработчики команд и сообщений
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handlers(build_callback_handlers())
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_combined_input))
-    # Запускаем бота в режиме опроса (polling)
-    application.run_polling()
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_item_file))
+    return application
+
+# Функция main - инициализация и запуск бота
+def main() -> None:
+    # Создаём таблицы базы данных до запуска обработчиков
+    init_db(DB_PATH)
+    application = build_application()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("❌ Для режима webhook необходимо задать WEBHOOK_URL")
+        # Встроенный сервер проверяет секретный заголовок каждого запроса
+        # и корректно останавливается по SIGINT/SIGTERM, дообработав принятые обновления
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        # Запускаем бота в режиме опроса (polling)
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # После остановки дожидаемся завершения отложенных операций с базой данных
+    db.close()
 
 # Точка входа в приложение
 if __name__ == "__main__":
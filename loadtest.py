@@ -0,0 +1,473 @@
+"""
+Нагрузочный тест бота без Telegram.
+Синтетические обновления (CallbackQuery) подаются в настоящее приложение bot.build_application(),
+а вызовы Bot API обслуживает фиктивный клиент FakeBotAPI с настраиваемой задержкой.
+
+Сценарий «запуск разбивки»: --users покупателей одновременно открывают актуальные разбивки, выбирают новую
+разбивку, быстро отмечают --picks случайных позиций из --items и оформляют заказ, соревнуясь за одни и те же
+позиции; в это время --admins администраторов листают отчёты. Обновления одного пользователя отправляются
+без ожидания ответа, поэтому проверяется и порядок их обработки.
+
+Часть покупателей (--taobao) затем отправляет ссылку ТаоБао, и каждое сообщение рассылается всем администраторам:
+так в чаты администраторов идёт поток уведомлений, который не должен задерживать уведомления «Сет разбит».
+Фиктивный Bot API отвечает на часть уведомлений ошибкой 429, сетевой ошибкой или 403 (--blocked чатов
+покупателей заблокировали бота), поэтому проверяются повторы и отбрасывание сообщений рассыльщиком.
+
+Результат - пропускная способность, перцентили задержек по маршрутам, метрики самого бота и проверки
+корректности (ни одна позиция не продана дважды, заказы совпадают с выбором и т.д.).
+Результаты сохраняются в loadtest-results/ (или --output); --compare выводит разницу с прошлым запуском.
+
+Пример: python loadtest.py --users 500 --items 20 --picks 3 --admins 4 --api-latency 30
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+
+RESULTS_DIR = Path(__file__).resolve().parent / "loadtest-results"
+# id синтетических пользователей: администраторы - с 1, покупатели - с USER_BASE, история заказов - с HISTORY_BASE
+USER_BASE = 1_000_000
+HISTORY_BASE = 10_000_000
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+# Начало текстов уведомлений рассыльщика (на них фиктивный Bot API отвечает ошибками)
+NOTIFICATION_PREFIXES = ("✅ Сет разбит", "📨 Новое сообщение")
+ADMIN_REPORTS = ("instance_users_menu", "view_full_splits", "view_all_positions", "view_user_checks", "show_users")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с фиктивным Bot API")
+    parser.add_argument("--users", type=int, default=200, help="число покупателей (по умолчанию 200)")
+    parser.add_argument("--items", type=int, default=20, help="позиций в разбивке (по умолчанию 20)")
+    parser.add_argument("--picks", type=int, default=3, help="позиций, отмечаемых каждым покупателем (по умолчанию 3)")
+    parser.add_argument("--admins", type=int, default=2, help="число администраторов, листающих отчёты (по умолчанию 2)")
+    parser.add_argument("--admin-rounds", type=int, default=5, help="проходов по отчётам на администратора")
+    parser.add_argument("--taobao", type=int, default=10, help="покупателей, отправляющих ссылку ТаоБао после заказа")
+    parser.add_argument("--api-429", type=float, default=0.05, help="доля уведомлений с ответом 429 (RetryAfter)")
+    parser.add_argument("--api-errors", type=float, default=0.05, help="доля уведомлений с сетевой ошибкой")
+    parser.add_argument("--blocked", type=float, default=0.05, help="доля покупателей, заблокировавших бота (403)")
+    parser.add_argument("--history", type=int, default=2000, help="заказов в базе до начала теста (для отчётов)")
+    parser.add_argument("--api-latency", type=float, default=30.0, help="средняя задержка вызова Bot API, мс")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя между шагами, мс")
+    parser.add_argument("--ramp", type=float, default=0.0, help="за сколько секунд подключаются все покупатели")
+    parser.add_argument("--concurrency", type=int, help="UPDATE_CONCURRENCY бота (по умолчанию из окружения)")
+    parser.add_argument("--queue-limit", type=int, help="UPDATE_QUEUE_LIMIT бота (по умолчанию из окружения)")
+    parser.add_argument("--drain-timeout", type=float, default=60.0,
+                        help="сколько секунд ждать рассылки уведомлений после теста (0 - не ждать)")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора случайных чисел")
+    parser.add_argument("--output", help="файл результатов (по умолчанию loadtest-results/<время>-<версия>.json)")
+    parser.add_argument("--compare", help="файл результатов прошлого запуска для сравнения")
+    parser.add_argument("--verbose", action="store_true", help="не скрывать INFO-логи бота")
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace, db_dir: str) -> None:
+    """Настройки бота читаются из окружения при импорте, поэтому задаются до import bot."""
+    os.environ["DB_PATH"] = os.path.join(db_dir, "loadtest.sqlite")
+    os.environ["BOT_TOKEN"] = "123456:loadtest"
+    os.environ["SUPER_ADMIN_IDS"] = ",".join(str(i) for i in range(1, args.admins + 1)) or "0"
+    os.environ["METRICS_PORT"] = "0"
+    if args.concurrency:
+        os.environ["UPDATE_CONCURRENCY"] = str(args.concurrency)
+    if args.queue_limit:
+        os.environ["UPDATE_QUEUE_LIMIT"] = str(args.queue_limit)
+
+
+def percentiles(samples: list) -> dict:
+    """Количество, p50/p95/p99 и максимум (мс) по всем замерам."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"count": len(ordered), "p50": round(pick(0.5), 2), "p95": round(pick(0.95), 2),
+            "p99": round(pick(0.99), 2), "max": round(ordered[-1] * 1000, 2)}
+
+
+def code_version() -> str:
+    """Короткий хэш коммита (с пометкой -dirty при незафиксированных изменениях) или "unknown"."""
+    try:
+        cwd = Path(__file__).resolve().parent
+        version = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=cwd, text=True).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=cwd).returncode != 0
+        return version + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def build_fake_api(BaseRequest):
+    class FakeBotAPI(BaseRequest):
+        """
+        Фиктивный Bot API: отвечает на вызовы без сети с задержкой latency (±50%)
+        и запоминает количество вызовов по методам и тексты успешно отправленных сообщений.
+        Уведомления (NOTIFICATION_PREFIXES) в чаты blocked получают 403, остальные с вероятностями
+        rate_429 и error_rate - ответ 429 или сетевую ошибку.
+        """
+
+        def __init__(self, latency: float, rng: random.Random, rate_429: float = 0.0, error_rate: float = 0.0,
+                     blocked: frozenset = frozenset()) -> None:
+            self.latency = latency
+            self.rng = rng
+            self.rate_429 = rate_429
+            self.error_rate = error_rate
+            self.blocked = blocked
+            self.calls = defaultdict(int)
+            self.texts = defaultdict(list)
+            self.injected = defaultdict(int)
+            self._message_id = 0
+
+        def _failure(self, chat_id: int, text: str):
+            """Ответ с ошибкой для уведомления или None."""
+            from telegram.error import NetworkError
+            if not text.startswith(NOTIFICATION_PREFIXES):
+                return None
+            if chat_id in self.blocked:
+                self.injected["403"] += 1
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+            roll = self.rng.random()
+            if roll < self.rate_429:
+                self.injected["429"] += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}
+            if roll < self.rate_429 + self.error_rate:
+                self.injected["network"] += 1
+                raise NetworkError("loadtest: connection reset")
+            return None
+
+        @property
+        def read_timeout(self):
+            return 5.0
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        async def do_request(self, url, method, request_data=None, *args, **kwargs) -> tuple:
+            api_method = url.rpartition("/")[2]
+            self.calls[api_method] += 1
+            params = request_data.parameters if request_data is not None else {}
+            if self.latency:
+                await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+            if api_method == "getMe":
+                result = BOT_USER
+            elif api_method in ("editMessageText", "sendMessage", "sendDocument"):
+                self._message_id += 1
+                chat_id = int(params.get("chat_id", 0))
+                failure = self._failure(chat_id, params.get("text", "")) if api_method == "sendMessage" else None
+                if failure is not None:
+                    status, body = failure
+                    return status, json.dumps(body).encode()
+                self.texts[api_method].append((chat_id, params.get("text", "")))
+                result = {"message_id": params.get("message_id", self._message_id), "date": int(time.time()),
+                          "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, "text": params.get("text", "")}
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeBotAPI
+
+
+class LoadTest:
+    """Подготовка базы, запуск приложения, прогон сценария и проверки корректности."""
+
+    def __init__(self, bot, args: argparse.Namespace) -> None:
+        self.bot = bot
+        self.args = args
+        self.rng = random.Random(args.seed)
+        from telegram.request import BaseRequest
+        # Покупатели, заблокировавшие бота, выбираются заранее: уведомления им отбрасываются после 403
+        blocked = frozenset(USER_BASE + i for i in random.Random(args.seed + 2).sample(
+            range(args.users), int(args.users * args.blocked)))
+        self.api = build_fake_api(BaseRequest)(args.api_latency / 1000, random.Random(args.seed + 1),
+                                               args.api_429, args.api_errors, blocked)
+        self.application = None
+        self._update_id = 0
+        self._pending = {}
+        self.latencies = defaultdict(list)
+        self.errors = []
+        self.picks = {}
+
+    async def seed_database(self) -> None:
+        """Разбивка для теста и, для отчётов, история заказов в отдельной разбивке."""
+        bot, args = self.bot, self.args
+
+        def seed(conn):
+            conn.execute("INSERT INTO breakdowns (name) VALUES ('Нагрузочный тест'), ('История')")
+            bot.add_items(conn, "Нагрузочный тест", [(f"Позиция {i}", 100.0 + i) for i in range(1, args.items + 1)])
+            bot.add_items(conn, "История", [(f"Товар {i}", 50.0 + i) for i in range(1, args.items + 1)])
+            history_items = [row[0] for row in conn.execute("SELECT id FROM items WHERE breakdown_name = 'История' ORDER BY id")]
+            # Позиции берутся по кругу, поэтому каждый заказ попадает в первый экземпляр со свободной позицией
+            for i in range(args.history):
+                bot.reserve_items(conn, HISTORY_BASE + i, f"history{i}", "История", [history_items[i % len(history_items)]])
+            # Уведомления исторических заказов не нужны
+            conn.execute("DELETE FROM outbox")
+
+        await bot.db.transaction(seed)
+        self.breakdown_id = (await bot.db.fetchone("SELECT id FROM breakdowns WHERE name = 'Нагрузочный тест'"))[0]
+        self.item_ids = [row[0] for row in await bot.db.fetchall(
+            "SELECT id FROM items WHERE breakdown_name = 'Нагрузочный тест' ORDER BY id")]
+
+    def callback_update(self, user_id: int, data: str):
+        from telegram import Update
+        self._update_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+        return Update.de_json({
+            "update_id": self._update_id,
+            "callback_query": {
+                "id": str(self._update_id), "from": user, "chat_instance": str(user_id), "data": data,
+                "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                            "from": BOT_USER, "text": "loadtest"},
+            },
+        }, self.application.bot)
+
+    def message_update(self, user_id: int, text: str):
+        from telegram import Update
+        self._update_id += 1
+        user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+        return Update.de_json({
+            "update_id": self._update_id,
+            "message": {"message_id": self._update_id, "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "from": user, "text": text},
+        }, self.application.bot)
+
+    async def send(self, user_id: int, data: str, text: Optional[str] = None) -> asyncio.Future:
+        """
+        Ставит обновление в очередь приложения; future завершается, когда все обработчики отработали.
+        С text отправляется текстовое сообщение (маршрут "message"), иначе нажатие кнопки data.
+        """
+        update = self.message_update(user_id, text) if text is not None else self.callback_update(user_id, data)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[update.update_id] = (future, data.partition(":")[0], time.perf_counter())
+        await self.application.update_queue.put(update)
+        return future
+
+    async def _finished(self, update, context) -> None:
+        future, route, started = self._pending.pop(update.update_id)
+        self.latencies[route].append(time.perf_counter() - started)
+        future.set_result(None)
+
+    async def _error(self, update, context) -> None:
+        self.errors.append(repr(context.error))
+
+    async def think(self) -> None:
+        if self.args.think:
+            await asyncio.sleep(self.args.think / 1000)
+
+    async def buyer(self, index: int) -> None:
+        bot, args = self.bot, self.args
+        user_id = USER_BASE + index
+        if args.ramp:
+            await asyncio.sleep(args.ramp * index / max(args.users, 1))
+        await (await self.send(user_id, "actual_breakdowns"))
+        await self.think()
+        await (await self.send(user_id, bot.encode_callback(bot.CB_BREAKDOWN, self.breakdown_id)))
+        await self.think()
+        picks = self.rng.sample(self.item_ids, min(args.picks, len(self.item_ids)))
+        self.picks[user_id] = set(picks)
+        # Отметки и оформление отправляются подряд, как при быстрых нажатиях
+        futures = [await self.send(user_id, bot.encode_callback(bot.CB_TOGGLE_ITEM, item_id)) for item_id in picks]
+        futures.append(await self.send(user_id, "finish_selection"))
+        await asyncio.gather(*futures)
+        await self.think()
+        await (await self.send(user_id, "personal_account"))
+        if index < args.taobao:
+            await self.think()
+            await (await self.send(user_id, "buy_from_taobao"))
+            await (await self.send(user_id, "message", text=f"https://item.taobao.com/item.htm?id={index}"))
+
+    async def admin(self, index: int) -> None:
+        for _ in range(self.args.admin_rounds):
+            for route in ADMIN_REPORTS:
+                await (await self.send(index + 1, route))
+                await self.think()
+
+    async def drain_notifications(self) -> bool:
+        deadline = time.monotonic() + self.args.drain_timeout
+        while time.monotonic() < deadline:
+            if not (await self.bot.db.fetchone("SELECT COUNT(*) FROM outbox"))[0]:
+                return True
+            self.bot.notifier.wake()
+            await asyncio.sleep(0.2)
+        return False
+
+    async def checks(self, drained: bool) -> dict:
+        db = self.bot.db
+        results = {}
+
+        def check(name: str, ok: bool, detail) -> None:
+            results[name] = {"ok": bool(ok), "detail": detail}
+
+        duplicates = await db.fetchall("""
+            SELECT instance_id, item_id, COUNT(*) FROM order_items GROUP BY instance_id, item_id HAVING COUNT(*) > 1
+        """)
+        check("no_item_sold_twice", not duplicates, {"duplicates": len(duplicates)})
+
+        counters = await db.fetchall("""
+            SELECT bi.id FROM breakdown_instances bi
+            LEFT JOIN (SELECT instance_id, COUNT(*) AS taken FROM order_items GROUP BY instance_id) oi
+                   ON oi.instance_id = bi.id
+            WHERE bi.taken_count != COALESCE(oi.taken, 0)
+               OR (bi.status = 'complete') != (bi.taken_count >= bi.total_count)
+        """)
+        check("instance_counters_consistent", not counters, {"mismatched_instances": len(counters)})
+
+        ordered = defaultdict(set)
+        for user_id, item_id in await db.fetchall("""
+            SELECT o.user_id, oi.item_id FROM orders o JOIN order_items oi ON oi.order_id = o.order_id
+            WHERE o.breakdown_name = 'Нагрузочный тест'
+        """):
+            ordered[user_id].add(item_id)
+        mismatched = [user_id for user_id, items in ordered.items() if items != self.picks.get(user_id)]
+        check("orders_match_selection", not mismatched, {"orders": len(ordered), "mismatched": len(mismatched)})
+
+        edits = [text for _, text in self.api.texts["editMessageText"]]
+        confirmed = sum(text.startswith("✅ Вы выбрали") for text in edits)
+        conflicts = sum(text.startswith("❌ Товары") for text in edits)
+        check("replies_match_orders", confirmed == len(ordered) and confirmed + conflicts == len(self.picks),
+              {"confirmed": confirmed, "conflicts": conflicts, "buyers": len(self.picks)})
+
+        updates = sum(len(samples) for route, samples in self.latencies.items() if route != "message")
+        check("all_updates_answered", self.api.calls["answerCallbackQuery"] == updates and not self._pending,
+              {"updates": updates, "answered": self.api.calls["answerCallbackQuery"], "unfinished": len(self._pending)})
+        check("no_handler_errors", not self.errors, {"errors": len(self.errors), "first": self.errors[:3]})
+
+        if drained:
+            expected = (await db.fetchone("""
+                SELECT COUNT(*) FROM orders o JOIN breakdown_instances bi ON bi.id = o.instance_id
+                WHERE o.breakdown_name = 'Нагрузочный тест' AND bi.status = 'complete'
+            """))[0]
+            notices = [(chat_id, text) for chat_id, text in self.api.texts["sendMessage"]
+                       if text.startswith(NOTIFICATION_PREFIXES)]
+            completions = sum(text.startswith("✅ Сет разбит") for _, text in notices)
+            messages = sum(text.startswith("📨 Новое сообщение") for _, text in notices)
+            dropped = self.bot.notifier.failed
+            check("notifications_delivered", completions + dropped == expected,
+                  {"expected": expected, "sent": completions, "dropped_blocked": dropped})
+            check("admin_messages_delivered", messages == min(self.args.taobao, self.args.users) * self.args.admins,
+                  {"expected": min(self.args.taobao, self.args.users) * self.args.admins, "sent": messages})
+            check("no_duplicate_notifications", len(set(notices)) == len(notices),
+                  {"duplicates": len(notices) - len(set(notices))})
+            injected = self.api.injected["429"] + self.api.injected["network"]
+            check("failed_sends_retried", self.bot.notifier.retried >= injected,
+                  {"injected": dict(self.api.injected), "retried": self.bot.notifier.retried})
+        else:
+            check("notifications_delivered", self.args.drain_timeout == 0, {"drained": False})
+        return results
+
+    async def run(self) -> dict:
+        from telegram import Update
+        from telegram.ext import TypeHandler
+        bot, args = self.bot, self.args
+        bot.init_db(bot.DB_PATH)
+        await self.seed_database()
+
+        self.application = bot.build_application(request=self.api)
+        # Последняя группа обработчиков отмечает завершение обработки обновления
+        self.application.add_handler(TypeHandler(Update, self._finished), group=99)
+        self.application.add_error_handler(self._error)
+        await self.application.initialize()
+        await bot.post_init(self.application)
+        await self.application.start()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[self.buyer(i) for i in range(args.users)],
+                             *[self.admin(i) for i in range(args.admins)])
+        duration = time.perf_counter() - started
+        drain_started = time.perf_counter()
+        drained = args.drain_timeout > 0 and await self.drain_notifications()
+        drain_time = time.perf_counter() - drain_started
+        checks = await self.checks(drained)
+
+        await self.application.stop()
+        await bot.post_shutdown(self.application)
+        await self.application.shutdown()
+
+        updates = sum(len(samples) for samples in self.latencies.values())
+        return {
+            "version": code_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "verbose")},
+            "concurrency": bot.UPDATE_CONCURRENCY,
+            "duration_s": round(duration, 3),
+            "updates": updates,
+            "throughput_updates_per_s": round(updates / duration, 1),
+            "latency_ms": {
+                "all": percentiles([s for samples in self.latencies.values() for s in samples]),
+                **{route: percentiles(samples) for route, samples in sorted(self.latencies.items())},
+            },
+            "bot_metrics": {
+                group.name: {key: {"count": hist.count,
+                                   **dict(zip(("p50", "p95", "p99"), (round(q * 1000, 2) for q in hist.quantiles())))}
+                             for key, hist in group.top()}
+                for group in bot.METRIC_GROUPS
+            },
+            "api_calls": dict(self.api.calls),
+            "notifications": {"drained": drained, "drain_s": round(drain_time, 3)},
+            "checks": checks,
+            "passed": all(c["ok"] for c in checks.values()),
+        }
+
+
+def print_report(results: dict) -> None:
+    print(f"Версия {results['version']}: {results['updates']} обновлений за {results['duration_s']} с, "
+          f"{results['throughput_updates_per_s']} обн/с (UPDATE_CONCURRENCY={results['concurrency']})")
+    print("Задержки, мс (от постановки в очередь до конца обработки):")
+    for route, stats in results["latency_ms"].items():
+        if stats["count"]:
+            print(f"  {route:24} {stats['count']:6d}  p50 {stats['p50']:8.2f}  p95 {stats['p95']:8.2f}  "
+                  f"p99 {stats['p99']:8.2f}  макс {stats['max']:8.2f}")
+    print("Проверки:")
+    for name, check in results["checks"].items():
+        print(f"  {'✅' if check['ok'] else '❌'} {name}: {check['detail']}")
+
+
+def print_comparison(results: dict, previous: dict) -> None:
+    """Разница с прошлым запуском: пропускная способность и перцентили по общим маршрутам."""
+    def delta(new, old):
+        return f"{new} ({(new - old) / old * 100:+.1f}%)" if old else f"{new}"
+
+    print(f"Сравнение с {previous['version']} ({previous['timestamp']}):")
+    print(f"  обн/с: {delta(results['throughput_updates_per_s'], previous['throughput_updates_per_s'])}")
+    for route, stats in results["latency_ms"].items():
+        old = previous["latency_ms"].get(route)
+        if stats["count"] and old and old["count"]:
+            print(f"  {route:24} p50 {delta(stats['p50'], old['p50'])}  p95 {delta(stats['p95'], old['p95'])}  "
+                  f"p99 {delta(stats['p99'], old['p99'])}")
+
+
+def main() -> None:
+    args = parse_args()
+    db_dir = tempfile.mkdtemp(prefix="loadtest-")
+    configure_environment(args, db_dir)
+    import bot  # настройки бота уже заданы в окружении
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    try:
+        results = asyncio.run(LoadTest(bot, args).run())
+    finally:
+        bot.db.close()
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    output = Path(args.output) if args.output else \
+        RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{results['version']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+    print_report(results)
+    if args.compare:
+        print_comparison(results, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+    print(f"Результаты сохранены в {output}")
+    sys.exit(0 if results["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()